@@ -0,0 +1 @@
+python -m tests.bench
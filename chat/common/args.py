@@ -1,6 +1,8 @@
 # args.py
 # in chat.common
 
+from chat.common.cluster import parse_addresses
+
 import argparse
 
 
@@ -15,6 +17,11 @@ def make_parser():
                         type=int,
                         default=0,
                         help='string saying this is the nth machine')
+    parser.add_argument('--addresses',
+                        required=False,
+                        type=parse_addresses,
+                        help='the machines, as host:port,host:port,... '
+                             '(defaults to Config.ADDRESSES)')
     return parser
 
 
@@ -37,6 +44,35 @@ def parse_server_args():
         Returns: an `argparse.Namespace` (filtering out `None` values).
     """
     parser = make_parser()
+    parser.add_argument('--asyncio',
+                        dest='use_asyncio',
+                        action='store_true',
+                        default=None,
+                        help='serve the connections as coroutines')
+    parser.add_argument('--threads',
+                        dest='use_asyncio',
+                        action='store_false',
+                        default=None,
+                        help='serve the connections on threads')
+    parser.add_argument('--max-workers',
+                        dest='max_workers',
+                        required=False,
+                        type=int,
+                        help='threads handling requests at once')
+    parser.add_argument('--max-concurrent-streams',
+                        dest='max_concurrent_streams',
+                        required=False,
+                        type=int,
+                        help='RPCs at once per connection (gRPC only)')
+    parser.add_argument('--max-message-len',
+                        dest='max_message_len',
+                        required=False,
+                        type=int,
+                        help='bytes a message may be (gRPC only)')
+    parser.add_argument('--compression',
+                        required=False,
+                        choices=['none', 'deflate', 'gzip'],
+                        help='compression of the responses (gRPC only)')
     return argparse.Namespace(**{k: v
                                  for k, v in
                                  parser.parse_args().__dict__.items()
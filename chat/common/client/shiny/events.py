@@ -1,9 +1,10 @@
 # events.py
 # in chat.common.client.shiny
 
+from chat.common.cluster import Channel, channel_address
 from chat.common.config import Config
 from chat.common.operations import Opcode
-from typing import Callable
+from typing import Callable, Optional
 
 import datetime
 import threading
@@ -11,6 +12,7 @@ import threading
 import curses
 
 
+subscription = None
 timer = None
 username = None
 
@@ -178,35 +180,43 @@ def print_messages(messages=None,
     curses.doupdate()
 
 
-def poll(request: Callable = None, username: str = None, **kwargs):
-    """Performs a regular `DeliverUndeliveredMessagesRequest` (followed by
-        a `AcknowledgeMessagesRequest`.
+def poll(request: Callable = None,
+         username: str = None,
+         ack_ids: list = (),
+         **kwargs):
+    """Performs a regular `DeliverUndeliveredMessagesRequest`, which also
+        acknowledges the messages of the last one (`ack_ids`), so there's
+        no separate `AcknowledgeMessagesRequest`.
     """
     try:
-        response = request(opcode=Opcode
-                        .DELIVER_UNDELIVERED_MESSAGES,
-                        logged_in=True,
-                        username=username,
-                        **kwargs)
+        response = request(opcode=Opcode.DELIVER_UNDELIVERED_MESSAGES,
+                           logged_in=True,
+                           username=username,
+                           ack_ids=ack_ids,
+                           **kwargs)
+        ack_ids = ()
         if response.get_error() == '':
             messages = response.get_messages()
 
-            # ack the messages
-            _ = request(opcode=Opcode
-                        .ACKNOWLEDGE_MESSAGES,
-                        messages=messages,
-                        **kwargs)
-
             print_messages(messages=messages, **kwargs)
 
-        create_poll(request=request, username=username, **kwargs)
-    except:
+            # ack the messages with the next poll
+            ack_ids = [message.get_id() for message in messages]
+
+        create_poll(request=request,
+                    username=username,
+                    ack_ids=ack_ids,
+                    **kwargs)
+    except Exception:
         # server failed; time to switch.
         # just don't start more polling. Wait for `main` to handle it.
         pass
 
 
-def create_poll(request: Callable = None, username: str = None, **kwargs):
+def create_poll(request: Callable = None,
+                username: str = None,
+                ack_ids: list = (),
+                **kwargs):
     """Creates the background polling `threading.Timer` that will execute
         `poll`.
     """
@@ -215,15 +225,56 @@ def create_poll(request: Callable = None, username: str = None, **kwargs):
                             function=poll,
                             kwargs=dict(request=request,
                                         username=username,
+                                        ack_ids=ack_ids,
                                         **kwargs))
     timer.start()
 
 
+def listen(request: Callable = None, **kwargs):
+    """Prints the `Message`s pushed on the `subscription` (acknowledging
+        them), until it's cancelled or the server fails.
+    """
+    try:
+        for response in subscription:
+            messages = response.get_messages()
+            if response.get_error() != '' or len(messages) == 0:
+                continue
+
+            # ack the messages
+            _ = request(opcode=Opcode.ACKNOWLEDGE_MESSAGES,
+                        ack_ids=[message.get_id() for message in messages],
+                        **kwargs)
+
+            print_messages(messages=messages, **kwargs)
+    except Exception:
+        # server failed (or the subscription was cancelled); time to switch.
+        # Wait for `main` to handle it.
+        pass
+
+
+def create_subscription(request: Callable = None,
+                        subscribe: Callable = None,
+                        username: str = None,
+                        **kwargs):
+    """Subscribes to the new messages (replacing any subscription to a
+        previous server), and starts the background `threading.Thread` that
+        will execute `listen`.
+    """
+    global subscription
+    if subscription is not None:
+        subscription.cancel()
+    subscription = subscribe(username=username, **kwargs)
+    threading.Thread(target=listen,
+                     kwargs=dict(request=request, **kwargs),
+                     daemon=True).start()
+
+
 def main(entry: Callable,
          request: Callable,
          handler: Callable,
          machine_id: int,
          addresses: list,
+         subscribe: Optional[Callable] = None,
          **kwargs):
     """A nice (TM) generic way of handling the event logic shared by the wire
        and gRPC protocols.
@@ -233,11 +284,14 @@ def main(entry: Callable,
         onwards to `request` and `handler`.
        `request` does requests across the connection,
        `handler` handles errors.
+       `subscribe` (if any) opens a stream of the new messages, which is used
+        instead of polling for them.
     """
     global timer
     global username
     try:
-        host, port = addresses[machine_id]
+        host, port = channel_address(addresses[machine_id],
+                                     Channel.CLIENT)
         kwargs = entry(host=host, port=port, **kwargs)
         has_logged_in = username is not None
         kwargs = initscr(**kwargs)
@@ -296,7 +350,14 @@ def main(entry: Callable,
                                           **kwargs)
 
         # start polling for new messages, every
-        create_poll(request=request, username=username, **kwargs)
+        # (or listening for them, if the server can push them).
+        if subscribe is None:
+            create_poll(request=request, username=username, **kwargs)
+        else:
+            create_subscription(request=request,
+                                subscribe=subscribe,
+                                username=username,
+                                **kwargs)
 
         msg_border_win.box()
         msg_border_win.noutrefresh()
@@ -376,9 +437,9 @@ def main(entry: Callable,
                         messages = response.get_messages()
 
                         # ack the messages
-                        _ = request(opcode=Opcode
-                                    .ACKNOWLEDGE_MESSAGES,
-                                    messages=messages,
+                        _ = request(opcode=Opcode.ACKNOWLEDGE_MESSAGES,
+                                    ack_ids=[message.get_id()
+                                             for message in messages],
                                     **kwargs)
 
                         print_messages(messages=messages,
@@ -417,8 +478,11 @@ def main(entry: Callable,
         new_machine_id = machine_id + 1
         if new_machine_id >= len(addresses):
             raise err
-        main(entry, request, handler, new_machine_id, addresses, **kwargs)
+        main(entry, request, handler, new_machine_id, addresses,
+             subscribe=subscribe, **kwargs)
 
 
     if timer is not None:
         timer.cancel()
+    if subscription is not None:
+        subscription.cancel()
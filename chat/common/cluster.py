@@ -0,0 +1,80 @@
+# cluster.py
+# in chat.common
+
+from enum import Enum
+from typing import Dict, List, Tuple, Union
+
+# a machine's address (see `channel_address`).
+Address = Union[Tuple[str, int], Tuple[str, int, Dict[str, Tuple[str, int]]]]
+
+# the most machines there can be, since a machine_id is a single byte when
+# the machines talk to each other.
+MAX_MACHINES = 1 << 8
+
+
+class Channel(Enum):
+    """What a machine listens on; and which port after its address' port it
+        is on, unless the address says otherwise.
+    """
+    CLIENT = 0
+    QUEUE = 1
+    SYNC = 2
+    HEARTBEAT = 3
+
+
+def channel_address(address: Address, channel: Channel) -> Tuple[str, int]:
+    """The (host, port) of a machine's `channel`.
+
+        `address` (i.e. an entry of `Config.ADDRESSES`) is either
+        `(host, port)`, where the clients connect to it, and the other
+        channels are on the next ports (so the port should be a multiple of
+        10); or `(host, port, channels)`, where `channels` has the
+        (host, port) of any channel (by its lowercase name, e.g. 'sync') that
+        isn't.
+    """
+    host, port = address[0], address[1]
+    if len(address) > 2 and channel.name.lower() in address[2]:
+        other_host, other_port = address[2][channel.name.lower()]
+        return other_host, int(other_port)
+    return host, port + channel.value
+
+
+def parse_address(text: str) -> Address:
+    """Parse a machine's address from the command line, i.e. `host:port`,
+        then any channels that aren't on the next ports as
+        `/channel=host:port` (e.g. `10.0.0.1:40130/sync=10.0.1.1:5000`).
+
+        Raises: `ValueError` if it isn't one.
+    """
+    def parse_host_port(host_port: str) -> Tuple[str, int]:
+        host, sep, port = host_port.rpartition(':')
+        if sep == '' or host == '':
+            raise ValueError(f'Invalid address {host_port!r}.')
+        # e.g. `[::1]:40130`
+        return host.strip('[]'), int(port)
+
+    address, *overrides = text.strip().split('/')
+    host, port = parse_host_port(address)
+    channels = {}
+    for override in overrides:
+        name, sep, host_port = override.partition('=')
+        if sep == '' or name.upper() not in Channel.__members__:
+            raise ValueError(f'Invalid channel {override!r}.')
+        channels[name.lower()] = parse_host_port(host_port)
+    if channels:
+        return host, port, channels
+    return host, port
+
+
+def parse_addresses(text: str) -> List[Address]:
+    """Parse the machines' addresses from the command line, separated by
+        commas (see `parse_address`), in the order of their machine_ids.
+
+        Raises: `ValueError` if they aren't.
+    """
+    addresses = [parse_address(address)
+                 for address in text.split(',')
+                 if address.strip() != '']
+    if not 0 < len(addresses) <= MAX_MACHINES:
+        raise ValueError(f'There must be 1 to {MAX_MACHINES!s} machines.')
+    return addresses
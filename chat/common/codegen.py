@@ -0,0 +1,208 @@
+# codegen.py
+# in chat.common
+
+from chat.common.config import Config
+from chat.common.serialization import SerializationUtils, STR_LEN_BITS
+from typing import Callable, Dict, List, Tuple
+
+import struct
+
+
+def int_from_limbs(names: List[str], fmt: str) -> str:
+    """The expression recombining the little-endian limbs (see
+        `serialization.int_format`) unpacked into `names`.
+    """
+    shift = 0
+    terms = []
+    for name, code in zip(names, fmt):
+        terms.append(name if shift == 0 else f'({name!s} << {shift!s})')
+        shift += 8 * struct.calcsize(f'<{code!s}')
+    return ' | '.join(terms)
+
+
+def int_to_limbs(name: str, fmt: str) -> List[str]:
+    """The expressions splitting the `int` in `name` into the little-endian
+        limbs of `fmt`.
+    """
+    shift = 0
+    limbs = []
+    for code in fmt:
+        width = 8 * struct.calcsize(f'<{code!s}')
+        limbs.append(f'({name!s} >> {shift!s}) & {(1 << width) - 1!s}')
+        shift += width
+    return limbs
+
+
+def generate_codecs(model: type) -> Tuple[Callable, Callable]:
+    """Generate a `serialize` and `decode` specialized to `model`'s fields.
+
+        Runs of consecutive fields with a `_field_formats` entry are packed by
+        a single precompiled `struct.Struct`, `str` fields with the default
+        (de)serializers are inlined, and anything else calls its field's
+        serializer / decoder directly. So there are no per-field `dict`
+        lookups or `getattr`s left in the generated code.
+
+        Returns: the `serialize` (for the instance) and `decode` (for the
+                 `classmethod`), which are equivalent to `Model.serialize`
+                 and `Model.decode`.
+    """
+    env: Dict[str, object] = {'int': int, 'len': len, 'str': str}
+    ser_lines: List[str] = []
+    ser_parts: List[str] = []
+    dec_lines: List[str] = ['obj = cls.__new__(cls)']
+
+    # the fixed-width fields not yet emitted, as (name, format)
+    run: List[Tuple[str, str]] = []
+
+    def flush_run():
+        if not run:
+            return
+        fmt = ''.join(f for _, f in run)
+        packer = f'_struct_{run[0][0]!s}'
+        env[packer] = struct.Struct(f'<{fmt!s}')
+
+        args = []
+        names = []
+        for name, f in run:
+            if len(f) == 1:
+                args.append(f'self._{name!s}')
+                names.append(f'obj._{name!s}')
+            else:
+                # the limbs are masked, so check the range up front, like
+                # `int.to_bytes` would.
+                bits = 8 * struct.calcsize(f'<{f!s}')
+                ser_lines.append(f'int_{name!s} = self._{name!s}')
+                ser_lines.append(f'if not 0 <= int_{name!s} < {1 << bits!s}: '
+                                 f'raise OverflowError('
+                                 f'\'int too big to convert\')')
+                args.extend(int_to_limbs(f'int_{name!s}', f))
+                names.extend(f'{name!s}_{i!s}' for i in range(len(f)))
+        ser_parts.append(f'{packer!s}.pack({", ".join(args)!s})')
+
+        dec_lines.append(f'({", ".join(names)!s},) = '
+                         f'{packer!s}.unpack_from(data, offset)')
+        for name, f in run:
+            if len(f) > 1:
+                limbs = [f'{name!s}_{i!s}' for i in range(len(f))]
+                dec_lines.append(f'obj._{name!s} = '
+                                 f'{int_from_limbs(limbs, f)!s}')
+        dec_lines.append(f'offset += {env[packer].size!s}')
+        run.clear()
+
+    for i, name in enumerate(model._order_of_fields):
+        fmt = model._field_formats.get(name, None)
+        serializer = model._field_serializers[name]
+        decoder = model._field_decoders.get(name, None)
+
+        if fmt is not None:
+            run.append((name, fmt))
+            continue
+        flush_run()
+
+        if (serializer is SerializationUtils.serialize_str and
+                decoder is SerializationUtils.decode_str):
+            ser_lines.append(f'str_{name!s} = str(self._{name!s} or \'\')'
+                             f'.encode(\'utf-8\')[:{Config.STR_MAX_LEN!s}]')
+            ser_parts.append(f'len(str_{name!s})'
+                             f'.to_bytes({STR_LEN_BITS!s}, \'little\')')
+            ser_parts.append(f'str_{name!s}')
+
+            dec_lines.append(f'length = int.from_bytes(data[offset:offset + '
+                             f'{STR_LEN_BITS!s}], \'little\')')
+            dec_lines.append(f'offset += {STR_LEN_BITS!s}')
+            dec_lines.append(f'obj._{name!s} = '
+                             f'str(data[offset:offset + length], \'utf-8\')')
+            dec_lines.append('offset += length')
+            continue
+
+        if decoder is None:
+            decoder = SerializationUtils.as_decoder(
+                model._field_deserializers[name],
+                serializer)
+        env[f'_serialize{i!s}'] = serializer
+        env[f'_decode{i!s}'] = decoder
+        ser_parts.append(f'_serialize{i!s}(self._{name!s})')
+        dec_lines.append(f'obj._{name!s}, offset = '
+                         f'_decode{i!s}(data, offset)')
+    flush_run()
+
+    ser_lines.append('return b\'\'.join((' +
+                     ''.join(f'{part!s}, ' for part in ser_parts) +
+                     '))')
+    dec_lines.append('return obj, offset')
+
+    source = ('def serialize(self):\n' +
+              ''.join(f'    {line!s}\n' for line in ser_lines) +
+              '\n'
+              'def decode(cls, data, offset=0):\n' +
+              ''.join(f'    {line!s}\n' for line in dec_lines))
+
+    exec(compile(source, f'<codecs of {model.__qualname__!s}>', 'exec'), env)
+    serialize, decode = env['serialize'], env['decode']
+    serialize.__doc__ = model.serialize.__doc__
+    decode.__doc__ = model.decode.__doc__
+    return serialize, decode
+
+
+def generate_grpc_converters(model: type,
+                             grpc_model: type) -> Tuple[Callable, Callable]:
+    """Generate the conversions between `model` and the `grpcio.Message`
+        subclass `grpc_model`, specialized to the fields they share.
+
+        Each field is copied by its attribute directly, and the nested
+        models of `list` fields use their own (cached) converters, so there
+        are no per-field `getattr`s or setter lookups left in the generated
+        code. Fields of `model` which `grpc_model` doesn't have get their
+        defaults.
+
+        Returns: the `to_grpc` (for the instance) and `from_grpc` (for the
+                 `classmethod`), which are equivalent to `Model.to_grpc_model`
+                 and `Model.from_grpc_model`.
+    """
+    from google.protobuf.message_factory import GetMessageClass
+
+    grpc_fields = grpc_model.DESCRIPTOR.fields_by_name
+    env: Dict[str, object] = {'_grpc_model': grpc_model}
+    to_args: List[str] = []
+    from_lines: List[str] = ['obj = cls.__new__(cls)']
+
+    for i, (name, t) in enumerate(model._fields.items()):
+        grpc_field = grpc_fields.get(name, None)
+        if grpc_field is None:
+            env[f'_default{i!s}'] = model._field_defaults.get(name, None)
+            from_lines.append(f'obj._{name!s} = _default{i!s}')
+            continue
+
+        nested_model = (model._fields_list_nested.get(name, None)
+                        if t is list else None)
+        if nested_model is not None and grpc_field.message_type is not None:
+            to_nested, from_nested = nested_model.grpc_converters(
+                GetMessageClass(grpc_field.message_type))
+            env[f'_to_grpc{i!s}'] = to_nested
+            env[f'_from_grpc{i!s}'] = from_nested.__get__(nested_model)
+            to_args.append(f'{name!s}=[_to_grpc{i!s}(v) '
+                           f'for v in self._{name!s} or ()]')
+            from_lines.append(f'obj._{name!s} = [_from_grpc{i!s}(v) '
+                              f'for v in grpc_obj.{name!s}]')
+        elif t is list:
+            to_args.append(f'{name!s}=self._{name!s}')
+            from_lines.append(f'obj._{name!s} = list(grpc_obj.{name!s})')
+        else:
+            to_args.append(f'{name!s}=self._{name!s}')
+            from_lines.append(f'obj._{name!s} = grpc_obj.{name!s}')
+    from_lines.append('return obj')
+
+    source = ('def to_grpc(self):\n'
+              '    return _grpc_model(' +
+              ''.join(f'{arg!s}, ' for arg in to_args) +
+              ')\n'
+              '\n'
+              'def from_grpc(cls, grpc_obj):\n' +
+              ''.join(f'    {line!s}\n' for line in from_lines))
+
+    exec(compile(source,
+                 f'<grpc converters of {model.__qualname__!s} and '
+                 f'{grpc_model.__qualname__!s}>',
+                 'exec'),
+         env)
+    return env['to_grpc'], env['from_grpc']
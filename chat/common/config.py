@@ -3,16 +3,53 @@
 
 # Useful configuration constants throughout the codebase.
 class Config:
+    # any number of machines, in the order of their machine_ids; each
+    # listens for clients on its port, and for the others on the next ports,
+    # unless it's (host, port, {'queue': (host, port), 'sync': ...,
+    # 'heartbeat': ...}) (see `cluster.channel_address`).
     ADDRESSES = [
         ("10.250.140.244", 40130), # port should be a multiple of 10
         ("10.250.78.122", 40130), # port should be a multiple of 10
         ("10.250.150.158", 40130), # port should be a multiple of 10
     ]
     MAX_WORKERS = 10
+    GRPC_CHANNELS = 1  # channels a gRPC client pools per server
+    GRPC_MAX_CONCURRENT_STREAMS = 100  # RPCs at once per gRPC connection
+    GRPC_MAX_MESSAGE_LEN = 1 << 22  # bytes a gRPC message may be
+    GRPC_COMPRESSION = 'none'  # one of 'none', 'deflate', 'gzip'
+    GRPC_KEEPALIVE_TIME = 10  # seconds between pings on an idle gRPC channel
+    GRPC_KEEPALIVE_TIMEOUT = 5  # seconds to wait for a ping's reply
+    SERVER_BACKLOG = 1 << 12  # pending connections for an `asyncio` server
     TIMEOUT_SYNC = 0.1
     TIMEOUT_QUEUE = 1
+    # seconds a proxied request may take; well over `REPLICATION_TIMEOUT`,
+    # since a write on the primary waits up to that for its replicas.
+    TIMEOUT_PROXY = 5
+    PROXY_CONNECTIONS = 4  # connections a replica proxies to the primary over
+    PROXY_WORKERS = 64  # threads handling the requests proxied to a machine
     TIMEOUT_CLIENT = 10
     STR_MAX_LEN = 280
     LIST_MAX_LEN = 255
     INT_MAX_LEN = 1 << 64
     POLL_TIME = 0.1
+    SUBSCRIPTION_HEARTBEAT = 1  # seconds between pushes if no new messages
+    DELIVERY_MAX_WAIT = 30  # seconds a delivery may wait for new messages
+    DELIVERY_MAX_WAITING = 4  # threads waiting at once (< MAX_WORKERS)
+    FRAME_CHUNK_LEN = 1 << 16  # bytes per `recv` into a frame's buffer
+    # bytes a frame's payload may be; well above the largest request (a
+    # `LIST_MAX_LEN` list of the largest model), so a peer can't make us
+    # buffer more than this per connection.
+    FRAME_MAX_LEN = 1 << 22
+    LOG_FSYNC = 'interval'  # one of 'always', 'interval', 'never'
+    LOG_FSYNC_INTERVAL = 1  # seconds between `fsync`s if 'interval'
+    LOG_COMPACT_LEN = 1 << 12  # records in the log before a snapshot
+    REPLICATION_BACKLOG_LEN = 1 << 12  # changes kept to catch up replicas
+    REPLICATION_DURABILITY = 'all'  # one of 'local', 'one', 'all'
+    REPLICATION_TIMEOUT = 1  # seconds to wait for replicas to acknowledge
+    REPLICATION_HEARTBEAT = 0.25  # seconds between positions sent if idle
+    READ_CONSISTENCY = 'primary'  # one of 'primary', 'bounded'
+    READ_MAX_STALENESS = 1  # seconds a replica's 'bounded' reads may lag
+    HEARTBEAT_INTERVAL = 0.1  # seconds between a machine's heartbeats
+    HEARTBEAT_TIMEOUT = 1  # seconds without a heartbeat until it's down
+    DATABASE_SHARDS = 16  # locks the accounts / messages are split over
+    PARTITIONS = 1  # primaries the usernames are spread over (1 = just one)
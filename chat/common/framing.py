@@ -0,0 +1,138 @@
+# framing.py
+# in chat.common
+
+from chat.common.config import Config
+from chat.common.serialization import SerializationUtils
+from typing import List, Optional, Tuple
+
+import asyncio
+import socket
+
+
+# the number of bytes in the header of a frame, encoding the frame's length.
+FRAME_LEN_BITS = 4
+
+
+def check_frame_len(length: int):
+    """Check that a frame's payload of `length` isn't longer than
+        `Config.FRAME_MAX_LEN`, before anything buffers it.
+
+        Raises: `ValueError` if it is.
+    """
+    if length > Config.FRAME_MAX_LEN:
+        raise ValueError(f'Frame of {length!s}B exceeds the maximum '
+                         f'of {Config.FRAME_MAX_LEN!s}B.')
+
+
+def serialize_frame(data: bytes) -> bytes:
+    """Prefix `data` with its frame header.
+    """
+    return FramedSocket.serialize_header(len(data)) + data
+
+
+def split_frames(data: bytes) -> Tuple[List[memoryview], int]:
+    """Split `data` (e.g. the contents of a file of frames) into the frames'
+        payloads.
+
+        Returns: the payloads of the whole frames, and the length of `data`
+                 they took up; anything after that is a partial frame.
+    """
+    view = memoryview(data)
+    frames = []
+    offset = 0
+    while len(view) - offset >= FRAME_LEN_BITS:
+        length, start = SerializationUtils.decode_int(view,
+                                                      offset,
+                                                      length=FRAME_LEN_BITS)
+        if len(view) - start < length:
+            break
+        frames.append(view[start:start + length])
+        offset = start + length
+    return frames, offset
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[bytes]:
+    """Read a single frame's payload from an `asyncio.StreamReader`. `None`
+        if the other side disconnected.
+
+        Raises: `ValueError` if it is too long (see `check_frame_len`).
+    """
+    try:
+        header = await reader.readexactly(FRAME_LEN_BITS)
+        length = SerializationUtils.deserialize_int(header,
+                                                    length=FRAME_LEN_BITS)
+        check_frame_len(length)
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+class FramedSocket(object):
+    """Wraps a `socket.socket` so that whole frames are sent and received.
+
+        Every frame is a `FRAME_LEN_BITS` header with the length of the
+        payload, then the payload. `recv` may return a partial frame or
+        several frames at once, so everything read is reassembled in a
+        buffer (reused for the lifetime of the socket) until a whole frame
+        is available.
+
+        Anything else (e.g. `close`, `settimeout`) is passed on to the
+        wrapped `socket.socket`.
+    """
+
+    def __init__(self,
+                 s: socket.socket,
+                 chunk_len: int = Config.FRAME_CHUNK_LEN):
+        self.socket = s
+        # the bytes received but not yet returned as a frame.
+        self._buffer = bytearray()
+        # where each `recv_into` lands, so we don't allocate per `recv`.
+        self._chunk = memoryview(bytearray(chunk_len))
+
+    def __getattr__(self, name: str):
+        return getattr(self.socket, name)
+
+    @staticmethod
+    def serialize_header(length: int) -> bytes:
+        """Serialize the length of a payload into a frame header.
+        """
+        check_frame_len(length)
+        return SerializationUtils.serialize_int(length,
+                                                length=FRAME_LEN_BITS)
+
+    def send_frame(self, data: bytes):
+        """Send `data` as a single frame.
+        """
+        self.socket.sendall(serialize_frame(data))
+
+    def pop_frame(self) -> Optional[bytes]:
+        """Take the first whole frame out of the buffer, if there is one.
+        """
+        if len(self._buffer) < FRAME_LEN_BITS:
+            return None
+        length = SerializationUtils.deserialize_int(
+            self._buffer[:FRAME_LEN_BITS],
+            length=FRAME_LEN_BITS)
+        check_frame_len(length)
+        end = FRAME_LEN_BITS + length
+        if len(self._buffer) < end:
+            return None
+        frame = bytes(self._buffer[FRAME_LEN_BITS:end])
+        del self._buffer[:end]
+        return frame
+
+    def recv_frame(self) -> Optional[bytes]:
+        """Receive a single frame's payload, blocking until all of it has
+            arrived. `None` if the other side disconnected.
+        """
+        frame = self.pop_frame()
+        while frame is None:
+            length = self.socket.recv_into(self._chunk)
+            if length == 0:
+                # This is a signal of disconnect.
+                # any partial frame left in the buffer is useless now.
+                self._buffer.clear()
+                return None
+            self._buffer += self._chunk[:length]
+            frame = self.pop_frame()
+        return frame
@@ -2,9 +2,9 @@
 # in chat.common
 
 from chat.common.operations import Opcode
-from chat.common.serialization import SerializationUtils
+from chat.common.serialization import SerializationUtils, int_format
 from chat.common.util import Model
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Tuple
 
 # DATA MODELS
 
@@ -14,7 +14,10 @@ Account = Model.model_with_fields(logged_in=bool,
 
 
 # the basic data model of a `Message`.
-Message = Model.model_with_fields(delivered=bool,
+# its `id` is given by the `Database` when it is first stored.
+Message = Model.model_with_fields(field_defaults=dict(id=0),
+                                  delivered=bool,
+                                  id=int,
                                   message=str,
                                   recipient_logged_in=bool,
                                   recipient_username=str,
@@ -24,6 +27,10 @@ Message = Model.model_with_fields(delivered=bool,
 
 # OBJECT MODELS
 
+# the `struct` format of an `opcode` (see `BaseRequest.serialize_opcode`).
+OPCODE_FORMAT = int_format(1)
+
+
 # these are the basic ones.
 class BaseRequest(Model.model_with_fields(opcode=int)):
     """A `Model` which has an `opcode` field, and the ability to peek
@@ -31,12 +38,20 @@ class BaseRequest(Model.model_with_fields(opcode=int)):
         to actually use).
     """
 
+    __slots__ = ()
+
     @staticmethod
     def deserialize_opcode(data: bytes) -> int:
         """Deserialize `bytes` to the `int` value of an `Opcode`.
         """
         return SerializationUtils.deserialize_int(data[:1])
 
+    @staticmethod
+    def decode_opcode(data: memoryview, offset: int = 0) -> Tuple[int, int]:
+        """Decode the `int` value of an `Opcode` at `offset`.
+        """
+        return SerializationUtils.decode_int(data, offset, length=1)
+
     @staticmethod
     def serialize_opcode(val: int) -> bytes:
         """Serialize the `int` value of an `Opcode` to `bytes`.
@@ -57,6 +72,8 @@ class BaseRequest(Model.model_with_fields(opcode=int)):
                                field_serializers: Dict[str, Callable] = {},
                                order_of_fields: List[str] = None,
                                fields_list_nested: Dict[str, type] = {},
+                               field_decoders: Dict[str, Callable] = {},
+                               field_formats: Dict[str, str] = {},
                                **new_fields: Dict[str, type]):
         """Creates a new `Model` which also uses an `opcode` field
             (but not the `peek_opcode` functionality, that is unique to
@@ -73,12 +90,17 @@ class BaseRequest(Model.model_with_fields(opcode=int)):
                 field_serializers=dict(list(field_serializers.items()) +
                                        [('opcode',
                                          BaseRequest.serialize_opcode)]),
+                field_decoders=dict(list(field_decoders.items()) +
+                                    [('opcode',
+                                      BaseRequest.decode_opcode)]),
+                field_formats=dict(list(field_formats.items()) +
+                                   [('opcode', OPCODE_FORMAT)]),
                 order_of_fields=(order_of_fields or
                                  (['opcode'] +
                                   list(new_fields.keys()))),
                 fields_list_nested=fields_list_nested,
                 **new_fields)):
-            pass
+            __slots__ = ()
 
         return __impl_class__
 
@@ -87,6 +109,8 @@ class BaseResponse(BaseRequest.add_fields(error=str)):
     """A `Model` which has an `error` field.
     """
 
+    __slots__ = ()
+
     @staticmethod
     def add_fields_with_opcode(opcode: int,
                                field_defaults: Dict[str, object] = {},
@@ -94,6 +118,8 @@ class BaseResponse(BaseRequest.add_fields(error=str)):
                                field_serializers: Dict[str, Callable] = {},
                                order_of_fields: List[str] = None,
                                fields_list_nested: Dict[str, type] = {},
+                               field_decoders: Dict[str, Callable] = {},
+                               field_formats: Dict[str, str] = {},
                                **new_fields: Dict[str, type]):
         """Creates a new `Model` which also uses an `error` field.
         """
@@ -108,12 +134,17 @@ class BaseResponse(BaseRequest.add_fields(error=str)):
                 field_serializers=dict(list(field_serializers.items()) +
                                        [('opcode',
                                          BaseRequest.serialize_opcode)]),
+                field_decoders=dict(list(field_decoders.items()) +
+                                    [('opcode',
+                                      BaseRequest.decode_opcode)]),
+                field_formats=dict(list(field_formats.items()) +
+                                   [('opcode', OPCODE_FORMAT)]),
                 order_of_fields=(order_of_fields or
                                  (['opcode'] +
                                   list(new_fields.keys()))),
                 fields_list_nested=fields_list_nested,
                 **new_fields)):
-            pass
+            __slots__ = ()
 
         return __impl_class__
 
@@ -134,11 +165,19 @@ CreateAccountResponse = BaseResponse.add_fields_with_opcode(
 
 
 # Function 2: List Accounts
+# a page of (at most) `limit` accounts (or `Config.LIST_MAX_LEN`, if it's 0),
+# starting from the `cursor` (i.e. the `next_cursor` of the last page, or empty
+# for the first page). `next_cursor` is empty if this is the last page.
 ListAccountsRequest = BaseRequest.add_fields_with_opcode(
+    field_defaults=dict(limit=0, cursor=''),
     text_wildcard=str,
+    limit=int,
+    cursor=str,
     opcode=Opcode.LIST_ACCOUNTS.value)
 ListAccountsResponse = BaseResponse.add_fields_with_opcode(
+    field_defaults=dict(next_cursor=''),
     accounts=list,
+    next_cursor=str,
     opcode=Opcode.LIST_ACCOUNTS.value,
     fields_list_nested=dict(
         accounts=Account))
@@ -154,28 +193,68 @@ SendMessageResponse = BaseResponse.add_fields_with_opcode(
     opcode=Opcode.SEND_MESSAGE.value)
 
 
+# Function 3.1: Send Messages
+# many messages (each with its `message`, `recipient_username` and
+# `sender_username`), to any recipients, at once.
+SendMessagesRequest = BaseRequest.add_fields_with_opcode(
+    messages=list,
+    opcode=Opcode.SEND_MESSAGES.value,
+    fields_list_nested=dict(
+        messages=Message))
+SendMessagesResponse = BaseResponse.add_fields_with_opcode(
+    opcode=Opcode.SEND_MESSAGES.value)
+
+
 # Function 4: Deliver Undelivered Messages
+# `max_wait` (in ms) is how long the server may hold the request until there
+# are new messages, rather than responding there are none (i.e. long-polling).
+# `ack_ids` are the ids of the messages (e.g. of the last delivery) to
+# acknowledge first, so a poll needs no separate `AcknowledgeMessagesRequest`.
+# `limit` and `cursor` page the messages, like `ListAccountsRequest`.
 DeliverUndeliveredMessagesRequest = BaseRequest.add_fields_with_opcode(
+    field_defaults=dict(max_wait=0, ack_ids=(), limit=0, cursor=''),
     logged_in=bool,
     username=str,
-    opcode=Opcode.DELIVER_UNDELIVERED_MESSAGES.value)
+    max_wait=int,
+    ack_ids=list,
+    limit=int,
+    cursor=str,
+    opcode=Opcode.DELIVER_UNDELIVERED_MESSAGES.value,
+    fields_list_nested=dict(
+        ack_ids=int))
 DeliverUndeliveredMessagesResponse = BaseResponse.add_fields_with_opcode(
+    field_defaults=dict(next_cursor=''),
     messages=list,
+    next_cursor=str,
     opcode=Opcode.DELIVER_UNDELIVERED_MESSAGES.value,
     fields_list_nested=dict(
         messages=Message))
 
 
 # Function 4.1: Acknowledge Messages
+# just the ids of the messages, since that's all the server needs.
 AcknowledgeMessagesRequest = BaseRequest.add_fields_with_opcode(
-    messages=list,
+    ids=list,
     opcode=Opcode.ACKNOWLEDGE_MESSAGES.value,
     fields_list_nested=dict(
-        messages=Message))
+        ids=int))
 AcknowledgeMessagesResponse = BaseResponse.add_fields_with_opcode(
     opcode=Opcode.ACKNOWLEDGE_MESSAGES.value)
 
 
+# Function 4.2: Subscribe Messages
+# the server keeps sending responses (i.e. pushing) until disconnected.
+SubscribeMessagesRequest = BaseRequest.add_fields_with_opcode(
+    logged_in=bool,
+    username=str,
+    opcode=Opcode.SUBSCRIBE_MESSAGES.value)
+SubscribeMessagesResponse = BaseResponse.add_fields_with_opcode(
+    messages=list,
+    opcode=Opcode.SUBSCRIBE_MESSAGES.value,
+    fields_list_nested=dict(
+        messages=Message))
+
+
 # Function 5: Delete Account
 DeleteAccountRequest = BaseRequest.add_fields_with_opcode(
     username=str,
@@ -14,3 +14,5 @@ class Opcode(Enum):
     DELETE_ACCOUNT = 5
     LOG_OUT_ACCOUNT = 6
     ACKNOWLEDGE_MESSAGES = 7
+    SUBSCRIBE_MESSAGES = 8
+    SEND_MESSAGES = 9
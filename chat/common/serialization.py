@@ -3,7 +3,7 @@
 
 from chat.common.config import Config
 from math import log
-from typing import Callable, Optional
+from typing import Callable, Tuple
 
 
 # this is supposed to be ceiling(log_2(...) / 8), but too lazy to calculate
@@ -17,15 +17,98 @@ from typing import Callable, Optional
 # the number of bits taken up in serializing an `int` using `chr`s
 INT_LEN_BITS = int(log(Config.INT_MAX_LEN) / 8) + 1
 # the number of bits taken up in serializing an `int` encoding a `list`'s `len`
-LIST_LEN_BITS = int(log(Config.LIST_MAX_LEN) / 8) + 1
+# (this one is exact, so `Config.LIST_MAX_LEN` can be raised arbitrarily).
+LIST_LEN_BITS = max(1, (Config.LIST_MAX_LEN.bit_length() + 7) // 8)
 # the number of bits taken up in serializing an `int` encoding a `str`'s `len`
 STR_LEN_BITS = int(log(Config.STR_MAX_LEN) / 8) + 1
 
 
+# the `struct` format of a `bool`.
+BOOL_FORMAT = '?'
+
+
+def int_format(length: int) -> str:
+    """The `struct` format of an unsigned `int` of `length` bytes. `struct`
+        only has widths of 1, 2, 4 and 8, so other lengths are split into
+        several codes; these are the little-endian limbs of the `int`.
+    """
+    codes = ''
+    for code, width in [('Q', 8), ('I', 4), ('H', 2), ('B', 1)]:
+        while length >= width:
+            codes += code
+            length -= width
+    return codes
+
+
+# the `struct` format of an `int` serialized with `INT_LEN_BITS`.
+INT_FORMAT = int_format(INT_LEN_BITS)
+
+
 class SerializationUtils:
     """A bunch of helpers for serialization of standard types.
+
+        The `decode_*` helpers are the cursor versions of `deserialize_*`;
+        they read from a `memoryview` at some `offset` and return the value
+        along with the offset just past it, so decoding a nested structure
+        is a single pass without any copies of the remaining `bytes`.
     """
 
+    @staticmethod
+    def decode_bool(data: memoryview, offset: int = 0) -> Tuple[bool, int]:
+        """Decode a `bool` at `offset`. It will be length 1.
+        """
+        return (bool.from_bytes(data[offset:offset + 1], byteorder='little'),
+                offset + 1)
+
+    @staticmethod
+    def decode_int(data: memoryview,
+                   offset: int = 0,
+                   length: int = INT_LEN_BITS) -> Tuple[int, int]:
+        """Decode an `int` at `offset`. It will be length `length`.
+        """
+        return (int.from_bytes(data[offset:offset + length],
+                               byteorder='little'),
+                offset + length)
+
+    @staticmethod
+    def decode_str(data: memoryview, offset: int = 0) -> Tuple[str, int]:
+        """Decode a `str` at `offset`; the first few `bytes` are the length
+            of the 'utf-8' encoding, followed by the encoding.
+        """
+        length, offset = SerializationUtils.decode_int(data,
+                                                       offset,
+                                                       length=STR_LEN_BITS)
+        return (str(data[offset:offset + length], 'utf-8'),
+                offset + length)
+
+    @staticmethod
+    def decode_list(data: memoryview,
+                    offset: int,
+                    item_decode: Callable) -> Tuple[list, int]:
+        """Decode a `list` at `offset`; the first few `bytes` are the length
+            of the `list`, then each item is decoded by `item_decode` (which
+            has the same signature as the other `decode_*`s).
+        """
+        length, offset = SerializationUtils.decode_int(data,
+                                                       offset,
+                                                       length=LIST_LEN_BITS)
+        val = [None] * length
+        for i in range(length):
+            val[i], offset = item_decode(data, offset)
+        return val, offset
+
+    @staticmethod
+    def as_decoder(deserialize: Callable, serialize: Callable) -> Callable:
+        """Make a `decode_*` out of a `deserialize` which doesn't have one,
+            by seeking ahead `len(serialize(...))` of what it deserialized.
+            Only a fallback, since it re-serializes every value.
+        """
+        def __impl_decode__(data: memoryview, offset: int = 0):
+            val = deserialize(data[offset:])
+            return val, offset + len(serialize(val))
+
+        return __impl_decode__
+
     @staticmethod
     def deserialize_bool(data: bytes) -> bool:
         """Deserialize a `bool` encoded in a `bytes`.
@@ -59,9 +142,7 @@ class SerializationUtils:
     def deserialize_str(data: bytes) -> str:
         """Deserialize `bytes` into a `str`.
         """
-        length = SerializationUtils.deserialize_int(data[:STR_LEN_BITS],
-                                                    length=STR_LEN_BITS)
-        return data[STR_LEN_BITS:length + STR_LEN_BITS].decode('utf-8')
+        return SerializationUtils.decode_str(memoryview(data))[0]
 
     @staticmethod
     def serialize_str(val: str) -> bytes:
@@ -77,53 +158,34 @@ class SerializationUtils:
     @staticmethod
     def deserialize_list(data: bytes,
                          item_deserialize: Callable,
-                         item_serialize: Callable,
-                         remain: Optional[int] = None) -> list:
+                         item_serialize: Callable) -> list:
         """Deserialize `bytes` into a `list` using some explicit item
             (de)serialization. First few `bytes` are the length of the `list`,
             then we use `item_deserialize` to get each item, figure out how
             far to seek ahead using `len(item_serialize(...))` on the
             deserialized object.
+
+            Prefer `decode_list` if the items have a `decode_*`.
         """
-        if remain is None:
-            length = SerializationUtils.deserialize_int(data[:LIST_LEN_BITS],
-                                                        length=LIST_LEN_BITS)
-            return SerializationUtils.deserialize_list(data[LIST_LEN_BITS:],
-                                                       item_deserialize,
-                                                       item_serialize,
-                                                       remain=length)
-        elif remain == 0:
-            return []
-        else:
-            obj = item_deserialize(data)
-            length = len(item_serialize(obj))
-            return [obj] + SerializationUtils.deserialize_list(
-                data[length:],
-                item_deserialize,
-                item_serialize,
-                remain=remain - 1)
+        return SerializationUtils.decode_list(
+            memoryview(data),
+            0,
+            SerializationUtils.as_decoder(item_deserialize,
+                                          item_serialize))[0]
 
     @staticmethod
-    def serialize_list(val: list,
-                       item_serialize: Callable,
-                       remain: Optional[int] = None) -> bytes:
+    def serialize_list(val: list, item_serialize: Callable) -> bytes:
         """Serialize `list` into `bytes` using some explicit item
             serialization. First few `bytes` are the length of the `list`,
-            then we use `item_serialize` for each item and concat the results.
+            then we use `item_serialize` for each item and concat the results
+            (with a single `join`, so it is linear in the total length).
         """
         if val is None:
             val = []
-        if remain is None:
-            val = val[:Config.LIST_MAX_LEN]
-            return (SerializationUtils.serialize_int(len(val),
-                                                     length=LIST_LEN_BITS) +
-                    SerializationUtils.serialize_list(val,
-                                                      item_serialize,
-                                                      remain=len(val)))
-        elif remain == 0:
-            return b''
-        else:
-            return (item_serialize(val[0]) +
-                    SerializationUtils.serialize_list(val[1:],
-                                                      item_serialize,
-                                                      remain=remain - 1))
+        val = val[:Config.LIST_MAX_LEN]
+        chunks = [None] * (len(val) + 1)
+        chunks[0] = SerializationUtils.serialize_int(len(val),
+                                                     length=LIST_LEN_BITS)
+        for i, item in enumerate(val):
+            chunks[i + 1] = item_serialize(item)
+        return b''.join(chunks)
@@ -1,15 +1,43 @@
 # database.py
 # in chat.common.server
 
+from chat.common.cluster import Channel, channel_address, MAX_MACHINES
 from chat.common.config import Config
+from chat.common.framing import FramedSocket, serialize_frame, split_frames
 from chat.common.models import Account, Message
 from chat.common.models import BaseRequest, BaseResponse
 from chat.common.serialization import SerializationUtils
+from chat.common.server.membership import Membership
+from chat.common.server.proxy import ProxyConnection, serve_proxy_connection
+from chat.common.util import Model
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 from enum import Enum
-from threading import Lock, Thread
-from typing import Dict
+from threading import Condition, Lock, RLock, Thread
+from typing import Callable, Deque, Dict, Iterable, List, Set, Tuple
 
+import bisect
+import itertools
+import os
 import socket
+import time
+import zlib
+
+
+# the start of a snapshot file (i.e. the accounts and messages files), then
+# its version as a byte. A file without it is in the legacy format: a single
+# serialized `list`, which can't start with this (its `bool`s are 0 or 1).
+SNAPSHOT_MAGIC = b'\xffsnapshot'
+SNAPSHOT_VERSION = 1
+
+# a `Message` as it was in the legacy snapshots, before it had an id.
+LegacyMessage = Model.model_with_fields(delivered=bool,
+                                        message=str,
+                                        recipient_logged_in=bool,
+                                        recipient_username=str,
+                                        sender_username=str,
+                                        time=int)
 
 
 class DatabaseOpcode(Enum):
@@ -23,6 +51,17 @@ class DatabaseOpcode(Enum):
     UPSERT_MESSAGE = 7
 
     SYNC_DATA = 8
+    REPLICATE = 9
+
+    SEND_MESSAGES = 10
+    ACKNOWLEDGE_MESSAGES = 11
+
+    LIST_ACCOUNTS = 12
+    GET_MESSAGES_PAGE = 13
+
+    POSITION = 14
+
+    HEARTBEAT = 15
 
 
 class DatabaseRequests:
@@ -30,7 +69,10 @@ class DatabaseRequests:
         account=Account,
         opcode=DatabaseOpcode.DELETE_ACCOUNT.value
     )
+    # of the `partitions` (see `partition_of`).
     DeleteAll = BaseRequest.add_fields_with_opcode(
+        partitions=list,
+        fields_list_nested=dict(partitions=int),
         opcode=DatabaseOpcode.DELETE_ALL.value
     )
     GetAccountLoggedIn = BaseRequest.add_fields_with_opcode(
@@ -38,6 +80,8 @@ class DatabaseRequests:
         opcode=DatabaseOpcode.GET_ACCOUNT_LOGGED_IN.value
     )
     GetAccounts = BaseRequest.add_fields_with_opcode(
+        partitions=list,
+        fields_list_nested=dict(partitions=int),
         opcode=DatabaseOpcode.GET_ACCOUNTS.value
     )
     GetMessages = BaseRequest.add_fields_with_opcode(
@@ -58,15 +102,79 @@ class DatabaseRequests:
         opcode=DatabaseOpcode.UPSERT_MESSAGE.value
     )
 
+    # new `Message`s, to any recipients, stored all at once.
+    SendMessages = BaseRequest.add_fields_with_opcode(
+        messages=list,
+        fields_list_nested=dict(messages=Message),
+        opcode=DatabaseOpcode.SEND_MESSAGES.value
+    )
+
+    # the ids of `Message`s to mark delivered, all at once.
+    AcknowledgeMessages = BaseRequest.add_fields_with_opcode(
+        ids=list,
+        fields_list_nested=dict(ids=int),
+        opcode=DatabaseOpcode.ACKNOWLEDGE_MESSAGES.value
+    )
+
+    # a page of the accounts (see `list_accounts`).
+    ListAccounts = BaseRequest.add_fields_with_opcode(
+        text_wildcard=str,
+        after=str,
+        limit=int,
+        partitions=list,
+        fields_list_nested=dict(partitions=int),
+        opcode=DatabaseOpcode.LIST_ACCOUNTS.value
+    )
+    # a page of the undelivered messages (see `get_messages_page`).
+    GetMessagesPage = BaseRequest.add_fields_with_opcode(
+        account=Account,
+        logged_in=bool,
+        after_time=int,
+        after_id=int,
+        limit=int,
+        opcode=DatabaseOpcode.GET_MESSAGES_PAGE.value
+    )
+
+    # a snapshot of the `partitions` (the ones the sender is the primary
+    # of), in as many of these as it takes (see `snapshot_frames`).
     SyncData = BaseRequest.add_fields_with_opcode(
         accounts=list,
+        done=bool,
         messages=list,
+        partitions=list,
+        reset=bool,
+        seq=int,
         fields_list_nested=dict(
             accounts=Account,
-            messages=Message
+            messages=Message,
+            partitions=int
         ),
         opcode=DatabaseOpcode.SYNC_DATA.value
     )
+    # a single change; the serialized change (e.g. an `UpsertMessage`)
+    # follows it in the same frame.
+    Replicate = BaseRequest.add_fields_with_opcode(
+        seq=int,
+        opcode=DatabaseOpcode.REPLICATE.value
+    )
+    # the primary's `log_seq`, after each batch of changes (and now and then
+    # if there aren't any), so a replica knows how stale it is (see
+    # `read_locally`).
+    Position = BaseRequest.add_fields_with_opcode(
+        seq=int,
+        opcode=DatabaseOpcode.POSITION.value
+    )
+
+    # what a machine sends the others with each heartbeat (see
+    # `Membership`): which machine it says the primary is (if `decided`),
+    # and whether it was the primary when it last ran.
+    Heartbeat = BaseRequest.add_fields_with_opcode(
+        caught_up=bool,
+        decided=bool,
+        primary_id=int,
+        was_primary=bool,
+        opcode=DatabaseOpcode.HEARTBEAT.value
+    )
 
 
 class DatabaseResponses:
@@ -97,286 +205,517 @@ class DatabaseResponses:
     UpsertAccount = BaseResponse.add_fields_with_opcode(
         opcode=DatabaseOpcode.UPSERT_ACCOUNT.value
     )
+    SendMessages = BaseResponse.add_fields_with_opcode(
+        missing=list,
+        fields_list_nested=dict(missing=Account),
+        opcode=DatabaseOpcode.SEND_MESSAGES.value
+    )
+    AcknowledgeMessages = BaseResponse.add_fields_with_opcode(
+        opcode=DatabaseOpcode.ACKNOWLEDGE_MESSAGES.value
+    )
     UpsertMessage = BaseResponse.add_fields_with_opcode(
         opcode=DatabaseOpcode.UPSERT_MESSAGE.value
     )
+    ListAccounts = BaseResponse.add_fields_with_opcode(
+        accounts=list,
+        more=bool,
+        fields_list_nested=dict(accounts=Account),
+        opcode=DatabaseOpcode.LIST_ACCOUNTS.value
+    )
+    GetMessagesPage = BaseResponse.add_fields_with_opcode(
+        messages=list,
+        more=bool,
+        fields_list_nested=dict(messages=Message),
+        opcode=DatabaseOpcode.GET_MESSAGES_PAGE.value
+    )
+
+    # the acknowledgement of a `SyncData` or `Replicate`.
+    Replicate = BaseResponse.add_fields_with_opcode(
+        resend=bool,
+        seq=int,
+        opcode=DatabaseOpcode.REPLICATE.value
+    )
 
 
 class Database(object):
     """A `Database` for the chat programs.
+
+        Each username is in one of `Config.PARTITIONS` partitions (see
+        `partition_of`), and the writes of its account and the messages to
+        it go to the partition's primary (see `get_partition_primary_id`),
+        which replicates them to every other machine.
+
+        The locks are always taken in the order: `membership`'s lock (it is
+        held for its callbacks), the shard locks (see `shard_lock`, and in
+        the order of `shard_locks` if more than one), then `log_lock`, then
+        `machine_lock`. `usernames_lock` is only ever
+        taken last, and nothing is taken holding it.
     """
 
     # key is username
     _accounts: Dict[str, Account] = {}
 
-    # key is recipient_username
-    _messages: Dict[str, Message] = {}
+    # the usernames of `_accounts`, sorted, so they can be listed a page at
+    # a time (see `list_accounts`).
+    _usernames: List[str] = []
+
+    # key is recipient_username, ordered by `time`
+    _messages: Dict[str, List[Message]] = {}
+
+    # key is id
+    _messages_by_id: Dict[int, Message] = {}
+
+    # key is recipient_username; only the undelivered `_messages`, sorted by
+    # `undelivered_key` (see `get_messages_page`).
+    _undelivered: Dict[str, List[Message]] = {}
+
+    # the id the next new `Message` gets
+    _next_message_id: int = 1
+
+    # key is recipient_username; called with each new undelivered `Message`
+    # stored on this machine (see `subscribe`).
+    _subscribers: Dict[str, List[Callable[[Message], None]]] = {}
+
+    # key is recipient_username; notified (sharing the recipient's shard
+    # lock) when a new undelivered `Message` to them is stored on this
+    # machine (see `wait_for_messages`).
+    _message_conds: Dict[str, Condition] = {}
+
+    # the append-only log of the changes since the last snapshot (i.e. the
+    # accounts and messages files), which is a file of frames of requests.
+    log_file = None
+    log_len: int = 0
+    log_fsynced_at: float = 0
+
+    # the number of changes made on this machine (as the primary of their
+    # partitions), so it orders them for replication.
+    log_seq: int = 0
+
+    # the most recent changes as (seq, `Replicate` frame), so a replica
+    # that is only a bit behind can catch up without a whole snapshot.
+    log_backlog: Deque[Tuple[int, bytes]] = deque(
+        maxlen=Config.REPLICATION_BACKLOG_LEN)
+
+    # key is machine_id; the last seq of another machine's changes applied
+    # here (see `local_replicate`).
+    origin_seqs: Dict[int, int] = {}
+
+    # key is machine_id; when (by `time.monotonic`) this machine last had
+    # every change another one had, as far as it knows (see `read_locally`).
+    replicated_ats: Dict[int, float] = {}
+
+    # key is machine_id; the last seq sent to / acknowledged by a replica.
+    replica_sent_seqs: Dict[int, int] = {}
+    replica_acked_seqs: Dict[int, int] = {}
+
+    # guards the accounts / messages of the usernames in a shard (see
+    # `shard_lock`), so different usernames don't contend.
+    shard_locks: List[Lock] = [Lock() for _ in range(Config.DATABASE_SHARDS)]
+
+    # guards the log, `log_seq`, `log_backlog`, the replica seqs,
+    # `origin_seqs`, `replicated_ats`, and `_next_message_id`.
+    log_lock: RLock = RLock()
+
+    # notified when there are changes to replicate, or replicas acknowledged
+    # some, or a machine went down.
+    replication_cond: Condition = Condition(log_lock)
 
     addresses = Config.ADDRESSES
 
-    machines_down: list = [False, False, False]
+    # guards the cluster membership: `machines_down`, `primary_id`,
+    # `machine_generations` and the sockets.
+    machines_down: list = [False for _ in Config.ADDRESSES]
     machine_id: int = None
     machine_lock: Lock = Lock()
 
-    queue_sockets: dict = {}
+    # notified when a machine's connections are up, or the primary is known.
+    machine_cond: Condition = Condition(machine_lock)
+
+    # the machine everyone agreed is the primary, `None` until it's known
+    # (see `startup`).
+    primary_id: int = None
+
+    # whether each machine is caught up (see `check_caught_up`), as of its
+    # last heartbeat; so it can be the primary of the partitions it's home
+    # to (see `get_partition_primary_id`).
+    machines_caught_up: List[bool] = [False for _ in Config.ADDRESSES]
+
+    # the partitions this machine had a whole snapshot of since it started.
+    synced_partitions: Set[int] = set()
+
+    # bumped each time a machine is up again, so the connections to it from
+    # before it went down are left alone.
+    machine_generations: List[int] = [0 for _ in Config.ADDRESSES]
+
+    # the heartbeats to / from the other machines (see `startup`).
+    membership: Membership = None
+
+    # guards `_usernames`.
+    usernames_lock: Lock = Lock()
+
+    # handles the requests proxied to this machine (see `handle_proxied`).
+    proxy_executor: ThreadPoolExecutor = None
+
+    # which of the `queue_sockets` the next proxied request goes on.
+    proxy_counter = itertools.count()
+
+    # key is machine_id; the queue ones are `Config.PROXY_CONNECTIONS` each.
+    queue_sockets: Dict[int, List[ProxyConnection]] = {}
     sync_sockets: dict = {}
-    queue_connections: dict = {}
+    queue_connections: Dict[int, List[FramedSocket]] = {}
     sync_connections: dict = {}
 
     @classmethod
     def startup(cls, machine_id=0, addresses=Config.ADDRESSES):
+        """Load this machine's data, then join the others. They are connected
+            to in the background (and again whenever they are back up, see
+            `Membership`), so this returns as soon as the primary is known,
+            rather than once every other machine is up.
+        """
+        if not 0 <= machine_id < len(addresses) <= MAX_MACHINES:
+            raise ValueError(f'Machine {machine_id!s} isn\'t one of the '
+                             f'{len(addresses)!s} (at most '
+                             f'{MAX_MACHINES!s}) machines.')
         cls.addresses = addresses
 
-        was_primarys = [None, None, None]
+        # key is machine_id; whether it was the primary when it last ran,
+        # and which machine it says the primary is (if it knows), as of its
+        # last heartbeat.
+        was_primarys: Dict[int, bool] = {}
+        primary_views: Dict[int, int] = {}
         with cls.machine_lock:
             cls.machine_id = machine_id
+            cls.primary_id = None
+            # the others are down until they are heard from.
+            cls.machines_down = [i != machine_id
+                                 for i in range(len(addresses))]
+            cls.machines_caught_up = [False for _ in addresses]
+            cls.synced_partitions = set()
+            cls.machine_generations = [0 for _ in addresses]
+        cls.proxy_executor = ThreadPoolExecutor(
+            max_workers=Config.PROXY_WORKERS)
+
+        # nothing else is running yet, so this needs no shard locks.
+        # a snapshot which can't be read raises, rather than starting empty.
+        try:
+            with open(cls.accounts_file_name(), "rb") as file:
+                content = file.read()
+            for account in cls.deserialize_accounts(content):
+                cls.local_upsert_account(account)
+        except FileNotFoundError:
+            pass
 
-            try:
-                with open(cls.accounts_file_name(), "rb") as file:
-                    content = b''.join(file.readlines())
-                    for account in cls.deserialize_accounts(content):
-                        cls.local_upsert_account(account)
-            except FileNotFoundError:
-                pass
-            except:
-                # no content or some random deserialization error
-                pass
+        try:
+            with open(cls.messages_file_name(), "rb") as file:
+                content = file.read()
+            for message in cls.deserialize_messages(content):
+                cls.local_upsert_message(message)
+        except FileNotFoundError:
+            pass
 
-            try:
-                with open(cls.messages_file_name(), "rb") as file:
-                    content = b''.join(file.readlines())
-                    for message in cls.deserialize_messages(content):
-                        cls.local_upsert_message(message)
-            except FileNotFoundError:
-                pass
-            except:
-                # no content or some random deserialization error
-                pass
+        try:
+            cls.replay_log()
+        except FileNotFoundError:
+            pass
 
-            try:
-                with open(cls.primary_log_file_name(), "r") as file:
-                    content = file.readlines()
-                    was_primary = content[0] == "1"
-                    was_primarys[cls.machine_id] = was_primary
-            except FileNotFoundError:
-                was_primary = False
-                was_primarys[cls.machine_id] = was_primary
-
-            host, port = cls.addresses[machine_id]
-
-            port += 1 # original + 1
-            queue_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            queue_socket.bind((host, port))
-            queue_socket.settimeout(None) # infinite
-            queue_socket.listen()
-
-            port += 1 # original + 2
-            sync_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sync_socket.bind((host, port))
-            sync_socket.settimeout(None) # infinite
-            sync_socket.listen()
-
-        def connect_to_queue(other_machine_id):
-            other_host, other_port = cls.addresses[other_machine_id]
-            other_port += 1
-            while True:
+        try:
+            with open(cls.primary_log_file_name(), "r") as file:
+                content = file.readlines()
+                was_primarys[machine_id] = content[0] == "1"
+        except FileNotFoundError:
+            was_primarys[machine_id] = False
+
+        queue_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        queue_socket.bind(channel_address(cls.addresses[machine_id],
+                                          Channel.QUEUE))
+        queue_socket.settimeout(None) # infinite
+        queue_socket.listen()
+
+        sync_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sync_socket.bind(channel_address(cls.addresses[machine_id],
+                                         Channel.SYNC))
+        sync_socket.settimeout(None) # infinite
+        sync_socket.listen()
+
+        def is_generation(other_machine_id, generation):
+            with cls.machine_lock:
+                return cls.machine_generations[other_machine_id] == generation
+
+        def connect_to_queue(other_machine_id, generation):
+            other_address = channel_address(cls.addresses[other_machine_id],
+                                            Channel.QUEUE)
+            while is_generation(other_machine_id, generation):
                 try:
                     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                     s.settimeout(Config.TIMEOUT_QUEUE)
-                    s.connect((other_host, other_port))
-                    s.sendall(int.to_bytes(machine_id, 1, byteorder='little'))
-                    with cls.machine_lock:
-                        cls.queue_sockets[other_machine_id] = s
-                    break
-                except:
-                    pass
+                    s.connect(other_address)
+                    # the requests time out on their own (see `proxy`).
+                    s.settimeout(None)
+                    s = FramedSocket(s)
+                    s.send_frame(int.to_bytes(machine_id,
+                                              1,
+                                              byteorder='little'))
+                except OSError:
+                    # not listening yet, so try again in a bit.
+                    time.sleep(Config.HEARTBEAT_INTERVAL)
+                    continue
+                with cls.machine_cond:
+                    if (cls.machine_generations[other_machine_id] !=
+                            generation):
+                        # it went down (and maybe up again) meanwhile.
+                        s.close()
+                        return
+                    (cls.queue_sockets
+                     .setdefault(other_machine_id, [])
+                     .append(ProxyConnection(s)))
+                    cls.machine_cond.notify_all()
+                return
 
-        def connect_to_sync(other_machine_id):
-            other_host, other_port = cls.addresses[other_machine_id]
-            other_port += 2
-            while True:
+        def connect_to_sync(other_machine_id, generation):
+            other_address = channel_address(cls.addresses[other_machine_id],
+                                            Channel.SYNC)
+            while is_generation(other_machine_id, generation):
                 try:
                     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                     s.settimeout(Config.TIMEOUT_SYNC)
-                    s.connect((other_host, other_port))
-                    i = machine_id * 2 + int(was_primarys[cls.machine_id])
-                    s.sendall(int.to_bytes(i, 1, byteorder='little'))
-                    with cls.machine_lock:
-                        cls.sync_sockets[other_machine_id] = s
-                    break
-                except:
-                    pass
+                    s.connect(other_address)
+                    s = FramedSocket(s)
+                    s.send_frame(int.to_bytes(machine_id,
+                                              1,
+                                              byteorder='little'))
+                except OSError:
+                    # not listening yet, so try again in a bit.
+                    time.sleep(Config.HEARTBEAT_INTERVAL)
+                    continue
+                with cls.machine_lock:
+                    if (cls.machine_generations[other_machine_id] !=
+                            generation):
+                        # it went down (and maybe up again) meanwhile.
+                        s.close()
+                        return
+                    cls.sync_sockets[other_machine_id] = s
+                Thread(target=handle_sync_acks,
+                       args=[other_machine_id, s]).start()
+                # so each sync socket has a single sender.
+                Thread(target=replicate_to,
+                       args=[other_machine_id, s]).start()
+                return
 
         def accept_on_queue():
             while True:
                 try:
                     connection, _ = queue_socket.accept()
-                    request = connection.recv(1024)
-                    if len(request) == 0:
+                    connection = FramedSocket(connection)
+                    request = connection.recv_frame()
+                    if request is None:
                         continue
-                    other_machine_id = int.from_bytes(request, byteorder='little')
+                    other_machine_id = int.from_bytes(request,
+                                                      byteorder='little')
                     with cls.machine_lock:
-                        cls.queue_connections[other_machine_id] = connection
-                    break
-                except:
+                        (cls.queue_connections
+                         .setdefault(other_machine_id, [])
+                         .append(connection))
+                    Thread(target=handle_queue_connection,
+                           args=[other_machine_id, connection]).start()
+                except (OSError, ValueError):
+                    # it went before saying which machine it is.
                     pass
 
         def accept_on_sync():
             while True:
                 try:
                     connection, _ = sync_socket.accept()
-                    request = connection.recv(1024)
-                    if len(request) == 0:
+                    connection = FramedSocket(connection)
+                    request = connection.recv_frame()
+                    if request is None:
                         continue
-                    i = int.from_bytes(request, byteorder='little')
-                    other_machine_id = i // 2
-                    other_was_primary = i % 2 == 1
+                    other_machine_id = int.from_bytes(request,
+                                                      byteorder='little')
                     with cls.machine_lock:
-                        was_primarys[other_machine_id] = other_was_primary
                         cls.sync_connections[other_machine_id] = connection
-                    break
-                except:
+                    Thread(target=handle_sync_connection,
+                           args=[other_machine_id, connection]).start()
+                except (OSError, ValueError):
+                    # it went before saying which machine it is.
                     pass
 
-        threads = []
-        for i in range(len(cls.machines_down)):
-            if i == machine_id:
-                continue
-            threads.append(Thread(target=connect_to_queue, args=[i]))
-            threads.append(Thread(target=connect_to_sync, args=[i]))
-        for i in range(len(cls.machines_down)):
-            if i == machine_id:
-                continue
-            threads.append(Thread(target=accept_on_queue, args=[]))
-            threads.append(Thread(target=accept_on_sync, args=[]))
-
-        for thread in threads:
-            thread.start()
-        for thread in threads:
-            thread.join()
-
         def handle_queue_connection(other_machine_id, connection):
             try:
-                while True:
-                    req = connection.recv(1024)
-                    if len(req) == 0:
-                        break
-                    with cls.machine_lock:
-                        if not cls.is_primary():
-                            for i in range(len(cls.machines_down)):
-                                if i == cls.machine_id:
-                                    break
-                                cls.machines_down[i] = True
-                                cls.persist_primary_log()
-                    opcode = DatabaseOpcode(BaseRequest.peek_opcode(req))
-                    request = None
-                    response = None
-                    match opcode:
-                        case DatabaseOpcode.DELETE_ACCOUNT:
-                            request = (DatabaseRequests.DeleteAccount
-                                    .deserialize(req))
-                            cls.delete_account(account=request.get_account())
-                            response = DatabaseResponses.DeleteAccount()
-                        case DatabaseOpcode.DELETE_ALL:
-                            request = (DatabaseRequests.DeleteAll
-                                    .deserialize(req))
-                            cls.delete_all()
-                            response = DatabaseResponses.DeleteAll()
-                        case DatabaseOpcode.GET_ACCOUNT_LOGGED_IN:
-                            request = (DatabaseRequests.GetAccountLoggedIn
-                                        .deserialize(req))
-                            response = DatabaseResponses.GetAccountLoggedIn(
-                                logged_in=cls.get_account_logged_in(
-                                    account=request.get_account()
-                                )
-                            )
-                        case DatabaseOpcode.GET_ACCOUNTS:
-                            request = (DatabaseRequests.GetAccounts
-                                    .deserialize(req))
-                            response = DatabaseResponses.GetAccounts(
-                                accounts=[v for v in cls.get_accounts().values()]
-                            )
-                        case DatabaseOpcode.GET_MESSAGES:
-                            request = (DatabaseRequests.GetMessages
-                                    .deserialize(req))
-                            response = DatabaseResponses.GetMessages(
-                                messages=cls.get_messages(
-                                    account=request.get_account(),
-                                    logged_in=request.get_logged_in()
-                                )
-                            )
-                        case DatabaseOpcode.HAS_ACCOUNT:
-                            request = (DatabaseRequests.HasAccount
-                                    .deserialize(req))
-                            response = DatabaseResponses.HasAccount(
-                                has_account=cls.has_account(
-                                    account=request.get_account()
-                                )
-                            )
-                        case DatabaseOpcode.UPSERT_ACCOUNT:
-                            request = (DatabaseRequests.UpsertAccount
-                                    .deserialize(req))
-                            cls.upsert_account(account=request.get_account())
-                            response = DatabaseResponses.UpsertAccount()
-                        case DatabaseOpcode.UPSERT_MESSAGE:
-                            request = (DatabaseRequests.UpsertMessage
-                                        .deserialize(req))
-                            cls.upsert_message(message=request.get_the_message())
-                            response = DatabaseResponses.UpsertMessage()
-                    connection.sendall(response.serialize())
-            except:
+                serve_proxy_connection(connection,
+                                       cls.handle_proxied,
+                                       cls.proxy_executor)
+            except (OSError, ValueError):
+                # disconnected, or sent a frame that's too long.
                 pass
             finally:
-                with cls.machine_lock:
-                    cls.machines_down[other_machine_id] = True
-                    cls.persist_primary_log()
+                cls.lost_connection(other_machine_id, connection)
 
         def handle_sync_connection(other_machine_id, connection):
             try:
                 while True:
-                    req = connection.recv(1024)
-                    if len(req) == 0:
+                    req = connection.recv_frame()
+                    if req is None:
                         break
-                    request = DatabaseRequests.SyncData.deserialize(req)
-                    with cls.machine_lock:
-                        cls._accounts = {}
-                        cls._messages = {}
-
-                        for account in request.get_accounts():
-                            cls.local_upsert_account(account)
-                        for message in request.get_messages():
-                            cls.local_upsert_message(message)
-
-                        cls.persist_accounts()
-                        cls.persist_messages()
-                    connection.sendall(b'')
-            except:
+                    # apply everything that has already arrived, then
+                    # acknowledge it all at once.
+                    resend = False
+                    while req is not None:
+                        response = cls.local_replicate(req,
+                                                       other_machine_id)
+                        resend = resend or response.get_resend()
+                        req = connection.pop_frame()
+                    response.set_resend(resend)
+                    connection.send_frame(response.serialize())
+            except (OSError, ValueError):
+                # disconnected, or sent something that can't be read.
                 pass
             finally:
-                with cls.machine_lock:
-                    cls.machines_down[other_machine_id] = True
-                    cls.persist_primary_log()
+                cls.lost_connection(other_machine_id, connection)
 
-        listener_threads = ([Thread(target=handle_queue_connection,
-                                    args=[id, conn])
-                             for id, conn in cls.queue_connections.items()] +
-                            [Thread(target=handle_sync_connection,
-                                    args=[id, conn])
-                             for id, conn in cls.sync_connections.items()])
+        def handle_sync_acks(other_machine_id, s):
+            try:
+                while True:
+                    try:
+                        ack = s.recv_frame()
+                    except socket.timeout:
+                        # nothing to acknowledge right now.
+                        continue
+                    if ack is None:
+                        break
+                    response = DatabaseResponses.Replicate.deserialize(ack)
+                    with cls.replication_cond:
+                        seq = response.get_seq()
+                        cls.replica_acked_seqs[other_machine_id] = seq
+                        if response.get_resend():
+                            # so `replicate_to` sends from there again.
+                            cls.replica_sent_seqs[other_machine_id] = seq
+                        cls.replication_cond.notify_all()
+            except (OSError, ValueError):
+                # disconnected, or sent something that can't be read.
+                pass
+            finally:
+                cls.lost_connection(other_machine_id, s)
 
-        for thread in listener_threads:
-            thread.start()
+        def replicate_to(other_machine_id, s):
+            sent_at = 0
+            try:
+                while True:
+                    with cls.replication_cond:
+                        if not cls.needs_sync(other_machine_id):
+                            with cls.machine_lock:
+                                if cls.sync_sockets.get(
+                                        other_machine_id, None) is not s:
+                                    # it went down, or this was replaced.
+                                    return
+                            # re-check now and then, e.g. in case we
+                            # became the primary.
+                            cls.replication_cond.wait(
+                                Config.REPLICATION_HEARTBEAT)
+                        if cls.needs_sync(other_machine_id):
+                            frames = cls.sync_frames(other_machine_id)
+                        elif (time.monotonic() - sent_at >=
+                                Config.REPLICATION_HEARTBEAT and
+                                cls.check_primary()):
+                            # nothing new, so it's up to date as of now.
+                            frames = [DatabaseRequests.Position(
+                                seq=cls.log_seq).serialize()]
+                        else:
+                            continue
+                    # everything since the last batch, in one go, and
+                    # without blocking the writers.
+                    s.sendall(b''.join(serialize_frame(frame)
+                                       for frame in frames))
+                    sent_at = time.monotonic()
+            except OSError:
+                cls.lost_connection(other_machine_id, s)
+
+        def beat():
+            with cls.machine_lock:
+                decided = cls.primary_id is not None
+                return DatabaseRequests.Heartbeat(
+                    caught_up=cls.machines_caught_up[machine_id],
+                    decided=decided,
+                    primary_id=cls.get_primary_id() if decided else 0,
+                    was_primary=was_primarys[machine_id]
+                ).serialize()
+
+        # MUST HOLD machine_lock
+        def agree_on_primary():
+            views = {i: primary_id for i, primary_id in primary_views.items()
+                     if not cls.machines_down[i] and
+                     not cls.machines_down[primary_id]}
+            if cls.primary_id is None:
+                # still starting, so a machine that knows tells us; unless
+                # it says it's this one, which must be from before it
+                # restarted.
+                known = [primary_id for primary_id in views.values()
+                         if primary_id != machine_id]
+                if known:
+                    cls.primary_id = Counter(known).most_common(1)[0][0]
+                return
+            # otherwise, go with most of them (e.g. they noticed the
+            # primary was down, then back up, before this did).
+            votes = Counter(views.values())
+            votes[cls.get_primary_id()] += 1
+            primary_id, n = votes.most_common(1)[0]
+            if n * 2 > len(views) + 1 and primary_id != cls.primary_id:
+                cls.primary_id = primary_id
+                cls.persist_primary_log()
 
-        with cls.machine_lock:
-            old_primary = None
-            for i in range(len(cls.machines_down)):
-                if was_primarys[i]:
-                    old_primary = i
-            if old_primary is not None and old_primary == cls.machine_id:
-                for i in range(len(cls.machines_down)):
-                    if i != cls.machine_id:
-                        cls.sync(i)
+        def on_beat(other_machine_id, data):
+            heartbeat = DatabaseRequests.Heartbeat.deserialize(data)
+            with cls.machine_cond:
+                was_primarys[other_machine_id] = heartbeat.get_was_primary()
+                cls.machines_caught_up[other_machine_id] = (
+                    heartbeat.get_caught_up())
+                if heartbeat.get_decided():
+                    primary_views[other_machine_id] = (
+                        heartbeat.get_primary_id())
+                else:
+                    primary_views.pop(other_machine_id, None)
+                agree_on_primary()
+                if cls.primary_id is not None:
+                    cls.check_caught_up()
+                cls.machine_cond.notify_all()
+
+        def on_up(other_machine_id):
+            generation = cls.set_machine_up(other_machine_id)
+            for _ in range(Config.PROXY_CONNECTIONS):
+                Thread(target=connect_to_queue,
+                       args=[other_machine_id, generation]).start()
+            Thread(target=connect_to_sync,
+                   args=[other_machine_id, generation]).start()
+
+        Thread(target=accept_on_queue, daemon=True).start()
+        Thread(target=accept_on_sync, daemon=True).start()
+        cls.membership = Membership(machine_id,
+                                    addresses,
+                                    beat=beat,
+                                    on_beat=on_beat,
+                                    on_up=on_up,
+                                    on_down=cls.set_machine_down)
+        cls.membership.start()
+
+        # the primary is known once a machine that knows tells us, or every
+        # other machine is heard from (or `Config.HEARTBEAT_TIMEOUT` passes
+        # first); then it's the one that was the primary last, if it's up,
+        # or else the first one up.
+        deadline = time.monotonic() + Config.HEARTBEAT_TIMEOUT
+        with cls.machine_cond:
+            while cls.primary_id is None:
+                remaining = deadline - time.monotonic()
+                if (remaining <= 0 or
+                        all(i in was_primarys
+                            for i in range(len(cls.machines_down)))):
+                    up = [i for i, down in enumerate(cls.machines_down)
+                          if not down]
+                    cls.primary_id = next((i for i in up
+                                           if was_primarys.get(i, False)),
+                                          up[0])
+                    break
+                cls.machine_cond.wait(remaining)
             cls.persist_primary_log()
+            cls.check_caught_up()
 
     @classmethod
     def accounts_file_name(cls):
@@ -390,67 +729,557 @@ class Database(object):
     def primary_log_file_name(cls):
         return "primary" + str(cls.machine_id) + ".txt"
 
+    @classmethod
+    def log_file_name(cls):
+        return "log" + str(cls.machine_id) + ".txt"
+
+    @staticmethod
+    def serialize_snapshot(items: Iterable[Model]) -> bytes:
+        """Serialize a snapshot file: `SNAPSHOT_MAGIC`, the version, then a
+            frame of each item, so they aren't capped at
+            `Config.LIST_MAX_LEN` like a serialized `list` is.
+        """
+        return (SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) +
+                b''.join(serialize_frame(v.serialize()) for v in items))
+
+    @staticmethod
+    def deserialize_snapshot(data: bytes,
+                             model: type,
+                             legacy_model: type) -> list:
+        """Deserialize a snapshot file of `model`s; or if it is in the
+            legacy format, a single serialized `list` of `legacy_model`s.
+
+            Raises: `ValueError` if it is of another version, or isn't all
+                    whole items.
+        """
+        if len(data) == 0:
+            return []
+        if not data.startswith(SNAPSHOT_MAGIC):
+            items, offset = SerializationUtils.decode_list(
+                memoryview(data),
+                0,
+                legacy_model.decode)
+            if offset != len(data):
+                raise ValueError(f'Legacy snapshot has '
+                                 f'{len(data) - offset!s}B after its '
+                                 f'{len(items)!s} items.')
+            return items
+        start = len(SNAPSHOT_MAGIC)
+        version = data[start] if len(data) > start else None
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f'Snapshot of version {version!s}, not '
+                             f'{SNAPSHOT_VERSION!s}.')
+        frames, length = split_frames(data[start + 1:])
+        if start + 1 + length != len(data):
+            raise ValueError('Snapshot ends with a partial frame.')
+        return [model.deserialize(frame) for frame in frames]
+
     @classmethod
     def deserialize_accounts(cls, data: bytes):
-        return SerializationUtils.deserialize_list(
-            data,
-            Account.deserialize,
-            lambda v: v.serialize()
-        )
+        # an `Account` is the same as it was in the legacy snapshots.
+        return cls.deserialize_snapshot(data, Account, Account)
 
-    # MUST HOLD machine_lock
+    # copying a `dict` / `list` is atomic, so this needs no shard locks; any
+    # change it races with is logged after it anyways.
     @classmethod
     def serialize_accounts(cls):
-        return SerializationUtils.serialize_list(
-            [v for v in cls._accounts.values()],
-            lambda v: v.serialize()
-        )
+        return cls.serialize_snapshot(list(cls._accounts.values()))
 
-    # MUST HOLD machine_lock
+    # MUST HOLD log_lock
     @classmethod
     def persist_accounts(cls):
-        if len(cls._accounts) == 0:
-            return
-        with open(cls.accounts_file_name(), "wb+") as file:
-            file.write(cls.serialize_accounts())
+        cls.persist_file(cls.accounts_file_name(), cls.serialize_accounts())
 
     @classmethod
     def deserialize_messages(cls, data: bytes):
-        return SerializationUtils.deserialize_list(
-            data,
-            Message.deserialize,
-            lambda v: v.serialize()
-        )
+        # the legacy ones get an id when they're stored.
+        return [message if isinstance(message, Message) else
+                message.as_model(Message)
+                for message in cls.deserialize_snapshot(data,
+                                                        Message,
+                                                        LegacyMessage)]
+
+    # see `serialize_accounts`
+    @classmethod
+    def serialize_messages(cls):
+        return cls.serialize_snapshot(vv
+                                      for v in list(cls._messages.values())
+                                      for vv in list(v))
+
+    # MUST HOLD log_lock
+    @classmethod
+    def persist_messages(cls):
+        cls.persist_file(cls.messages_file_name(), cls.serialize_messages())
+
+    @staticmethod
+    def persist_file(file_name: str, data: bytes):
+        """Replace the file's contents with `data`, such that a crash leaves
+            either the old or new contents (never a partial write).
+        """
+        tmp_file_name = file_name + ".tmp"
+        with open(tmp_file_name, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file_name, file_name)
+
+    # MUST HOLD the shard lock(s) of the change, if any
+    @classmethod
+    def append_log(cls, change: bytes, replicate: bool = True):
+        """Append a change (a serialized one of the `DatabaseRequests`) to
+            the log and, if `replicate` (i.e. it wasn't replicated from
+            another machine), the replication backlog, handing it to the
+            replicators (i.e. `replicate_to`). Snapshot everything once the
+            log gets long (see `compact`).
+
+            Returns: the seq of the change, to pass to `wait_for_replicas`.
+        """
+        with cls.replication_cond:
+            if cls.log_file is None:
+                cls.log_file = open(cls.log_file_name(), "ab")
+            cls.log_file.write(serialize_frame(change))
+            cls.log_file.flush()
+            cls.log_len += 1
+
+            if replicate:
+                cls.log_seq += 1
+                cls.log_backlog.append(
+                    (cls.log_seq,
+                     DatabaseRequests.Replicate(seq=cls.log_seq).serialize() +
+                     change))
+                cls.replication_cond.notify_all()
+
+            match Config.LOG_FSYNC:
+                case 'always':
+                    os.fsync(cls.log_file.fileno())
+                case 'interval':
+                    now = time.time()
+                    if now - cls.log_fsynced_at >= Config.LOG_FSYNC_INTERVAL:
+                        os.fsync(cls.log_file.fileno())
+                        cls.log_fsynced_at = now
+
+            if cls.log_len >= Config.LOG_COMPACT_LEN:
+                cls.compact()
+            return cls.log_seq
+
+    @classmethod
+    def compact(cls):
+        """Snapshot everything to the accounts and messages files, then
+            empty the log. The changes in the log are idempotent, so a crash
+            in between just means they are replayed on top of the snapshot.
+        """
+        with cls.log_lock:
+            cls.persist_accounts()
+            cls.persist_messages()
+            if cls.log_file is not None:
+                cls.log_file.close()
+            cls.log_file = open(cls.log_file_name(), "wb")
+            os.fsync(cls.log_file.fileno())
+            cls.log_len = 0
+
+    @classmethod
+    def replay_log(cls):
+        """Apply the changes in the log on top of the snapshot. A partial
+            change at the end (i.e. a crash mid-write) is dropped.
+        """
+        with open(cls.log_file_name(), "rb") as file:
+            content = file.read()
+        frames, length = split_frames(content)
+        for change in frames:
+            cls.local_apply(change)
+        if length < len(content):
+            with open(cls.log_file_name(), "r+b") as file:
+                file.truncate(length)
+        with cls.log_lock:
+            cls.log_len = len(frames)
+
+    # only the thread handling `origin`'s sync connection calls this, so its
+    # changes are applied in order.
+    @classmethod
+    def local_replicate(cls, req: bytes, origin: int):
+        """Apply a `SyncData` or `Replicate` from `origin` (the primary of
+            some partitions).
+
+            Returns: the acknowledgement, a `DatabaseResponses.Replicate`.
+        """
+        opcode = DatabaseOpcode(BaseRequest.peek_opcode(req))
+        resend = False
+        match opcode:
+            case DatabaseOpcode.SYNC_DATA:
+                request = DatabaseRequests.SyncData.deserialize(req)
+                with cls.all_shard_locks():
+                    if request.get_reset():
+                        cls.local_delete_partitions(request.get_partitions())
+                        with cls.log_lock:
+                            cls.origin_seqs[origin] = 0
+
+                    for account in request.get_accounts():
+                        cls.local_upsert_account(account)
+                    for message in request.get_messages():
+                        cls.local_upsert_message(message)
+
+                    if request.get_done():
+                        with cls.log_lock:
+                            cls.origin_seqs[origin] = request.get_seq()
+                            cls.compact()
+                        with cls.machine_lock:
+                            cls.synced_partitions.update(
+                                request.get_partitions())
+                            if cls.primary_id is not None:
+                                cls.check_caught_up()
+            case DatabaseOpcode.REPLICATE:
+                request, offset = (DatabaseRequests.Replicate
+                                   .decode(memoryview(req)))
+                seq = request.get_seq()
+                with cls.log_lock:
+                    expected_seq = cls.origin_seqs.get(origin, 0) + 1
+                if seq == expected_seq:
+                    change = bytes(req[offset:])
+                    cls.local_apply(memoryview(change), log=True)
+                    with cls.log_lock:
+                        cls.origin_seqs[origin] = seq
+                elif seq > expected_seq:
+                    # missed some, so we need them again.
+                    resend = True
+            case DatabaseOpcode.POSITION:
+                request = DatabaseRequests.Position.deserialize(req)
+                with cls.log_lock:
+                    if cls.origin_seqs.get(origin, 0) >= request.get_seq():
+                        cls.replicated_ats[origin] = time.monotonic()
+        with cls.log_lock:
+            return DatabaseResponses.Replicate(
+                resend=resend,
+                seq=cls.origin_seqs.get(origin, 0))
+
+    @classmethod
+    def local_apply(cls, change: memoryview, log: bool = False):
+        """Apply a change (a serialized one of the `DatabaseRequests`) from the
+            log or another machine, and `append_log` it too if `log` (but
+            not to replicate it, since it's the other machine's).
+        """
+        opcode = DatabaseOpcode(BaseRequest.peek_opcode(change))
+        match opcode:
+            case DatabaseOpcode.DELETE_ACCOUNT:
+                request = DatabaseRequests.DeleteAccount.decode(change)[0]
+                lock = cls.shard_lock(request.get_account().get_username())
+            case DatabaseOpcode.DELETE_ALL:
+                request = DatabaseRequests.DeleteAll.decode(change)[0]
+                lock = cls.all_shard_locks()
+            case DatabaseOpcode.UPSERT_ACCOUNT:
+                request = DatabaseRequests.UpsertAccount.decode(change)[0]
+                lock = cls.shard_lock(request.get_account().get_username())
+            case DatabaseOpcode.UPSERT_MESSAGE:
+                request = DatabaseRequests.UpsertMessage.decode(change)[0]
+                lock = cls.shard_lock(
+                    request.get_the_message().get_recipient_username())
+            case DatabaseOpcode.SEND_MESSAGES:
+                request = DatabaseRequests.SendMessages.decode(change)[0]
+                lock = cls.shard_locks_of(
+                    message.get_recipient_username()
+                    for message in request.get_messages())
+            case DatabaseOpcode.ACKNOWLEDGE_MESSAGES:
+                request = (DatabaseRequests.AcknowledgeMessages
+                           .decode(change)[0])
+                recipients = cls.recipients_of(request.get_ids())
+                lock = cls.shard_locks_of(recipients)
+            case _:
+                return
+        with lock:
+            match opcode:
+                case DatabaseOpcode.DELETE_ACCOUNT:
+                    cls.local_delete_account(request.get_account())
+                case DatabaseOpcode.DELETE_ALL:
+                    cls.local_delete_partitions(request.get_partitions())
+                case DatabaseOpcode.UPSERT_ACCOUNT:
+                    cls.local_upsert_account(request.get_account())
+                case DatabaseOpcode.UPSERT_MESSAGE:
+                    cls.local_upsert_message(request.get_the_message())
+                case DatabaseOpcode.SEND_MESSAGES:
+                    for message in request.get_messages():
+                        cls.local_upsert_message(message)
+                case DatabaseOpcode.ACKNOWLEDGE_MESSAGES:
+                    cls.local_acknowledge_messages(request.get_ids(),
+                                                   recipients)
+            if log:
+                cls.append_log(bytes(change), replicate=False)
+
+    @classmethod
+    def shard_lock(cls, username: str) -> Lock:
+        """The lock guarding `username`'s account and the messages to it.
+        """
+        return cls.shard_locks[hash(username) % len(cls.shard_locks)]
+
+    @classmethod
+    @contextmanager
+    def all_shard_locks(cls):
+        """Hold every shard lock, e.g. to change all of the usernames.
+        """
+        with ExitStack() as stack:
+            for lock in cls.shard_locks:
+                stack.enter_context(lock)
+            yield
+
+    @classmethod
+    @contextmanager
+    def shard_locks_of(cls, usernames: Iterable[str]):
+        """Hold the shard locks of all of the `usernames` (in order).
+        """
+        indices = sorted({hash(username) % len(cls.shard_locks)
+                          for username in usernames})
+        with ExitStack() as stack:
+            for i in indices:
+                stack.enter_context(cls.shard_locks[i])
+            yield
+
+    @staticmethod
+    def partition_of(username: str) -> int:
+        """The partition of `username`'s account and the messages to it.
+            Unlike `shard_lock`, this is the same on every machine (`hash`ing
+            a `str` isn't).
+        """
+        return zlib.crc32(username.encode('utf-8')) % Config.PARTITIONS
+
+    @classmethod
+    def in_partitions(cls,
+                      username: str,
+                      partitions: Iterable[int] = None) -> bool:
+        """Whether `username` is in one of the `partitions` (or any, if
+            `None`).
+        """
+        return partitions is None or cls.partition_of(username) in partitions
+
+    @classmethod
+    def partition_accounts(cls,
+                           partitions: Iterable[int] = None
+                           ) -> Dict[str, Account]:
+        """The `_accounts` in the `partitions` (or all of them, if `None`).
+        """
+        # copying a `dict` is atomic, so this needs no shard locks.
+        accounts = dict(cls._accounts)
+        if partitions is None or len(set(partitions)) == Config.PARTITIONS:
+            return accounts
+        return {username: account for username, account in accounts.items()
+                if cls.in_partitions(username, partitions)}
 
     # MUST HOLD machine_lock
     @classmethod
-    def serialize_messages(cls):
-        return SerializationUtils.serialize_list(
-            [vv for v in cls._messages.values() for vv in v],
-            lambda v: v.serialize()
-        )
+    def get_partition_primary_id(cls, partition: int) -> int:
+        """The primary of a partition, which its writes go to. Each
+            partition has a home machine, taking the partitions in turn
+            starting from the primary (so with a single partition, it's just
+            the primary). The home is the primary of it whenever it's up and
+            caught up (see `check_caught_up`); otherwise the next machine
+            that is (or the primary). So a machine going down or coming
+            back only moves the partitions it's home to.
+        """
+        primary_id = cls.get_primary_id()
+        if primary_id is None:
+            return None
+        n = len(cls.machines_down)
+        for i in range(n):
+            machine_id = (primary_id + partition + i) % n
+            if (machine_id == primary_id or
+                    (not cls.machines_down[machine_id] and
+                     cls.machines_caught_up[machine_id])):
+                return machine_id
 
     # MUST HOLD machine_lock
     @classmethod
-    def persist_messages(cls):
-        if len(cls._messages) == 0:
-            return
-        with open(cls.messages_file_name(), "wb+") as file:
-            file.write(cls.serialize_messages())
+    def check_caught_up(cls) -> bool:
+        """Whether this machine is caught up, i.e. it's the primary, or it
+            had a whole snapshot (from whichever was the primary of them
+            meanwhile) of each partition it's home to. Until then, those
+            stay with the others, so it doesn't write on (or replicate) the
+            stale data it had before it was down. Once it is, it stays so.
+        """
+        if not cls.machines_caught_up[cls.machine_id]:
+            n = len(cls.machines_down)
+            home = [partition for partition in range(Config.PARTITIONS)
+                    if (cls.get_primary_id() + partition) % n ==
+                    cls.machine_id]
+            cls.machines_caught_up[cls.machine_id] = (
+                cls.is_primary() or cls.synced_partitions.issuperset(home))
+        return cls.machines_caught_up[cls.machine_id]
+
+    # MUST HOLD machine_lock
+    @classmethod
+    def get_partitions(cls) -> List[int]:
+        """The partitions this machine is the primary of.
+        """
+        return [partition for partition in range(Config.PARTITIONS)
+                if cls.get_partition_primary_id(partition) == cls.machine_id]
+
+    @classmethod
+    def partition_primary_ids(cls,
+                              partitions: Iterable[int] = None
+                              ) -> Dict[int, List[int]]:
+        """Key is machine_id; the `partitions` (or all of them, if `None`)
+            it's the primary of.
+        """
+        if partitions is None:
+            partitions = range(Config.PARTITIONS)
+        primary_ids = {}
+        with cls.machine_lock:
+            for partition in partitions:
+                (primary_ids
+                 .setdefault(cls.get_partition_primary_id(partition), [])
+                 .append(partition))
+        return primary_ids
+
+    @classmethod
+    def group_by_primary(cls,
+                         items: Iterable,
+                         username_of: Callable[[object], str]
+                         ) -> Dict[int, list]:
+        """Key is machine_id; the `items` (e.g. `Message`s) whose username
+            (by `username_of`) is in a partition it's the primary of.
+        """
+        primary_ids = {}
+        with cls.machine_lock:
+            for item in items:
+                partition = cls.partition_of(username_of(item))
+                (primary_ids
+                 .setdefault(cls.get_partition_primary_id(partition), [])
+                 .append(item))
+        return primary_ids
+
+    @classmethod
+    def primary_id_of(cls, username: str) -> int:
+        """The primary of `username`'s partition.
+        """
+        with cls.machine_lock:
+            return cls.get_partition_primary_id(cls.partition_of(username))
+
+    @classmethod
+    def check_primary(cls):
+        """Whether this machine is the primary of any partition (i.e. has
+            changes of its own to replicate), for when not holding
+            machine_lock.
+        """
+        with cls.machine_lock:
+            return len(cls.get_partitions()) > 0
+
+    @classmethod
+    def read_locally(cls,
+                     consistency: str = None,
+                     partitions: Iterable[int] = None) -> bool:
+        """Whether this machine can answer a read of the `partitions` (or
+            of all of them, if `None`), rather than proxying it to their
+            primaries. It always can if it's the primary of all of them;
+            otherwise only if the read's `consistency` (or
+            `Config.READ_CONSISTENCY`, if `None`) is 'bounded', and it had
+            every change each of their primaries had at most
+            `Config.READ_MAX_STALENESS` seconds ago.
+        """
+        primary_ids = (set(cls.partition_primary_ids(partitions)) -
+                       {cls.machine_id})
+        if len(primary_ids) == 0:
+            return True
+        if (consistency or Config.READ_CONSISTENCY) != 'bounded':
+            return False
+        now = time.monotonic()
+        with cls.log_lock:
+            return all(i in cls.replicated_ats and
+                       now - cls.replicated_ats[i] <=
+                       Config.READ_MAX_STALENESS
+                       for i in primary_ids)
+
+    @classmethod
+    def set_machine_down(cls, other_machine_id):
+        with cls.machine_lock:
+            cls.machines_down[other_machine_id] = True
+            cls.machines_caught_up[other_machine_id] = False
+            cls.machine_generations[other_machine_id] += 1
+            connections = (cls.queue_sockets.pop(other_machine_id, []) +
+                           cls.queue_connections.pop(other_machine_id, []) +
+                           [cls.sync_sockets.pop(other_machine_id, None),
+                            cls.sync_connections.pop(other_machine_id, None)])
+            cls.persist_primary_log()
+            # so anything waiting on a connection to it stops (see
+            # `proxy_connection`).
+            cls.machine_cond.notify_all()
+        for connection in connections:
+            if connection is not None:
+                # so anything receiving on it stops.
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                connection.close()
+        # so it's connected to again once it's heard from again.
+        if cls.membership is not None:
+            cls.membership.suspect(other_machine_id)
+        with cls.replication_cond:
+            # the partitions it was the primary of moved, so a replica still
+            # catching up gets a snapshot of them again.
+            with cls.machine_lock:
+                behind = [i for i, caught_up
+                          in enumerate(cls.machines_caught_up)
+                          if not caught_up and i != cls.machine_id]
+            for i in behind:
+                cls.replica_sent_seqs.pop(i, None)
+            # so anything waiting on it stops.
+            cls.replication_cond.notify_all()
+
+    @classmethod
+    def set_machine_up(cls, other_machine_id) -> int:
+        """Another machine is up (again), though not caught up until its
+            heartbeats say so (see `check_caught_up`).
+
+            Returns: its new generation, for the connections to it.
+        """
+        with cls.machine_lock:
+            cls.machines_down[other_machine_id] = False
+            cls.machines_caught_up[other_machine_id] = False
+            cls.machine_generations[other_machine_id] += 1
+            generation = cls.machine_generations[other_machine_id]
+            cls.persist_primary_log()
+        # it's new (or back), so it gets a whole snapshot first (see
+        # `needs_sync`).
+        with cls.replication_cond:
+            cls.replica_sent_seqs.pop(other_machine_id, None)
+            cls.replica_acked_seqs.pop(other_machine_id, None)
+            cls.origin_seqs.pop(other_machine_id, None)
+            cls.replicated_ats.pop(other_machine_id, None)
+        return generation
+
+    @classmethod
+    def lost_connection(cls, other_machine_id, connection):
+        """A connection to / from another machine broke, so it's down, unless
+            the connection was already replaced (e.g. it was down, and is
+            back up).
+        """
+        with cls.machine_lock:
+            current = (cls.queue_sockets.get(other_machine_id, []) +
+                       cls.queue_connections.get(other_machine_id, []) +
+                       [cls.sync_sockets.get(other_machine_id, None),
+                        cls.sync_connections.get(other_machine_id, None)])
+            if not any(connection is c for c in current):
+                return
+        cls.set_machine_down(other_machine_id)
 
     # MUST HOLD machine_lock
     @classmethod
     def persist_primary_log(cls):
+        if cls.primary_id is None:
+            # it isn't known yet (see `startup`).
+            return
         with open(cls.primary_log_file_name(), "w+") as file:
             file.write("1" if cls.is_primary() else "0")
 
     # MUST HOLD machine_lock
     @classmethod
     def get_primary_id(cls):
-        for i in range(len(cls.machines_down)):
-            if not cls.machines_down[i]:
-                return i
-        return None
+        """The primary, or if it's down, the first machine up (which the
+            others pick too, once they notice).
+        """
+        first_up = next((i for i, down in enumerate(cls.machines_down)
+                         if not down), None)
+        if cls.primary_id is None:
+            return first_up
+        if cls.machines_down[cls.primary_id]:
+            cls.primary_id = first_up
+        return cls.primary_id
 
     # MUST HOLD machine_lock
     @classmethod
@@ -460,46 +1289,289 @@ class Database(object):
     # MUST HOLD machine_lock
     @classmethod
     def get_replicas(cls):
-        skipped_primary = False
-        replicas = []
-        for i in range(len(cls.machines_down)):
-            if not cls.machines_down[i]:
-                if not skipped_primary:
-                    skipped_primary = True
-                else:
-                    replicas.append(i)
-        return replicas
+        """The machines this one's changes are replicated to, i.e. every
+            other one up.
+        """
+        return [i for i, down in enumerate(cls.machines_down)
+                if not down and i != cls.machine_id]
 
-    # MUST HOLD machine_lock
+    # MUST HOLD log_lock
     @classmethod
     def sync(cls, other_machine_id):
-        if len(cls._accounts) == 0 and len(cls._messages) == 0:
+        """Send a replica the changes it hasn't been sent yet (see
+            `sync_frames`).
+        """
+        s = cls.sync_sockets[other_machine_id]
+        for frame in cls.sync_frames(other_machine_id):
+            s.send_frame(frame)
+
+    # MUST HOLD log_lock
+    @classmethod
+    def sync_frames(cls, other_machine_id):
+        """The changes a replica hasn't been sent yet, or a whole snapshot if
+            it is new or so far behind that the changes it needs are no
+            longer in `log_backlog`. They count as sent after this.
+        """
+        sent_seq = cls.replica_sent_seqs.get(other_machine_id, None)
+        oldest_seq = cls.log_seq - len(cls.log_backlog) + 1
+        if sent_seq is None or sent_seq + 1 < oldest_seq:
+            with cls.machine_lock:
+                partitions = cls.get_partitions()
+            frames = cls.snapshot_frames(partitions)
+        else:
+            frames = [frame for seq, frame in cls.log_backlog
+                      if seq > sent_seq]
+        frames.append(DatabaseRequests.Position(seq=cls.log_seq).serialize())
+        cls.replica_sent_seqs[other_machine_id] = cls.log_seq
+        return frames
+
+    # MUST HOLD log_lock
+    @classmethod
+    def needs_sync(cls, other_machine_id):
+        # one that is new (or back) always gets a snapshot first.
+        if (other_machine_id in cls.replica_sent_seqs and
+                cls.log_seq <= cls.replica_sent_seqs[other_machine_id]):
+            return False
+        with cls.machine_lock:
+            if cls.machines_down[other_machine_id]:
+                return False
+            if not cls.get_partitions():
+                # none of its own changes to send; so once it's the primary
+                # of some (see `check_caught_up`), the replicas already have
+                # them, and just get its changes from then on.
+                cls.replica_sent_seqs[other_machine_id] = cls.log_seq
+                return False
+            return True
+
+    # MUST HOLD log_lock
+    @classmethod
+    def snapshot_frames(cls, partitions: List[int]):
+        """Everything in the `partitions` as `SyncData`s, each with at most
+            `Config.LIST_MAX_LEN` of the accounts and of the messages. Like
+            `serialize_accounts`, this needs no shard locks.
+        """
+        accounts = list(cls.partition_accounts(partitions).values())
+        messages = [vv for k, v in list(cls._messages.items())
+                    if cls.in_partitions(k, partitions) for vv in list(v)]
+        n = Config.LIST_MAX_LEN
+        chunks = max(1, -(-max(len(accounts), len(messages)) // n))
+        return [DatabaseRequests.SyncData(
+                    accounts=accounts[i * n:(i + 1) * n],
+                    done=i == chunks - 1,
+                    messages=messages[i * n:(i + 1) * n],
+                    partitions=partitions,
+                    reset=i == 0,
+                    seq=cls.log_seq
+                ).serialize()
+                for i in range(chunks)]
+
+    @classmethod
+    def wait_for_replicas(cls, seq: int):
+        """Wait until enough replicas (see `Config.REPLICATION_DURABILITY`)
+            acknowledged the changes up to `seq`, or until
+            `Config.REPLICATION_TIMEOUT`. Must NOT hold any shard locks, since
+            that would hold up the other writes meanwhile.
+        """
+        if seq is None or Config.REPLICATION_DURABILITY == 'local':
             return
-        request = DatabaseRequests.SyncData(
-            accounts=[v for v in cls._accounts.values()],
-            messages=[vv for v in cls._messages.values() for vv in v]
-        )
-        cls.sync_sockets[other_machine_id].sendall(request.serialize())
+        deadline = time.time() + Config.REPLICATION_TIMEOUT
+        with cls.replication_cond:
+            while True:
+                with cls.machine_lock:
+                    replicas = cls.get_replicas()
+                acked = sum(1 for i in replicas
+                            if cls.replica_acked_seqs.get(i, 0) >= seq)
+                match Config.REPLICATION_DURABILITY:
+                    case 'one':
+                        needed = min(1, len(replicas))
+                    case _:
+                        needed = len(replicas)
+                remaining = deadline - time.time()
+                if acked >= needed or remaining <= 0:
+                    return
+                cls.replication_cond.wait(remaining)
+
+    @classmethod
+    def handle_proxied(cls, req: bytes) -> bytes:
+        """Handle a request proxied from another machine (see `proxy`).
+
+            Returns: the serialized response.
+        """
+        opcode = DatabaseOpcode(BaseRequest.peek_opcode(req))
+        request = None
+        response = None
+        match opcode:
+            case DatabaseOpcode.DELETE_ACCOUNT:
+                request = (DatabaseRequests.DeleteAccount
+                           .deserialize(req))
+                cls.delete_account(account=request.get_account())
+                response = DatabaseResponses.DeleteAccount()
+            case DatabaseOpcode.DELETE_ALL:
+                request = (DatabaseRequests.DeleteAll
+                           .deserialize(req))
+                cls.delete_all(partitions=request.get_partitions())
+                response = DatabaseResponses.DeleteAll()
+            case DatabaseOpcode.GET_ACCOUNT_LOGGED_IN:
+                request = (DatabaseRequests.GetAccountLoggedIn
+                           .deserialize(req))
+                response = DatabaseResponses.GetAccountLoggedIn(
+                    logged_in=cls.get_account_logged_in(
+                        account=request.get_account()
+                    )
+                )
+            case DatabaseOpcode.GET_ACCOUNTS:
+                request = (DatabaseRequests.GetAccounts
+                           .deserialize(req))
+                response = DatabaseResponses.GetAccounts(
+                    accounts=[v for v in cls.get_accounts(
+                        partitions=request.get_partitions()
+                    ).values()]
+                )
+            case DatabaseOpcode.GET_MESSAGES:
+                request = (DatabaseRequests.GetMessages
+                           .deserialize(req))
+                response = DatabaseResponses.GetMessages(
+                    messages=cls.get_messages(
+                        account=request.get_account(),
+                        logged_in=request.get_logged_in()
+                    )
+                )
+            case DatabaseOpcode.HAS_ACCOUNT:
+                request = (DatabaseRequests.HasAccount
+                           .deserialize(req))
+                response = DatabaseResponses.HasAccount(
+                    has_account=cls.has_account(
+                        account=request.get_account()
+                    )
+                )
+            case DatabaseOpcode.UPSERT_ACCOUNT:
+                request = (DatabaseRequests.UpsertAccount
+                           .deserialize(req))
+                cls.upsert_account(account=request.get_account())
+                response = DatabaseResponses.UpsertAccount()
+            case DatabaseOpcode.UPSERT_MESSAGE:
+                request = (DatabaseRequests.UpsertMessage
+                           .deserialize(req))
+                cls.upsert_message(message=request.get_the_message())
+                response = DatabaseResponses.UpsertMessage()
+            case DatabaseOpcode.SEND_MESSAGES:
+                request = (DatabaseRequests.SendMessages
+                           .deserialize(req))
+                response = DatabaseResponses.SendMessages(
+                    missing=[Account(username=username)
+                             for username in cls.send_messages(
+                                 messages=request.get_messages()
+                             )]
+                )
+            case DatabaseOpcode.ACKNOWLEDGE_MESSAGES:
+                request = (DatabaseRequests.AcknowledgeMessages
+                           .deserialize(req))
+                cls.acknowledge_messages(ids=request.get_ids())
+                response = DatabaseResponses.AcknowledgeMessages()
+            case DatabaseOpcode.LIST_ACCOUNTS:
+                request = (DatabaseRequests.ListAccounts
+                           .deserialize(req))
+                accounts, more = cls.list_accounts(
+                    text_wildcard=request.get_text_wildcard(),
+                    after=request.get_after(),
+                    limit=request.get_limit(),
+                    partitions=request.get_partitions()
+                )
+                response = DatabaseResponses.ListAccounts(
+                    accounts=accounts,
+                    more=more
+                )
+            case DatabaseOpcode.GET_MESSAGES_PAGE:
+                request = (DatabaseRequests.GetMessagesPage
+                           .deserialize(req))
+                messages, more = cls.get_messages_page(
+                    account=request.get_account(),
+                    logged_in=request.get_logged_in(),
+                    after=(request.get_after_time(),
+                           request.get_after_id()),
+                    limit=request.get_limit()
+                )
+                response = DatabaseResponses.GetMessagesPage(
+                    messages=messages,
+                    more=more
+                )
+        return response.serialize()
 
-    # MUST HOLD machine_lock
     @classmethod
-    def sync_with_replicas(cls):
-        replicas = cls.get_replicas()
-        for other_machine_id in replicas:
+    def proxy_connection(cls, primary_id, deadline) -> ProxyConnection:
+        """One of the (open) connections to the primary's queue socket,
+            waiting (until the `time.monotonic` `deadline`) for them if they
+            aren't up yet, e.g. it was only just heard from.
+
+            Raises: `ConnectionError` if the primary is down, or this machine
+                    is the primary now; or `TimeoutError` if there are none
+                    by the `deadline`.
+        """
+        if primary_id == cls.machine_id:
+            # e.g. it just became the primary, so there's nothing to proxy.
+            raise ConnectionError('This is the primary.')
+        with cls.machine_cond:
+            while True:
+                # any number of requests can be waiting on each connection,
+                # so they're just spread over them.
+                connections = [connection for connection
+                               in cls.queue_sockets.get(primary_id, [])
+                               if not connection.closed]
+                if connections:
+                    return connections[next(cls.proxy_counter) %
+                                       len(connections)]
+                # nothing connects to it without `membership` (i.e. before
+                # `startup`).
+                if cls.machines_down[primary_id] or cls.membership is None:
+                    raise ConnectionError('The primary is down.')
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('Not connected to the primary.')
+                cls.machine_cond.wait(remaining)
+
+    @classmethod
+    def proxy_request(cls, primary_id, data: bytes) -> bytes:
+        """Send a (serialized) request to `primary_id`, and wait for its
+            (serialized) response. Only `membership` decides it's down (by
+            its heartbeats); until then, if the connections to it aren't up
+            yet or break, it's sent again once they are.
+
+            Raises: `ConnectionError` once `primary_id` is down (or this
+                    machine is the primary now), `TimeoutError` if it isn't
+                    done within `Config.TIMEOUT_PROXY`, or `RuntimeError` if
+                    it failed there.
+        """
+        deadline = time.monotonic() + Config.TIMEOUT_PROXY
+        while True:
+            connection = cls.proxy_connection(primary_id, deadline)
             try:
-                cls.sync(other_machine_id)
-            except:
-                cls.machines_down[other_machine_id] = True
-                cls.persist_primary_log()
+                return connection.request(data,
+                                          timeout=deadline - time.monotonic())
+            except ConnectionError:
+                # it broke; but that's not it being down.
+                connection.close()
 
-    # MUST HOLD machine_lock
     @classmethod
     def proxy(cls,
               opcode,
+              primary_id,
               account=None,
               logged_in=None,
-              message=None):
-        primary_id = cls.get_primary_id()
+              message=None,
+              messages=None,
+              ids=None,
+              text_wildcard=None,
+              after=None,
+              limit=None,
+              partitions=None):
+        """Do a request on `primary_id` (the primary of its partitions)
+            instead (see `proxy_request`). If `primary_id` is down, it's done
+            again here, going to whichever is the primary now.
+
+            Raises: `TimeoutError` if `primary_id` doesn't respond within
+                    `Config.TIMEOUT_PROXY`, or `RuntimeError` if it failed
+                    doing the request.
+        """
         request = None
         match opcode:
             case DatabaseOpcode.DELETE_ACCOUNT:
@@ -507,13 +1579,17 @@ class Database(object):
                     account=account
                 )
             case DatabaseOpcode.DELETE_ALL:
-                request = DatabaseRequests.DeleteAll()
+                request = DatabaseRequests.DeleteAll(
+                    partitions=partitions
+                )
             case DatabaseOpcode.GET_ACCOUNT_LOGGED_IN:
                 request = DatabaseRequests.GetAccountLoggedIn(
                     account=account
                 )
             case DatabaseOpcode.GET_ACCOUNTS:
-                request = DatabaseRequests.GetAccounts()
+                request = DatabaseRequests.GetAccounts(
+                    partitions=partitions
+                )
             case DatabaseOpcode.GET_MESSAGES:
                 request = DatabaseRequests.GetMessages(
                     account=account,
@@ -531,25 +1607,47 @@ class Database(object):
                 request = DatabaseRequests.UpsertMessage(
                     the_message=message
                 )
+            case DatabaseOpcode.SEND_MESSAGES:
+                request = DatabaseRequests.SendMessages(
+                    messages=messages
+                )
+            case DatabaseOpcode.ACKNOWLEDGE_MESSAGES:
+                request = DatabaseRequests.AcknowledgeMessages(
+                    ids=ids
+                )
+            case DatabaseOpcode.LIST_ACCOUNTS:
+                request = DatabaseRequests.ListAccounts(
+                    text_wildcard=text_wildcard,
+                    after=after,
+                    limit=limit,
+                    partitions=partitions
+                )
+            case DatabaseOpcode.GET_MESSAGES_PAGE:
+                request = DatabaseRequests.GetMessagesPage(
+                    account=account,
+                    logged_in=logged_in,
+                    after_time=after[0],
+                    after_id=after[1],
+                    limit=limit
+                )
         try:
-            cls.queue_sockets[primary_id].sendall(request.serialize())
-            response = b''
-            while len(response) == 0:
-                response = cls.queue_sockets[primary_id].recv(1024)
-        except:
-            cls.machines_down[cls.get_primary_id()] = True
-            cls.persist_primary_log()
+            # a `TimeoutError` (e.g. it's waiting on its replicas) or
+            # `RuntimeError` doesn't mean it's down, so it's just raised;
+            # doing it here too would make two writers.
+            response = cls.proxy_request(primary_id, request.serialize())
+        except ConnectionError:
+            # it's down, so whichever is the primary now does it.
             match opcode:
                 case DatabaseOpcode.DELETE_ACCOUNT:
                     cls.delete_account(account=account)
                     return
                 case DatabaseOpcode.DELETE_ALL:
-                    cls.delete_all()
+                    cls.delete_all(partitions=partitions)
                     return
                 case DatabaseOpcode.GET_ACCOUNT_LOGGED_IN:
                     return cls.get_account_logged_in(account=account)
                 case DatabaseOpcode.GET_ACCOUNTS:
-                    return cls.get_accounts()
+                    return cls.get_accounts(partitions=partitions)
                 case DatabaseOpcode.GET_MESSAGES:
                     return cls.get_messages(account=account,
                                             logged_in=logged_in)
@@ -561,6 +1659,21 @@ class Database(object):
                 case DatabaseOpcode.UPSERT_MESSAGE:
                     cls.upsert_message(message=message)
                     return
+                case DatabaseOpcode.SEND_MESSAGES:
+                    return cls.send_messages(messages=messages)
+                case DatabaseOpcode.ACKNOWLEDGE_MESSAGES:
+                    cls.acknowledge_messages(ids=ids)
+                    return
+                case DatabaseOpcode.LIST_ACCOUNTS:
+                    return cls.list_accounts(text_wildcard=text_wildcard,
+                                             after=after,
+                                             limit=limit,
+                                             partitions=partitions)
+                case DatabaseOpcode.GET_MESSAGES_PAGE:
+                    return cls.get_messages_page(account=account,
+                                                 logged_in=logged_in,
+                                                 after=after,
+                                                 limit=limit)
         opcode = DatabaseOpcode(BaseRequest.peek_opcode(response))
         match opcode:
             case DatabaseOpcode.GET_ACCOUNT_LOGGED_IN:
@@ -580,6 +1693,18 @@ class Database(object):
                 return (DatabaseResponses.HasAccount
                         .deserialize(response)
                         .get_has_account())
+            case DatabaseOpcode.SEND_MESSAGES:
+                return [account.get_username()
+                        for account in (DatabaseResponses.SendMessages
+                                        .deserialize(response)
+                                        .get_missing())]
+            case DatabaseOpcode.LIST_ACCOUNTS:
+                response = DatabaseResponses.ListAccounts.deserialize(response)
+                return response.get_accounts(), response.get_more()
+            case DatabaseOpcode.GET_MESSAGES_PAGE:
+                response = (DatabaseResponses.GetMessagesPage
+                            .deserialize(response))
+                return response.get_messages(), response.get_more()
             case _:
                 # success; method is a `void`
                 return
@@ -588,135 +1713,535 @@ class Database(object):
     def upsert_account(cls, account: Account):
         """Update or insert an `Account`.
         """
-        with cls.machine_lock:
-            if cls.is_primary():
+        primary_id = cls.primary_id_of(account.get_username())
+        if primary_id == cls.machine_id:
+            with cls.shard_lock(account.get_username()):
                 cls.local_upsert_account(account)
-                cls.persist_accounts()
-                cls.sync_with_replicas()
-            else:
-                return cls.proxy(DatabaseOpcode.UPSERT_ACCOUNT, 
-                                 account=account)
+                seq = cls.append_log(
+                    DatabaseRequests.UpsertAccount(account=account)
+                    .serialize())
+            cls.wait_for_replicas(seq)
+        else:
+            return cls.proxy(DatabaseOpcode.UPSERT_ACCOUNT,
+                             primary_id,
+                             account=account)
 
-    # MUST HOLD machine_lock
+    # MUST HOLD the account's shard lock
     @classmethod
     def local_upsert_account(cls, account: Account):
-        cls._accounts[account.get_username()] = account
+        username = account.get_username()
+        if username not in cls._accounts:
+            with cls.usernames_lock:
+                bisect.insort(cls._usernames, username)
+        cls._accounts[username] = account
 
     @classmethod
-    def get_accounts(cls):
-        """Get the entire `_accounts` table...
+    def get_accounts(cls,
+                     consistency: str = None,
+                     partitions: List[int] = None):
+        """Get the entire `_accounts` table (or the `partitions` of it)...
         """
-        with cls.machine_lock:
-            if cls.is_primary():
-                return {k: v for k, v in cls._accounts.items()}
+        if cls.read_locally(consistency, partitions):
+            return cls.partition_accounts(partitions)
+        accounts = {}
+        primary_ids = cls.partition_primary_ids(partitions)
+        for primary_id, its_partitions in primary_ids.items():
+            if primary_id == cls.machine_id:
+                accounts.update(cls.partition_accounts(its_partitions))
             else:
-                return cls.proxy(DatabaseOpcode.GET_ACCOUNTS)
+                accounts.update(cls.proxy(DatabaseOpcode.GET_ACCOUNTS,
+                                          primary_id,
+                                          partitions=its_partitions))
+        return accounts
 
     @classmethod
-    def get_account_logged_in(cls, account: Account):
+    def list_accounts(cls,
+                      text_wildcard: str,
+                      after: str,
+                      limit: int,
+                      consistency: str = None,
+                      partitions: List[int] = None
+                      ) -> Tuple[List[Account], bool]:
+        """Get (at most) `limit` of the `Account`s (in the `partitions`, or
+            any, if `None`) whose usernames contain `text_wildcard`, in order
+            of username, starting after the username `after` (or from the
+            first, if it's empty).
+
+            Returns: the `Account`s, and whether there are any more after
+                     them.
+        """
+        if cls.read_locally(consistency, partitions):
+            if (partitions is not None and
+                    len(set(partitions)) == Config.PARTITIONS):
+                partitions = None
+            usernames = []
+            more = False
+            with cls.usernames_lock:
+                start = bisect.bisect_right(cls._usernames, after)
+                for i in range(start, len(cls._usernames)):
+                    username = cls._usernames[i]
+                    if (text_wildcard not in username or
+                            not cls.in_partitions(username, partitions)):
+                        continue
+                    if len(usernames) == limit:
+                        more = True
+                        break
+                    usernames.append(username)
+            # reading a `dict` is atomic, so this needs no shard locks.
+            accounts = [cls._accounts.get(username, None)
+                        for username in usernames]
+            return [account for account in accounts
+                    if account is not None], more
+
+        # a page from each primary, then the first of them all.
+        accounts = []
+        more = False
+        primary_ids = cls.partition_primary_ids(partitions)
+        for primary_id, its_partitions in primary_ids.items():
+            if primary_id == cls.machine_id:
+                its_accounts, its_more = cls.list_accounts(
+                    text_wildcard=text_wildcard,
+                    after=after,
+                    limit=limit,
+                    partitions=its_partitions)
+            else:
+                its_accounts, its_more = cls.proxy(
+                    DatabaseOpcode.LIST_ACCOUNTS,
+                    primary_id,
+                    text_wildcard=text_wildcard,
+                    after=after,
+                    limit=limit,
+                    partitions=its_partitions)
+            accounts.extend(its_accounts)
+            more = more or its_more
+        accounts.sort(key=lambda account: account.get_username())
+        return accounts[:limit], more or len(accounts) > limit
+
+    @classmethod
+    def get_account_logged_in(cls,
+                              account: Account,
+                              consistency: str = None):
         """Get whether a particular `account` is logged in according to the db.
         """
-        with cls.machine_lock:
-            if cls.is_primary():
-                username = account.get_username()
+        if cls.read_locally(consistency,
+                            [cls.partition_of(account.get_username())]):
+            username = account.get_username()
+            with cls.shard_lock(username):
                 if username in cls._accounts:
                     return cls._accounts[username].get_logged_in()
-            else:
-                return cls.proxy(DatabaseOpcode.GET_ACCOUNT_LOGGED_IN, 
-                                 account=account)
+        else:
+            return cls.proxy(DatabaseOpcode.GET_ACCOUNT_LOGGED_IN,
+                             cls.primary_id_of(account.get_username()),
+                             account=account)
 
     @classmethod
-    def has_account(cls, account: Account):
+    def has_account(cls, account: Account, consistency: str = None):
         """See whether a particular `account` is in the db.
         """
-        with cls.machine_lock:
-            if cls.is_primary():
-                return account.get_username() in cls._accounts
-            else:
-                return cls.proxy(DatabaseOpcode.HAS_ACCOUNT, 
-                                 account=account)
+        if cls.read_locally(consistency,
+                            [cls.partition_of(account.get_username())]):
+            username = account.get_username()
+            with cls.shard_lock(username):
+                return username in cls._accounts
+        else:
+            return cls.proxy(DatabaseOpcode.HAS_ACCOUNT,
+                             cls.primary_id_of(account.get_username()),
+                             account=account)
 
     @classmethod
     def upsert_message(cls, message: Message):
         """Update or insert a `Message`.
         """
-        with cls.machine_lock:
-            if cls.is_primary():
+        primary_id = cls.primary_id_of(message.get_recipient_username())
+        if primary_id == cls.machine_id:
+            with cls.shard_lock(message.get_recipient_username()):
+                # after this, `message` has its id, so replaying it is
+                # idempotent.
                 cls.local_upsert_message(message)
-                cls.persist_messages()
-                cls.sync_with_replicas()
-            else:
-                return cls.proxy(DatabaseOpcode.UPSERT_MESSAGE, 
-                                 message=message)
+                seq = cls.append_log(
+                    DatabaseRequests.UpsertMessage(the_message=message)
+                    .serialize())
+            cls.wait_for_replicas(seq)
+        else:
+            return cls.proxy(DatabaseOpcode.UPSERT_MESSAGE,
+                             primary_id,
+                             message=message)
+
+    @classmethod
+    def send_messages(cls, messages: List[Message]) -> List[str]:
+        """Store new `Message`s, to any recipients, all at once: the
+            `Message`s to each primary's recipients go to it together, which
+            checks the recipients (and sets their `recipient_logged_in`) in
+            one pass, then logs and replicates the `Message`s as one change
+            (per `Config.LIST_MAX_LEN` of them).
+
+            Returns: the recipients which don't exist (so the `Message`s to
+                     them weren't stored).
+        """
+        n = Config.LIST_MAX_LEN
+        missing = set()
+        primary_ids = cls.group_by_primary(
+            messages,
+            lambda message: message.get_recipient_username())
+        for primary_id, its_messages in primary_ids.items():
+            if primary_id != cls.machine_id:
+                for i in range(0, len(its_messages), n):
+                    missing.update(
+                        cls.proxy(DatabaseOpcode.SEND_MESSAGES,
+                                  primary_id,
+                                  messages=its_messages[i:i + n]))
+                continue
+            usernames = {message.get_recipient_username()
+                         for message in its_messages}
+            seq = None
+            with cls.shard_locks_of(usernames):
+                missing.update(username for username in usernames
+                               if username not in cls._accounts)
+                stored = [message for message in its_messages
+                          if message.get_recipient_username()
+                          in cls._accounts]
+                for message in stored:
+                    message.set_recipient_logged_in(
+                        cls._accounts[message.get_recipient_username()]
+                        .get_logged_in())
+                    cls.local_upsert_message(message)
+                for i in range(0, len(stored), n):
+                    seq = cls.append_log(
+                        DatabaseRequests.SendMessages(
+                            messages=stored[i:i + n])
+                        .serialize())
+            if seq is not None:
+                cls.wait_for_replicas(seq)
+        return sorted(missing)
 
-    # MUST HOLD machine_lock
+    @classmethod
+    def acknowledge_messages(cls, ids: List[int]):
+        """Mark the `Message`s with `ids` delivered, all at once: the ones
+            to each primary's recipients go to it together, which logs and
+            replicates them as one change (per `Config.LIST_MAX_LEN` of
+            them).
+        """
+        n = Config.LIST_MAX_LEN
+        # `dict.get` is atomic, so this needs no shard locks.
+        messages = {message_id: cls._messages_by_id.get(message_id, None)
+                    for message_id in ids}
+        primary_ids = cls.group_by_primary(
+            [message_id for message_id in ids
+             if messages[message_id] is not None],
+            lambda message_id: messages[message_id].get_recipient_username())
+        # the ones not here (yet) go to every primary, which skip the ones
+        # they don't have either.
+        unknown = [message_id for message_id in ids
+                   if messages[message_id] is None]
+        if len(unknown) > 0:
+            for primary_id in cls.partition_primary_ids():
+                primary_ids.setdefault(primary_id, []).extend(unknown)
+        for primary_id, its_ids in primary_ids.items():
+            if primary_id != cls.machine_id:
+                for i in range(0, len(its_ids), n):
+                    cls.proxy(DatabaseOpcode.ACKNOWLEDGE_MESSAGES,
+                              primary_id,
+                              ids=its_ids[i:i + n])
+                continue
+            recipients = cls.recipients_of(its_ids)
+            seq = None
+            with cls.shard_locks_of(recipients):
+                acked = cls.local_acknowledge_messages(its_ids, recipients)
+                for i in range(0, len(acked), n):
+                    seq = cls.append_log(
+                        DatabaseRequests.AcknowledgeMessages(
+                            ids=acked[i:i + n])
+                        .serialize())
+            if seq is not None:
+                cls.wait_for_replicas(seq)
+
+    @classmethod
+    def recipients_of(cls, ids: List[int]) -> Set[str]:
+        """The recipients of the stored `Message`s with `ids` (i.e. whose
+            shard locks are needed to acknowledge them).
+        """
+        # `dict.get` is atomic, and a `Message`'s recipient never changes,
+        # so this needs no shard locks.
+        messages = (cls._messages_by_id.get(message_id, None)
+                    for message_id in ids)
+        return {message.get_recipient_username()
+                for message in messages if message is not None}
+
+    # MUST HOLD the `recipients`' shard locks
+    @classmethod
+    def local_acknowledge_messages(cls,
+                                   ids: List[int],
+                                   recipients: Set[str]) -> List[int]:
+        """Returns: the ids of the `Message`s which weren't delivered yet.
+        """
+        acked = []
+        for message_id in ids:
+            message = cls._messages_by_id.get(message_id, None)
+            if (message is None or message.get_delivered() or
+                    message.get_recipient_username() not in recipients):
+                # (not in `recipients` if it was stored since, so we don't
+                #  hold its lock; but then it's new, so can't be acked.)
+                continue
+            message.set_delivered(True)
+            cls.local_remove_undelivered(message)
+            acked.append(message_id)
+        return acked
+
+    @staticmethod
+    def undelivered_key(message: Message) -> Tuple[int, int]:
+        """What `_undelivered` is sorted by, i.e. `time` then id.
+        """
+        return message.get_time(), message.get_id()
+
+    # MUST HOLD the recipient's shard lock
+    @classmethod
+    def local_remove_undelivered(cls, message: Message):
+        undelivered = cls._undelivered.get(message.get_recipient_username(),
+                                           [])
+        i = bisect.bisect_left(undelivered,
+                               cls.undelivered_key(message),
+                               key=cls.undelivered_key)
+        if i < len(undelivered) and undelivered[i] is message:
+            del undelivered[i]
+
+    # MUST HOLD the recipient's shard lock
     @classmethod
     def local_upsert_message(cls, message: Message):
+        message_id = message.get_id()
+        with cls.log_lock:
+            if not message_id:
+                # a new `Message`, so it gets the next id of its partition's
+                # (so the partitions' primaries don't give out the same ids).
+                message_id = cls._next_message_id
+                message_id += ((cls.partition_of(
+                    message.get_recipient_username()) - message_id) %
+                    Config.PARTITIONS)
+                message.set_id(message_id)
+            cls._next_message_id = max(cls._next_message_id, message_id + 1)
+
         username = message.get_recipient_username()
-        if username not in cls._messages:
-            cls._messages[username] = []
-        messages = cls._messages[username]
-        if message.get_delivered():
-            message.set_delivered(False)
-            idx = None
-            for i, msg in enumerate(messages):
-                if msg == message:
-                    idx = i
-                    break
-            if idx is not None:
-                messages[idx].set_delivered(True)
-            else:
-                message.set_delivered(True)
-                messages.append(message)
-        else:
+        existing = cls._messages_by_id.get(message_id, None)
+        if existing is not None:
+            # the only update is acknowledging it.
+            if message.get_delivered() and not existing.get_delivered():
+                existing.set_delivered(True)
+                cls.local_remove_undelivered(existing)
+            return
+
+        cls._messages_by_id[message_id] = message
+        messages = cls._messages.setdefault(username, [])
+        in_order = (len(messages) == 0 or
+                    messages[-1].get_time() <= message.get_time())
+        if in_order:
             messages.append(message)
-        messages.sort(key=lambda m: m.get_time())
-        cls._messages[username] = messages
+        else:
+            bisect.insort(messages, message, key=lambda m: m.get_time())
+
+        if not message.get_delivered():
+            undelivered = cls._undelivered.setdefault(username, [])
+            if (len(undelivered) == 0 or
+                    cls.undelivered_key(undelivered[-1]) <
+                    cls.undelivered_key(message)):
+                undelivered.append(message)
+            else:
+                bisect.insort(undelivered, message, key=cls.undelivered_key)
+            for callback in cls._subscribers.get(username, []):
+                callback(message)
+            cond = cls._message_conds.get(username, None)
+            if cond is not None:
+                cond.notify_all()
+
+    @classmethod
+    def wait_for_messages(cls,
+                          account: Account,
+                          logged_in: bool,
+                          timeout: float,
+                          after: Tuple[int, int] = (0, 0)) -> bool:
+        """Wait (up to `timeout` seconds) until there are undelivered
+            `Message`s to `account` (after the `(time, id)` `after`, see
+            `get_messages_page`) stored on this machine. Like `subscribe`,
+            this is local (so it doesn't hold up the primary).
+
+            Returns: whether there are any.
+        """
+        username = account.get_username()
+        lock = cls.shard_lock(username)
+
+        def has_messages():
+            undelivered = cls._undelivered.get(username, [])
+            start = bisect.bisect_right(undelivered,
+                                        after,
+                                        key=cls.undelivered_key)
+            return any(not logged_in or msg.get_recipient_logged_in()
+                       for msg in itertools.islice(undelivered, start, None))
+
+        with lock:
+            cond = cls._message_conds.get(username, None)
+            if cond is None:
+                cond = cls._message_conds[username] = Condition(lock)
+            return cond.wait_for(has_messages, timeout=timeout)
+
+    @classmethod
+    def subscribe(cls,
+                  account: Account,
+                  callback: Callable[[Message], None]):
+        """Call `callback` with each new undelivered `Message` to `account`
+            stored on this machine from now on. Every machine stores every
+            `Message` (the primary, then the replicas), so this is local.
+
+            `callback` is called holding a shard lock, so it mustn't block.
+        """
+        username = account.get_username()
+        with cls.shard_lock(username):
+            cls._subscribers.setdefault(username, []).append(callback)
+
+    @classmethod
+    def unsubscribe(cls,
+                    account: Account,
+                    callback: Callable[[Message], None]):
+        username = account.get_username()
+        with cls.shard_lock(username):
+            callbacks = cls._subscribers.get(username, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if len(callbacks) == 0:
+                cls._subscribers.pop(username, None)
+
+    # MUST HOLD the username's shard lock
+    @classmethod
+    def local_delete_messages(cls, username: str):
+        for message in cls._messages.pop(username, []):
+            cls._messages_by_id.pop(message.get_id(), None)
+        cls._undelivered.pop(username, None)
 
+    # MUST HOLD the account's shard lock
+    @classmethod
+    def local_delete_account(cls, account: Account):
+        username = account.get_username()
+        if cls._accounts.pop(username, None) is not None:
+            with cls.usernames_lock:
+                i = bisect.bisect_left(cls._usernames, username)
+                if (i < len(cls._usernames) and
+                        cls._usernames[i] == username):
+                    del cls._usernames[i]
+        cls.local_delete_messages(username)
+
+    # MUST HOLD all_shard_locks
     @classmethod
-    def get_messages(cls, account: Account, logged_in: bool):
+    def local_delete_all(cls):
+        cls._accounts = {}
+        with cls.usernames_lock:
+            cls._usernames = []
+        cls._messages = {}
+        cls._messages_by_id = {}
+        cls._undelivered = {}
+
+    # MUST HOLD all_shard_locks
+    @classmethod
+    def local_delete_partitions(cls, partitions: List[int]):
+        if len(set(partitions)) == Config.PARTITIONS:
+            cls.local_delete_all()
+            return
+        for username in [username for username in cls._accounts
+                         if cls.in_partitions(username, partitions)]:
+            cls.local_delete_account(Account(username=username))
+        for username in [username for username in cls._messages
+                         if cls.in_partitions(username, partitions)]:
+            cls.local_delete_messages(username)
+
+    @classmethod
+    def get_messages(cls,
+                     account: Account,
+                     logged_in: bool,
+                     consistency: str = None):
         """Get the `Message`s sent to the `Account`.
         """
-        with cls.machine_lock:
-            if cls.is_primary():
-                recipient_username = account.get_username()
-                if recipient_username not in cls._messages:
+        if cls.read_locally(consistency,
+                            [cls.partition_of(account.get_username())]):
+            recipient_username = account.get_username()
+            with cls.shard_lock(recipient_username):
+                if recipient_username not in cls._undelivered:
                     return []
-                messages = cls._messages[recipient_username]
+                messages = cls._undelivered[recipient_username]
                 return [msg for msg in messages
-                        if not msg.get_delivered() and
-                        (not logged_in or msg.get_recipient_logged_in())]
-            else:
-                return cls.proxy(DatabaseOpcode.GET_MESSAGES,
-                                 account=account, 
-                                 logged_in=logged_in)
+                        if not logged_in or msg.get_recipient_logged_in()]
+        else:
+            return cls.proxy(DatabaseOpcode.GET_MESSAGES,
+                             cls.primary_id_of(account.get_username()),
+                             account=account,
+                             logged_in=logged_in)
+
+    @classmethod
+    def get_messages_page(cls,
+                          account: Account,
+                          logged_in: bool,
+                          after: Tuple[int, int],
+                          limit: int,
+                          consistency: str = None
+                          ) -> Tuple[List[Message], bool]:
+        """Get (at most) `limit` of the `Message`s sent to the `Account`,
+            in the order of `get_messages` (i.e. by `time` then id), starting
+            after the `(time, id)` `after`.
+
+            Returns: the `Message`s, and whether there are any more after
+                     them.
+        """
+        if cls.read_locally(consistency,
+                            [cls.partition_of(account.get_username())]):
+            recipient_username = account.get_username()
+            messages = []
+            with cls.shard_lock(recipient_username):
+                undelivered = cls._undelivered.get(recipient_username, [])
+                start = bisect.bisect_right(undelivered,
+                                            after,
+                                            key=cls.undelivered_key)
+                for i in range(start, len(undelivered)):
+                    msg = undelivered[i]
+                    if logged_in and not msg.get_recipient_logged_in():
+                        continue
+                    if len(messages) == limit:
+                        return messages, True
+                    messages.append(msg)
+            return messages, False
+        else:
+            return cls.proxy(DatabaseOpcode.GET_MESSAGES_PAGE,
+                             cls.primary_id_of(account.get_username()),
+                             account=account,
+                             logged_in=logged_in,
+                             after=after,
+                             limit=limit)
 
     @classmethod
     def delete_account(cls, account: Account):
         """Delete an `Account`, and all `Message`s to it.
         """
-        with cls.machine_lock:
-            if cls.is_primary():
-                username = account.get_username()
-                cls._accounts.pop(username, None)
-                cls._messages.pop(username, None)
-                cls.persist_accounts()
-                cls.persist_messages()
-                cls.sync_with_replicas()
-                return
-            else:
-                return cls.proxy(DatabaseOpcode.DELETE_ACCOUNT, 
-                                 account=account)
+        primary_id = cls.primary_id_of(account.get_username())
+        if primary_id == cls.machine_id:
+            with cls.shard_lock(account.get_username()):
+                cls.local_delete_account(account)
+                seq = cls.append_log(
+                    DatabaseRequests.DeleteAccount(account=account)
+                    .serialize())
+            cls.wait_for_replicas(seq)
+        else:
+            return cls.proxy(DatabaseOpcode.DELETE_ACCOUNT,
+                             primary_id,
+                             account=account)
 
     @classmethod
-    def delete_all(cls):
-        with cls.machine_lock:
-            if cls.is_primary():
-                cls._accounts = {}
-                cls._messages = {}
-                cls.persist_accounts()
-                cls.persist_messages()
-                cls.sync_with_replicas()
-                return
+    def delete_all(cls, partitions: List[int] = None):
+        """Delete everything (or everything in the `partitions`).
+        """
+        primary_ids = cls.partition_primary_ids(partitions)
+        for primary_id, its_partitions in primary_ids.items():
+            if primary_id == cls.machine_id:
+                with cls.all_shard_locks():
+                    cls.local_delete_partitions(its_partitions)
+                    seq = cls.append_log(
+                        DatabaseRequests.DeleteAll(partitions=its_partitions)
+                        .serialize())
+                cls.wait_for_replicas(seq)
             else:
-                return cls.proxy(DatabaseOpcode.DELETE_ALL)
+                cls.proxy(DatabaseOpcode.DELETE_ALL,
+                          primary_id,
+                          partitions=its_partitions)
@@ -13,9 +13,17 @@ from chat.common.models import (
     LogOutAccountResponse,
     Message,
     SendMessageResponse,
+    SendMessagesResponse,
+    SubscribeMessagesResponse,
 )
 from chat.common.operations import Opcode
+from concurrent.futures import Executor
+from functools import partial
+from typing import List, Tuple
 
+import asyncio
+import queue
+import threading
 import time
 
 
@@ -27,6 +35,10 @@ class Events:
         can call it on-the-nose from gRPC.
     """
 
+    # the threads waiting in `deliver_undelivered_messages`; bounded below
+    # the servers' pools, so the waits can't take up all of the threads.
+    waiting = threading.BoundedSemaphore(Config.DELIVERY_MAX_WAITING)
+
     @staticmethod
     def startup(database=None, machine_id=0, addresses=Config.ADDRESSES):
         database.startup(machine_id=machine_id, addresses=addresses)
@@ -38,7 +50,7 @@ class Events:
         account = (Account()
                    .set_username(username)
                    .set_logged_in(True))
-        if not database.has_account(account):
+        if not database.has_account(account, consistency='primary'):
             return LogInAccountResponse(error='This account does not exist.')
         database.upsert_account(account)
         return LogInAccountResponse(error='')
@@ -50,20 +62,55 @@ class Events:
         account = (Account()
                    .set_username(username)
                    .set_logged_in(True))
-        if database.has_account(account):
+        # on the primary, since it decides the write below.
+        if database.has_account(account, consistency='primary'):
             return CreateAccountResponse(error='This account already exists.')
         database.upsert_account(account)
         return CreateAccountResponse(error='')
 
     @staticmethod
-    def list_accounts(text_wildcard: str, database=None, **kwargs):
-        """Lists all the accounts, subject to some token. Implicitly places
-            a wildcard on both the head and tail.
+    def page_len(limit: int) -> int:
+        """The number of items in a page of at most `limit`; a page always
+            fits in a response, so it's at most `Config.LIST_MAX_LEN`.
+        """
+        if limit is None or limit <= 0:
+            return Config.LIST_MAX_LEN
+        return min(limit, Config.LIST_MAX_LEN)
+
+    @staticmethod
+    def message_cursor(message: Message) -> str:
+        """The cursor of the page after `message` (see
+            `deliver_undelivered_messages`).
+        """
+        return f'{message.get_time()!s}:{message.get_id()!s}'
+
+    @staticmethod
+    def parse_message_cursor(cursor: str) -> Tuple[int, int]:
+        """The `(time, id)` of the last `Message` of the page before the
+            `cursor` (see `Database.get_messages_page`). Raises `ValueError`
+            if it's not a cursor from `message_cursor`.
+        """
+        if not cursor:
+            return (0, 0)
+        message_time, message_id = cursor.split(':')
+        return (int(message_time), int(message_id))
+
+    @staticmethod
+    def list_accounts(text_wildcard: str,
+                      limit: int = 0,
+                      cursor: str = '',
+                      database=None,
+                      **kwargs):
+        """Lists the accounts, subject to some token. Implicitly places
+            a wildcard on both the head and tail. A page of (at most) `limit`
+            at a time, in order of username, starting after the `cursor`.
         """
+        accounts, more = database.list_accounts(text_wildcard=text_wildcard,
+                                                after=cursor or '',
+                                                limit=Events.page_len(limit))
         return ListAccountsResponse(
-            accounts=[account
-                      for _, account in database.get_accounts().items()
-                      if text_wildcard in account.get_username()],
+            accounts=accounts,
+            next_cursor=accounts[-1].get_username() if more else '',
             error='')
 
     @staticmethod
@@ -75,39 +122,239 @@ class Events:
         """Adds a message to the database (i.e. sent from the sender's
             perspective). Sends error if recipient doesn't exist.
         """
-        recipient_account = (Account()
-                             .set_username(recipient_username))
-        if not database.has_account(recipient_account):
-            return SendMessageResponse(
-                error='Recipient account does not exist.')
-        logged_in = database.get_account_logged_in(recipient_account)
         message = (Message()
                    .set_delivered(False)
                    .set_message(message)
-                   .set_recipient_logged_in(logged_in)
                    .set_recipient_username(recipient_username)
                    .set_sender_username(sender_username)
                    .set_time(int(time.time())))
-        database.upsert_message(message)
+        if database.send_messages([message]):
+            return SendMessageResponse(
+                error='Recipient account does not exist.')
         return SendMessageResponse(error='')
 
+    @staticmethod
+    def send_messages(messages: list, database=None, **kwargs):
+        """Adds many messages (to any recipients) to the database at once.
+            Sends error if any recipients don't exist (the messages to the
+            others are still sent).
+        """
+        now = int(time.time())
+        messages = [(Message()
+                     .set_delivered(False)
+                     .set_message(msg.get_message())
+                     .set_recipient_username(msg.get_recipient_username())
+                     .set_sender_username(msg.get_sender_username())
+                     .set_time(now))
+                    for msg in messages]
+        missing = database.send_messages(messages)
+        if missing:
+            return SendMessagesResponse(
+                error=f'Recipient accounts do not exist: '
+                      f'{", ".join(missing)!s}.')
+        return SendMessagesResponse(error='')
+
     @staticmethod
     def deliver_undelivered_messages(logged_in: bool,
                                      username: str,
+                                     max_wait: int = 0,
+                                     ack_ids: list = (),
+                                     limit: int = 0,
+                                     cursor: str = '',
                                      database=None,
                                      **kwargs):
-        """Delivers any undelivered messages to the recipient. Sends error
-            if there aren't any.
+        """Acknowledges the messages with `ack_ids` (i.e. the last ones
+            delivered), then delivers a page of (at most) `limit` undelivered
+            messages to the recipient, starting after the `cursor`. If there
+            aren't any, waits up to `max_wait` ms (at most
+            `Config.DELIVERY_MAX_WAIT`) for some, then sends error if there
+            still aren't any. Only `Config.DELIVERY_MAX_WAITING` threads wait
+            at once; past that, this doesn't wait (the client polls again).
         """
-        messages = []
-        account = database.get_accounts()[username]
-        messages = database.get_messages(account, logged_in)
+        try:
+            after = Events.parse_message_cursor(cursor)
+        except ValueError:
+            return DeliverUndeliveredMessagesResponse(
+                error='Invalid cursor.',
+                messages=[])
+        if ack_ids:
+            database.acknowledge_messages(list(ack_ids))
+        limit = Events.page_len(limit)
+        account = (Account()
+                   .set_username(username))
+        messages, more = database.get_messages_page(account,
+                                                    logged_in,
+                                                    after=after,
+                                                    limit=limit)
+        timeout = Events.delivery_wait(max_wait)
+        if (not messages and timeout > 0 and
+                Events.waiting.acquire(blocking=False)):
+            try:
+                if database.wait_for_messages(account,
+                                              logged_in,
+                                              timeout,
+                                              after=after):
+                    messages, more = database.get_messages_page(
+                        account,
+                        logged_in,
+                        after=after,
+                        limit=limit)
+            finally:
+                Events.waiting.release()
         if not messages:
             return DeliverUndeliveredMessagesResponse(
                 error='No new messages!',
                 messages=[])
-        return DeliverUndeliveredMessagesResponse(error='',
-                                                  messages=messages)
+        return DeliverUndeliveredMessagesResponse(
+            error='',
+            messages=messages,
+            next_cursor=Events.message_cursor(messages[-1]) if more else '')
+
+    @staticmethod
+    async def deliver_undelivered_messages_async(logged_in: bool,
+                                                 username: str,
+                                                 max_wait: int = 0,
+                                                 ack_ids: list = (),
+                                                 executor: Executor = None,
+                                                 database=None,
+                                                 **kwargs):
+        """`deliver_undelivered_messages`, as a coroutine. So rather than
+            holding one of the `executor` threads while it waits, this waits
+            on an `asyncio.Event` set as the `database` stores new messages
+            (and reads the `database` on `executor`).
+        """
+        loop = asyncio.get_running_loop()
+        account = (Account()
+                   .set_username(username))
+        pushed = asyncio.Event()
+
+        def push(message):
+            loop.call_soon_threadsafe(pushed.set)
+
+        deliver = partial(Events.deliver_undelivered_messages,
+                          logged_in=logged_in,
+                          username=username,
+                          database=database,
+                          **kwargs)
+        database.subscribe(account, push)
+        try:
+            response = await loop.run_in_executor(
+                executor,
+                partial(deliver, ack_ids=ack_ids))
+            deadline = loop.time() + Events.delivery_wait(max_wait)
+            while response.get_error() == 'No new messages!':
+                try:
+                    await asyncio.wait_for(pushed.wait(),
+                                           timeout=deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                pushed.clear()
+                response = await loop.run_in_executor(executor, deliver)
+            return response
+        finally:
+            database.unsubscribe(account, push)
+
+    @staticmethod
+    def delivery_wait(max_wait: int) -> float:
+        """The seconds a delivery waits, given the `max_wait` ms requested.
+        """
+        return min((max_wait or 0) / 1000, Config.DELIVERY_MAX_WAIT)
+
+    @staticmethod
+    def subscribe_messages(logged_in: bool,
+                           username: str,
+                           database=None,
+                           **kwargs):
+        """Delivers any undelivered messages to the recipient, then the new
+            ones as they are stored. A generator of
+            `SubscribeMessagesResponse`s, which are empty every
+            `Config.SUBSCRIPTION_HEARTBEAT` if there are no new messages (so
+            a dead connection is noticed).
+        """
+        account = (Account()
+                   .set_username(username))
+        pushed = queue.SimpleQueue()
+        database.subscribe(account, pushed.put)
+        try:
+            messages = database.get_messages(account, logged_in)
+            last_id = 0
+            while True:
+                responses, last_id = Events.push_responses(messages,
+                                                           last_id,
+                                                           logged_in)
+                yield from responses
+                try:
+                    messages = [pushed.get(
+                        timeout=Config.SUBSCRIPTION_HEARTBEAT)]
+                except queue.Empty:
+                    messages = []
+                while not pushed.empty():
+                    messages.append(pushed.get_nowait())
+        finally:
+            database.unsubscribe(account, pushed.put)
+
+    @staticmethod
+    async def subscribe_messages_async(logged_in: bool,
+                                       username: str,
+                                       executor: Executor = None,
+                                       database=None,
+                                       **kwargs):
+        """`subscribe_messages`, as an async generator. So rather than
+            blocking, this waits on an `asyncio.Queue` the `database` puts
+            the new messages on (and reads the `database` on `executor`).
+        """
+        loop = asyncio.get_running_loop()
+        account = (Account()
+                   .set_username(username))
+        pushed = asyncio.Queue()
+
+        def push(message):
+            loop.call_soon_threadsafe(pushed.put_nowait, message)
+
+        database.subscribe(account, push)
+        try:
+            messages = await loop.run_in_executor(
+                executor,
+                partial(database.get_messages, account, logged_in))
+            last_id = 0
+            while True:
+                responses, last_id = Events.push_responses(messages,
+                                                           last_id,
+                                                           logged_in)
+                for response in responses:
+                    yield response
+                try:
+                    messages = [await asyncio.wait_for(
+                        pushed.get(),
+                        timeout=Config.SUBSCRIPTION_HEARTBEAT)]
+                except asyncio.TimeoutError:
+                    messages = []
+                while not pushed.empty():
+                    messages.append(pushed.get_nowait())
+        finally:
+            database.unsubscribe(account, push)
+
+    @staticmethod
+    def push_responses(messages: list,
+                       last_id: int,
+                       logged_in: bool
+                       ) -> Tuple[List[SubscribeMessagesResponse], int]:
+        """The `SubscribeMessagesResponse`s for the `messages` not pushed yet
+            (i.e. with ids after `last_id`, since a recipient's messages are
+            stored in order of id), at most `Config.LIST_MAX_LEN` each.
+
+            Returns: the responses, and the new `last_id`.
+        """
+        messages = [msg for msg in messages
+                    if msg.get_id() > last_id and
+                    (not logged_in or msg.get_recipient_logged_in())]
+        if messages:
+            last_id = max(msg.get_id() for msg in messages)
+        n = Config.LIST_MAX_LEN
+        return ([SubscribeMessagesResponse(error='',
+                                           messages=messages[i:i + n])
+                 for i in range(0, max(1, len(messages)), n)],
+                last_id)
 
     @staticmethod
     def delete_account(username: str, database=None, **kwargs):
@@ -115,7 +362,7 @@ class Events:
         """
         account = (Account()
                    .set_username(username))
-        if database.has_account(account):
+        if database.has_account(account, consistency='primary'):
             database.delete_account(account)
             return DeleteAccountResponse(error='')
         else:
@@ -128,20 +375,18 @@ class Events:
         account = (Account()
                    .set_username(username)
                    .set_logged_in(False))
-        if not database.has_account(account):
+        if not database.has_account(account, consistency='primary'):
             return DeleteAccountResponse(error='This account does not exist.')
         else:
             database.upsert_account(account)
             return LogOutAccountResponse(error='')
 
     @staticmethod
-    def acknowledge_messages(messages: list, database=None, **kwargs):
-        """Acknowledges the receiving of messages, so it's nice and
-            transactional. Won't be marked delivered until now.
+    def acknowledge_messages(ids: list, database=None, **kwargs):
+        """Acknowledges the receiving of messages (by their `ids`), so it's
+            nice and transactional. Won't be marked delivered until now.
         """
-        for message in messages:
-            message.set_delivered(True)
-            database.upsert_message(message)
+        database.acknowledge_messages(list(ids))
         return AcknowledgeMessagesResponse(error='')
 
 
@@ -154,6 +399,8 @@ EventsRouter = {Opcode.LOG_IN_ACCOUNT:
                 Events.list_accounts,
                 Opcode.SEND_MESSAGE:
                 Events.send_message,
+                Opcode.SEND_MESSAGES:
+                Events.send_messages,
                 Opcode.DELIVER_UNDELIVERED_MESSAGES:
                 Events.deliver_undelivered_messages,
                 Opcode.DELETE_ACCOUNT:
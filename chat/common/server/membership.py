@@ -0,0 +1,127 @@
+# membership.py
+# in chat.common.server
+
+from chat.common.cluster import Address, Channel, channel_address
+from chat.common.config import Config
+from threading import RLock, Thread
+from typing import Callable, Dict, List, Set
+
+import socket
+import struct
+import time
+
+
+# the largest heartbeat datagram.
+HEARTBEAT_MAX_LEN = 1 << 10
+
+
+class Membership(object):
+    """Which of the other machines are up, by heartbeats on a channel of their
+        own (UDP, so it never waits on a connection). A machine that stops or
+        hangs is noticed even if nothing is being sent to it, and one that
+        (re)starts is noticed without connecting to it first.
+
+        Every `interval` seconds, this machine sends each of the others a
+        heartbeat: its machine_id, then whatever `beat` returns. A machine is
+        up once it is heard from, and down once it isn't for `timeout`
+        seconds. `on_up` / `on_down` get a machine as it goes up / down, and
+        `on_beat` gets each heartbeat's machine and the rest of it. They are
+        called one at a time, and mustn't block.
+    """
+
+    def __init__(self,
+                 machine_id: int,
+                 addresses: List[Address],
+                 beat: Callable[[], bytes],
+                 on_beat: Callable[[int, bytes], None],
+                 on_up: Callable[[int], None],
+                 on_down: Callable[[int], None],
+                 interval: float = Config.HEARTBEAT_INTERVAL,
+                 timeout: float = Config.HEARTBEAT_TIMEOUT):
+        self.machine_id = machine_id
+        self.addresses = [channel_address(address, Channel.HEARTBEAT)
+                          for address in addresses]
+        self.beat = beat
+        self.on_beat = on_beat
+        self.on_up = on_up
+        self.on_down = on_down
+        self.interval = interval
+        self.timeout = timeout
+        self.closed = False
+        # key is machine_id; when (by `time.monotonic`) it was last heard.
+        self.heard_at: Dict[int, float] = {}
+        self.up: Set[int] = set()
+        # guards `heard_at` and `up`, and held for the callbacks (so they
+        # are called one at a time, in order).
+        self.lock = RLock()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(self.addresses[machine_id])
+
+    def start(self):
+        Thread(target=self._send, daemon=True).start()
+        Thread(target=self._receive, daemon=True).start()
+
+    def close(self):
+        self.closed = True
+        self.socket.close()
+
+    def is_up(self, other_machine_id: int) -> bool:
+        with self.lock:
+            return other_machine_id in self.up
+
+    def suspect(self, other_machine_id: int):
+        """Count a machine as down (e.g. its connection broke) without
+            calling `on_down`, so it's up again (calling `on_up`) once it's
+            heard from again.
+        """
+        with self.lock:
+            self.up.discard(other_machine_id)
+
+    def _send(self):
+        while not self.closed:
+            try:
+                heartbeat = (int.to_bytes(self.machine_id,
+                                          1,
+                                          byteorder='little') +
+                             self.beat())
+                for i, address in enumerate(self.addresses):
+                    if i != self.machine_id:
+                        self.socket.sendto(heartbeat, address)
+            except OSError:
+                # e.g. no route to it right now; it's just not heard from.
+                pass
+            now = time.monotonic()
+            with self.lock:
+                for i in sorted(self.up):
+                    if now - self.heard_at.get(i, 0) > self.timeout:
+                        self.up.discard(i)
+                        try:
+                            self.on_down(i)
+                        except OSError:
+                            # e.g. closing its connections failed.
+                            pass
+            time.sleep(self.interval)
+
+    def _receive(self):
+        while not self.closed:
+            try:
+                data, _ = self.socket.recvfrom(HEARTBEAT_MAX_LEN)
+            except OSError:
+                # e.g. closed, or a heartbeat we sent was refused.
+                continue
+            if len(data) == 0:
+                continue
+            other_machine_id = data[0]
+            if (other_machine_id == self.machine_id or
+                    other_machine_id >= len(self.addresses)):
+                continue
+            with self.lock:
+                self.heard_at[other_machine_id] = time.monotonic()
+                try:
+                    if other_machine_id not in self.up:
+                        self.up.add(other_machine_id)
+                        self.on_up(other_machine_id)
+                    self.on_beat(other_machine_id, data[1:])
+                except (OSError, ValueError, struct.error):
+                    # e.g. a heartbeat that can't be read.
+                    pass
@@ -0,0 +1,164 @@
+# proxy.py
+# in chat.common.server
+
+from chat.common.config import Config
+from chat.common.framing import FramedSocket
+from chat.common.serialization import SerializationUtils
+from concurrent.futures import Executor, Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from threading import Lock, Thread
+from typing import Callable, Dict, Tuple
+
+import itertools
+import socket
+
+
+# the number of bytes at the start of a proxied request / response's frame,
+# encoding its request id.
+REQUEST_ID_BITS = 4
+# the byte after a proxied response's request id: whether the rest is the
+# response, or the error handling its request raised.
+RESPONSE_OK = b'\x00'
+RESPONSE_ERROR = b'\x01'
+
+
+def serialize_request_id(request_id: int) -> bytes:
+    return SerializationUtils.serialize_int(request_id,
+                                            length=REQUEST_ID_BITS)
+
+
+def split_request_id(frame: bytes) -> Tuple[int, bytes]:
+    """Split a proxied request / response's frame into its request id and
+        the serialized request / response.
+    """
+    request_id = SerializationUtils.deserialize_int(frame[:REQUEST_ID_BITS],
+                                                    length=REQUEST_ID_BITS)
+    return request_id, frame[REQUEST_ID_BITS:]
+
+
+class ProxyConnection(object):
+    """A connection to another machine's queue socket, which any number of
+        threads can proxy requests over at once.
+
+        Each request is sent in a frame after a request id of its own, and
+        its response comes back after the same id, so the responses can come
+        back in any order. A thread of its own receives them, and hands each
+        to the caller waiting on its id.
+    """
+
+    def __init__(self, s: FramedSocket):
+        self.socket = s
+        self.closed = False
+        # held for a whole frame sent on `socket`.
+        self._send_lock = Lock()
+        # key is request id; the callers waiting on a response.
+        self._pending: Dict[int, Future] = {}
+        # guards `closed` and `_pending`.
+        self._pending_lock = Lock()
+        self._request_ids = itertools.count()
+        Thread(target=self._receive, daemon=True).start()
+
+    def request(self,
+                data: bytes,
+                timeout: float = Config.TIMEOUT_PROXY) -> bytes:
+        """Send a (serialized) request, and wait (up to `timeout` seconds)
+            for its (serialized) response.
+
+            Raises: `ConnectionError` if the connection is (or gets) closed,
+                    `TimeoutError` if there is no response in time, or
+                    `RuntimeError` if handling it on the other side failed.
+        """
+        request_id = (next(self._request_ids) %
+                      (1 << (8 * REQUEST_ID_BITS)))
+        future = Future()
+        with self._pending_lock:
+            if self.closed:
+                raise ConnectionError('Connection closed.')
+            self._pending[request_id] = future
+        try:
+            with self._send_lock:
+                self.socket.send_frame(serialize_request_id(request_id) +
+                                       data)
+            try:
+                return future.result(timeout)
+            except FutureTimeoutError:
+                # the same as `TimeoutError` only as of Python 3.11.
+                raise TimeoutError('No response in time.')
+        finally:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+
+    def _receive(self):
+        try:
+            while True:
+                frame = self.socket.recv_frame()
+                if frame is None:
+                    # This is a signal of disconnect.
+                    break
+                request_id, response = split_request_id(frame)
+                with self._pending_lock:
+                    future = self._pending.pop(request_id, None)
+                # `None` if it's a response to a request that timed out.
+                if future is None:
+                    continue
+                if response[:1] == RESPONSE_ERROR:
+                    error = response[1:].decode('utf-8', errors='replace')
+                    future.set_exception(
+                        RuntimeError(f'Proxied request failed: {error!s}'))
+                else:
+                    future.set_result(response[1:])
+        except (OSError, ValueError):
+            # disconnected, or sent a frame that's too long.
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        """Close the connection, failing the requests waiting on it.
+        """
+        with self._pending_lock:
+            self.closed = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future in pending:
+            future.set_exception(ConnectionError('Disconnected.'))
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+def serve_proxy_connection(connection: FramedSocket,
+                           handle: Callable[[bytes], bytes],
+                           executor: Executor):
+    """Receive the requests on `connection` (from a `ProxyConnection`),
+        handling each with `handle` on `executor` (so a slow request doesn't
+        hold up the others), and send back each response after the request
+        id of its request. If `handle` raises, just that request gets the
+        error back (see `ProxyConnection.request`). Returns once the other
+        side disconnects.
+    """
+    send_lock = Lock()
+
+    def respond(request_id: int, request: bytes):
+        try:
+            response = RESPONSE_OK + handle(request)
+        except Exception as e:
+            # the other requests on the connection carry on regardless.
+            response = (RESPONSE_ERROR +
+                        repr(e)[:Config.STR_MAX_LEN].encode('utf-8'))
+        try:
+            with send_lock:
+                connection.send_frame(serialize_request_id(request_id) +
+                                      response)
+        except OSError:
+            # disconnected, so `recv_frame` returns too.
+            pass
+
+    while True:
+        frame = connection.recv_frame()
+        if frame is None:
+            # This is a signal of disconnect.
+            return
+        executor.submit(respond, *split_request_id(frame))
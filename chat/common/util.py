@@ -3,9 +3,14 @@
 
 import builtins
 
-from chat.common.serialization import SerializationUtils
+from chat.common.codegen import generate_codecs, generate_grpc_converters
+from chat.common.serialization import (
+    BOOL_FORMAT,
+    INT_FORMAT,
+    SerializationUtils,
+)
 from enum import Enum, EnumMeta
-from typing import Callable, Dict, List, Optional, Type
+from typing import Callable, Dict, List, Optional, Tuple, Type
 
 
 class Interface(object):
@@ -22,8 +27,14 @@ class Interface(object):
 class Model(object):
     """The abstract "models" created from `interface`s.
        Useful for making new models, or (de)serializing.
+
+       The fields are stored in `__slots__` (see `model_with_fields`), so
+       subclasses of a model should also declare `__slots__ = ()` to keep
+       their instances without a `__dict__`.
     """
 
+    __slots__ = ()
+
     # the fields and their types
     _fields: Dict[str, type] = {}
 
@@ -33,6 +44,15 @@ class Model(object):
     # the fields and their deserializers
     _field_deserializers: Dict[str, Callable] = {}
 
+    # the fields and their decoders (the cursor version of deserializers, see
+    # `SerializationUtils`). `None` if it only has a deserializer.
+    _field_decoders: Dict[str, Optional[Callable]] = {}
+
+    # the fields which are fixed-width, and their `struct` formats (see
+    # `serialization.int_format`); these take precedence over the
+    # (de)serializers in the generated codecs (see `codegen`).
+    _field_formats: Dict[str, str] = {}
+
     # the fields and their serializers
     _field_serializers: Dict[str, Callable] = {}
 
@@ -44,12 +64,18 @@ class Model(object):
     # the order to (de)serialize fields in.
     _order_of_fields: List[str] = {}
 
+    # key is a `grpcio.Message` subclass; the generated conversions to and
+    # from it (see `grpc_converters`).
+    _grpc_converters: Dict[type, Tuple[Callable, Callable]] = {}
+
     # TODO: is this necessary? I think not necessarily, but will
     # be at a minimum useful for awkard class attributes sharing object
     # attributes names, so best to just discourage it entirely.
     _reserved_fields = ['fields',
                         'field_defaults'
                         'field_deserializers',
+                        'field_decoders',
+                        'field_formats',
                         'field_serializers',
                         'order_of_fields',
                         'fields_list_nested',
@@ -88,6 +114,38 @@ class Model(object):
                     return t.deserialize
                 return None
 
+    @staticmethod
+    def default_decoder(t: Type) -> Optional[Callable]:
+        """The default decoding function for a type. `None` if not
+            explicit.
+        """
+        match t:
+            case builtins.bool:
+                return SerializationUtils.decode_bool
+            case builtins.int:
+                return SerializationUtils.decode_int
+            case builtins.str:
+                return SerializationUtils.decode_str
+            case _:
+                if t is None:
+                    return None
+                if issubclass(t, Model):
+                    return t.decode
+                return None
+
+    @staticmethod
+    def default_format(t: Type) -> Optional[str]:
+        """The default `struct` format for a type. `None` if it is not
+            fixed-width.
+        """
+        match t:
+            case builtins.bool:
+                return BOOL_FORMAT
+            case builtins.int:
+                return INT_FORMAT
+            case _:
+                return None
+
     @staticmethod
     def default_serializer(t: Type) -> Optional[Callable]:
         """The default serializing function for a type. `None` if not
@@ -110,26 +168,36 @@ class Model(object):
     @staticmethod
     def default_list_deserializer(t: Type) -> Callable:
         """The default list deserializer if we can deduce the items'
-            default deserializers (via `default_deserializer`).
+            default decoders (via `default_decoder`).
         """
-        return (lambda d: SerializationUtils.deserialize_list(
-                    d,
-                    Model.default_deserializer(t),
-                    Model.default_serializer(t)))
+        decode = Model.default_list_decoder(t)
+        return (lambda d: decode(memoryview(d), 0)[0])
+
+    @staticmethod
+    def default_list_decoder(t: Type) -> Callable:
+        """The default list decoder if we can deduce the items'
+            default decoders (via `default_decoder`).
+        """
+        item_decode = Model.default_decoder(t)
+        return (lambda d, o: SerializationUtils.decode_list(d,
+                                                            o,
+                                                            item_decode))
 
     @staticmethod
     def default_list_serializer(t: Type) -> Callable:
         """The default list serializer if we can deduce the items'
             default serializers (via `default_serializer`).
         """
-        return (lambda v: SerializationUtils.serialize_list(
-                    v,
-                    Model.default_serializer(t)))
+        item_serialize = Model.default_serializer(t)
+        return (lambda v: SerializationUtils.serialize_list(v,
+                                                            item_serialize))
 
     @classmethod
-    def deserialize(cls, data: bytes):
-        """Deserialize a `Model` according to its `order_of_fields` and
-            `field_deserializers`.
+    def decode(cls, data: memoryview, offset: int = 0):
+        """Decode a `Model` at `offset` according to its `order_of_fields` and
+            `field_decoders` (falling back to `field_deserializers`).
+
+            Returns: the `Model` and the offset just past it.
 
             Can cause some headaches on optional arguments, so assume there
             are no `None` values.
@@ -139,18 +207,23 @@ class Model(object):
         # on lists (of max len 1).
         obj = cls()
         for name in cls._order_of_fields:
-            deserializer = cls._field_deserializers[name]
-            serializer = cls._field_serializers[name]
+            decoder = cls._field_decoders.get(name, None)
+            if decoder is None:
+                decoder = SerializationUtils.as_decoder(
+                    cls._field_deserializers[name],
+                    cls._field_serializers[name])
 
-            field_val = deserializer(data)
-            length = len(serializer(field_val))
+            field_val, offset = decoder(data, offset)
 
             getattr(obj, f'set_{name!s}', lambda _: obj)(field_val)
-            try:
-                data = data[length:]
-            except Exception:
-                break
-        return obj
+        return obj, offset
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        """Deserialize a `Model` according to its `order_of_fields` and
+            `field_decoders` (see `decode`).
+        """
+        return cls.decode(memoryview(data))[0]
 
     def serialize(self) -> bytes:
         """Serialize a `Model` according to its `order_of_fields` and
@@ -165,22 +238,31 @@ class Model(object):
                                                               None)())
                         for name in self._order_of_fields)
 
+    @classmethod
+    def grpc_converters(model,
+                        grpc_model: type) -> Tuple[Callable, Callable]:
+        """The conversions to and from the `grpcio.Message` subclass
+            `grpc_model`, generated the first time they're needed (see
+            `codegen.generate_grpc_converters`).
+        """
+        converters = model._grpc_converters.get(grpc_model, None)
+        if converters is None:
+            converters = generate_grpc_converters(model, grpc_model)
+            model._grpc_converters[grpc_model] = converters
+        return converters
+
     @classmethod
     def from_grpc_model(model, grpc_obj):
-        """Take a `grpcio.Message` subclass instance, and see if we have
-            matching fields, and grab them if so. Nothing fancy.
+        """Take a `grpcio.Message` subclass instance, and grab the fields we
+            have in common (the others get their defaults).
         """
-        obj = model()
-        for name, t in model._fields.items():
-            val = getattr(grpc_obj, name, None)
-            if t is list:
-                nested_model = model._fields_list_nested.get(name, None)
-                if nested_model:
-                    val = [nested_model.from_grpc_model(v)
-                           for v in val or []]
-
-            getattr(obj, f'set_{name!s}', lambda _: obj)(val)
-        return obj
+        return model.grpc_converters(type(grpc_obj))[1](model, grpc_obj)
+
+    def to_grpc_model(self, grpc_model: type):
+        """Create a `grpc_model` (a `grpcio.Message` subclass) instance from
+            this instance, with the fields we have in common.
+        """
+        return type(self).grpc_converters(grpc_model)[0](self)
 
     def as_model(self, model: Type):
         """Create a new `model` instance from this instance, by copying the
@@ -198,8 +280,15 @@ class Model(object):
                           field_serializers: Dict[str, Callable] = {},
                           order_of_fields: List[str] = None,
                           fields_list_nested: Dict[str, type] = {},
+                          field_decoders: Dict[str, Callable] = {},
+                          field_formats: Dict[str, str] = {},
                           **fields: Dict[str, type]) -> type:
         """Create a new `Model` subclass with the given class attributes.
+
+            A field with an explicit deserializer but no explicit decoder
+            falls back to its deserializer (see `SerializationUtils
+            .as_decoder`), and a field with an explicit (de)serializer is
+            only fixed-width if it has an explicit format.
         """
 
         for name in fields:
@@ -209,8 +298,28 @@ class Model(object):
         # this gives the explicit order, or just uses the keys.
         order = order_of_fields or list(fields.keys())
 
+        # don't modify the callers' (or worse, the default) `dict`s.
+        field_deserializers = dict(field_deserializers)
+        field_serializers = dict(field_serializers)
+        field_decoders = dict(field_decoders)
+        field_formats = dict(field_formats)
+
         # set default (de)serializers, if not set
         for name, t in fields.items():
+            fmt = field_formats.get(
+                name,
+                None
+                if name in field_deserializers or name in field_serializers
+                else Model.default_format(t))
+            decode = field_decoders.get(
+                name,
+                None
+                if name in field_deserializers else
+                (Model.default_list_decoder(
+                    fields_list_nested.get(name, None))
+                 if name in fields_list_nested else None)
+                if t is list else
+                Model.default_decoder(t))
             deserialize = field_deserializers.get(
                 name,
                 (Model.default_list_deserializer(
@@ -235,8 +344,14 @@ class Model(object):
 
             field_deserializers[name] = deserialize
             field_serializers[name] = serialize
+            field_decoders[name] = decode
+            if fmt is not None:
+                field_formats[name] = fmt
 
         class __impl_model__(Model):
+            # the private attributes of the fields (see `add_getters_setters`)
+            __slots__ = tuple(f'_{name!s}' for name in fields)
+
             # copy is likely safest here...
             _fields = {k: v for k, v in fields.items()}
 
@@ -245,12 +360,18 @@ class Model(object):
             _field_deserializers = {k: v
                                     for k, v in field_deserializers.items()}
 
+            _field_decoders = {k: v for k, v in field_decoders.items()}
+
+            _field_formats = {k: v for k, v in field_formats.items()}
+
             _field_serializers = {k: v for k, v in field_serializers.items()}
 
             _order_of_fields = order
 
             _fields_list_nested = {k: v for k, v in fields_list_nested.items()}
 
+            _grpc_converters = {}
+
         return __impl_model__.add_getters_setters()
 
     @classmethod
@@ -305,7 +426,7 @@ class Model(object):
 
         setattr(model, '__init__', __impl_init__)
 
-        return model.clean_getters_setters()
+        return model.clean_getters_setters().add_codecs()
 
     @classmethod
     def clean_getters_setters(model):
@@ -324,6 +445,16 @@ class Model(object):
                 model._order_of_fields.append(name)
         return model
 
+    @classmethod
+    def add_codecs(model):
+        """Replace `serialize` and `decode` with ones generated for exactly
+            the fields in the model (see `codegen.generate_codecs`).
+        """
+        serialize, decode = generate_codecs(model)
+        setattr(model, 'serialize', serialize)
+        setattr(model, 'decode', classmethod(decode))
+        return model
+
     @classmethod
     def add_fields(cls,
                    field_defaults: Dict[str, object] = {},
@@ -331,6 +462,8 @@ class Model(object):
                    field_serializers: Dict[str, Callable] = {},
                    order_of_fields: List[str] = None,
                    fields_list_nested: Dict[str, type] = {},
+                   field_decoders: Dict[str, Callable] = {},
+                   field_formats: Dict[str, str] = {},
                    **new_fields: Dict[str, type]) -> type:
         """The same as `model_with_fields`, but using the initial state
             of whatever `Model` subclass it's called from, adding on.
@@ -342,6 +475,15 @@ class Model(object):
                                      list(field_deserializers.items())),
             field_serializers=dict(list(cls._field_serializers.items()) +
                                    list(field_serializers.items())),
+            field_decoders=dict([(k, v)
+                                 for k, v in cls._field_decoders.items()
+                                 if k not in field_deserializers] +
+                                list(field_decoders.items())),
+            field_formats=dict([(k, v)
+                                for k, v in cls._field_formats.items()
+                                if k not in field_deserializers and
+                                k not in field_serializers] +
+                               list(field_formats.items())),
             fields_list_nested=dict(list(cls._fields_list_nested.items()) +
                                     list(fields_list_nested.items())),
             order_of_fields=order_of_fields,
@@ -355,6 +497,8 @@ class Model(object):
                     field_serializers: Dict[str, Callable] = {},
                     order_of_fields: List[str] = None,
                     fields_list_nested: Dict[str, type] = {},
+                    field_decoders: Dict[str, Callable] = {},
+                    field_formats: Dict[str, str] = {},
                     **rm_fields: Dict[str, type]) -> type:
         """The same as `model_with_fields`, but using the initial state
             of whatever `Model` subclass it's called from, removing from.
@@ -370,6 +514,15 @@ class Model(object):
                                      list(field_deserializers.items())),
             field_serializers=dict(list(cls._field_serializers.items()) +
                                    list(field_serializers.items())),
+            field_decoders=dict([(k, v)
+                                 for k, v in cls._field_decoders.items()
+                                 if k not in field_deserializers] +
+                                list(field_decoders.items())),
+            field_formats=dict([(k, v)
+                                for k, v in cls._field_formats.items()
+                                if k not in field_deserializers and
+                                k not in field_serializers] +
+                               list(field_formats.items())),
             order_of_fields=order_of_fields,
             fields_list_nested=dict(list(cls._fields_list_nested.items()) +
                                     list(fields_list_nested.items())),
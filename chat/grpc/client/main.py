@@ -14,101 +14,221 @@ from chat.common.models import (
     LogInAccountResponse,
     LogOutAccountResponse,
     SendMessageResponse,
+    SendMessagesRequest,
+    SendMessagesResponse,
+    SubscribeMessagesResponse,
 )
 from chat.common.operations import Opcode
-from typing import Optional
+from typing import Dict, Iterator, Optional, Tuple
 
 import grpc
+import itertools
 import chat.grpc.grpcio.proto_pb2 as proto_pb2
 import chat.grpc.grpcio.proto_pb2_grpc as proto_pb2_grpc
 
 
+# the options of every channel, so an idle channel is kept alive (and a dead
+# one is noticed) rather than having to reconnect on the next request.
+CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', Config.GRPC_KEEPALIVE_TIME * 1000),
+    ('grpc.keepalive_timeout_ms', Config.GRPC_KEEPALIVE_TIMEOUT * 1000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+]
+
+
+class ChannelPool(object):
+    """A fixed number of channels to one server, each with its one stub,
+        which are handed out round-robin. So many users (e.g. of a load
+        generator or bot) can be multiplexed over a few connections, without
+        making a stub per request.
+
+        With `aio`, the channels and stubs are `grpc.aio` ones (so their
+        calls are awaited, see `request_async`).
+    """
+
+    def __init__(self,
+                 target: str,
+                 size: int = Config.GRPC_CHANNELS,
+                 aio: bool = False):
+        channel_module = grpc.aio if aio else grpc
+        self.channels = [channel_module.insecure_channel(
+                             target,
+                             options=CHANNEL_OPTIONS)
+                         for _ in range(size)]
+        self.stubs = [proto_pb2_grpc.ChatStub(channel)
+                      for channel in self.channels]
+        self._stubs = itertools.cycle(self.stubs)
+
+    def stub(self) -> proto_pb2_grpc.ChatStub:
+        """The next stub to use.
+        """
+        return next(self._stubs)
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+
+    async def close_async(self):
+        for channel in self.channels:
+            await channel.close()
+
+
+# key is the channel; so a channel without a pool still only gets one stub.
+_stubs: Dict[grpc.Channel, proto_pb2_grpc.ChatStub] = {}
+
+
+def stub_of(channel: grpc.Channel) -> proto_pb2_grpc.ChatStub:
+    """The stub of a `channel`, made the first time it's needed.
+    """
+    stub = _stubs.get(channel, None)
+    if stub is None:
+        stub = _stubs[channel] = proto_pb2_grpc.ChatStub(channel)
+    return stub
+
+
 def entry(host=Config.ADDRESSES[0][0], port=Config.ADDRESSES[0][1], **kwargs):
     """Establish a connection to the server.
     """
-    channel = grpc.insecure_channel(f'{host!s}:{port!s}')
-    kwargs['channel'] = channel
+    pool = ChannelPool(f'{host!s}:{port!s}')
+    kwargs['pool'] = pool
+    kwargs['channel'] = pool.channels[0]
     return kwargs
 
 
-def request(opcode: Opcode,
-            channel: grpc.Channel = None,
-            username: Optional[str] = None,
-            text_wildcard: Optional[str] = None,
-            message: Optional[str] = None,
-            recipient_username: Optional[str] = None,
-            sender_username: Optional[str] = None,
-            logged_in: Optional[bool] = None,
-            messages: Optional[list] = None,
-            **kwargs):
-    """Send a request to the server.
+async def entry_async(host=Config.ADDRESSES[0][0],
+                      port=Config.ADDRESSES[0][1],
+                      **kwargs):
+    """`entry`, but with `grpc.aio` channels (for `request_async`).
     """
-    stub = proto_pb2_grpc.ChatStub(channel)
+    kwargs['pool'] = ChannelPool(f'{host!s}:{port!s}', aio=True)
+    return kwargs
+
+
+def prepare_request(opcode: Opcode,
+                    username: Optional[str] = None,
+                    text_wildcard: Optional[str] = None,
+                    message: Optional[str] = None,
+                    recipient_username: Optional[str] = None,
+                    sender_username: Optional[str] = None,
+                    logged_in: Optional[bool] = None,
+                    messages: Optional[list] = None,
+                    max_wait: Optional[int] = None,
+                    ack_ids: Optional[list] = None,
+                    limit: Optional[int] = None,
+                    cursor: Optional[str] = None,
+                    **kwargs) -> Tuple[str, object, type]:
+    """The parts of a request to the server which don't depend on the stub.
 
+        Returns: the name of the stub's method, its request, and the model
+                 of its response.
+    """
     match opcode:
         case Opcode.LOG_IN_ACCOUNT:
             req = proto_pb2.LogInAccountRequest(username=username)
-            res = stub.LogInAccount(req)
-            response = LogInAccountResponse.from_grpc_model(res)
+            return 'LogInAccount', req, LogInAccountResponse
         case Opcode.CREATE_ACCOUNT:
             req = proto_pb2.CreateAccountRequest(username=username)
-            res = stub.CreateAccount(req)
-            response = CreateAccountResponse.from_grpc_model(res)
+            return 'CreateAccount', req, CreateAccountResponse
         case Opcode.LIST_ACCOUNTS:
-            req = proto_pb2.ListAccountsRequest(text_wildcard=text_wildcard)
-            res = stub.ListAccounts(req)
-            response = ListAccountsResponse.from_grpc_model(res)
+            req = proto_pb2.ListAccountsRequest(text_wildcard=text_wildcard,
+                                                limit=limit or 0,
+                                                cursor=cursor or '')
+            return 'ListAccounts', req, ListAccountsResponse
         case Opcode.SEND_MESSAGE:
             req = proto_pb2.SendMessageRequest(
                 message=message,
                 recipient_username=recipient_username,
                 sender_username=sender_username)
-            res = stub.SendMessage(req)
-            response = SendMessageResponse.from_grpc_model(res)
+            return 'SendMessage', req, SendMessageResponse
+        case Opcode.SEND_MESSAGES:
+            req = (SendMessagesRequest(messages=messages)
+                   .to_grpc_model(proto_pb2.SendMessagesRequest))
+            return 'SendMessages', req, SendMessagesResponse
         case Opcode.DELIVER_UNDELIVERED_MESSAGES:
             req = proto_pb2.DeliverUndeliveredMessagesRequest(
                 logged_in=logged_in,
-                username=username)
-            res = stub.DeliverUndeliveredMessages(req)
-            response = DeliverUndeliveredMessagesResponse.from_grpc_model(res)
+                username=username,
+                max_wait=max_wait or 0,
+                ack_ids=ack_ids or (),
+                limit=limit or 0,
+                cursor=cursor or '')
+            return ('DeliverUndeliveredMessages',
+                    req,
+                    DeliverUndeliveredMessagesResponse)
         case Opcode.DELETE_ACCOUNT:
             req = proto_pb2.DeleteAccountRequest(
                 username=username)
-            res = stub.DeleteAccount(req)
-            response = DeleteAccountResponse.from_grpc_model(res)
+            return 'DeleteAccount', req, DeleteAccountResponse
         case Opcode.LOG_OUT_ACCOUNT:
             req = proto_pb2.LogOutAccountRequest(
                 username=username)
-            res = stub.LogOutAccount(req)
-            response = LogOutAccountResponse.from_grpc_model(res)
+            return 'LogOutAccount', req, LogOutAccountResponse
         case Opcode.ACKNOWLEDGE_MESSAGES:
-            req = proto_pb2.AcknowledgeMessagesRequest(
-                messages=[proto_pb2.Message(
-                              message=message
-                              .get_message(),
-                              recipient_logged_in=message
-                              .get_recipient_logged_in(),
-                              recipient_username=message
-                              .get_recipient_username(),
-                              sender_username=message
-                              .get_sender_username(),
-                              time=message
-                              .get_time(),
-                              delivered=message
-                              .get_delivered())
-                          for message in messages])
-            res = stub.AcknowledgeMessages(req)
-            response = AcknowledgeMessagesResponse.from_grpc_model(res)
-
-    return response
+            req = proto_pb2.AcknowledgeMessagesRequest(ids=ack_ids or ())
+            return 'AcknowledgeMessages', req, AcknowledgeMessagesResponse
+
+
+def request(opcode: Opcode,
+            pool: Optional[ChannelPool] = None,
+            channel: Optional[grpc.Channel] = None,
+            **kwargs):
+    """Send a request to the server, on the next stub of the `pool` (or, if
+        there isn't one, the `channel`'s).
+    """
+    stub = pool.stub() if pool is not None else stub_of(channel)
+    method, req, model = prepare_request(opcode, **kwargs)
+    return model.from_grpc_model(getattr(stub, method)(req))
+
+
+async def request_async(opcode: Opcode,
+                        pool: ChannelPool = None,
+                        **kwargs):
+    """`request`, on a `grpc.aio` `pool` (see `entry_async`).
+    """
+    method, req, model = prepare_request(opcode, **kwargs)
+    return model.from_grpc_model(await getattr(pool.stub(), method)(req))
+
+
+class Subscription(object):
+    """The `SubscribeMessagesResponse`s streamed by the server.
+    """
+
+    def __init__(self, stub: proto_pb2_grpc.ChatStub, username: str):
+        self.stream = stub.SubscribeMessages(
+            proto_pb2.SubscribeMessagesRequest(logged_in=True,
+                                               username=username))
+
+    def __iter__(self) -> Iterator[SubscribeMessagesResponse]:
+        for res in self.stream:
+            yield SubscribeMessagesResponse.from_grpc_model(res)
+
+    def cancel(self):
+        """Stop the subscription.
+        """
+        self.stream.cancel()
+
+
+def subscribe(username: str,
+              pool: Optional[ChannelPool] = None,
+              channel: Optional[grpc.Channel] = None,
+              **kwargs) -> Subscription:
+    """Subscribe to the new messages for `username`.
+    """
+    stub = pool.stub() if pool is not None else stub_of(channel)
+    return Subscription(stub, username)
 
 
 def handler(err: Exception,
+            pool: Optional[ChannelPool] = None,
             channel: Optional[grpc.Channel] = None,
             **kwargs):
-    """Handle errors (i.e. close the channel).
+    """Handle errors (i.e. close the channels).
     """
-    if channel is not None:
+    if pool is not None:
+        pool.close()
+    elif channel is not None:
+        _stubs.pop(channel, None)
         channel.close()
 
 
@@ -122,6 +242,7 @@ def main(addresses: list = Config.ADDRESSES,
         shiny_client_main(entry=entry,
                           request=request,
                           handler=handler,
+                          subscribe=subscribe,
                           machine_id=machine_id,
                           addresses=addresses,
                           **kwargs)
@@ -129,6 +250,7 @@ def main(addresses: list = Config.ADDRESSES,
         client_main(entry=entry,
                     request=request,
                     handler=handler,
+                    subscribe=subscribe,
                     machine_id=machine_id,
                     addresses=addresses,
                     **kwargs)
@@ -2,12 +2,16 @@
 # in chat.grpc.server
 
 from chat.common.args import parse_server_args as parse_args
+from chat.common.cluster import Channel, channel_address
 from chat.common.config import Config
-from chat.common.models import Message
+from chat.common.models import SendMessagesRequest
 from chat.common.server.database import Database
 from chat.common.server.events import Events
 from concurrent import futures
+from concurrent.futures import Executor
+from typing import List, Tuple
 
+import asyncio
 import grpc
 import chat.grpc.grpcio.proto_pb2 as proto_pb2
 import chat.grpc.grpcio.proto_pb2_grpc as proto_pb2_grpc
@@ -26,21 +30,19 @@ class ChatServicer(proto_pb2_grpc.ChatServicer):
     def LogInAccount(self, request, context):
         response = Events.log_in_account(username=request.username,
                                          database=self.database)
-        return proto_pb2.LogInAccountResponse(error=response.get_error())
+        return response.to_grpc_model(proto_pb2.LogInAccountResponse)
 
     def CreateAccount(self, request, context):
         response = Events.create_account(username=request.username,
                                          database=self.database)
-        return proto_pb2.CreateAccountResponse(error=response.get_error())
+        return response.to_grpc_model(proto_pb2.CreateAccountResponse)
 
     def ListAccounts(self, request, context):
         response = Events.list_accounts(text_wildcard=request.text_wildcard,
+                                        limit=request.limit,
+                                        cursor=request.cursor,
                                         database=self.database)
-        return proto_pb2.ListAccountsResponse(
-            error=response.get_error(),
-            accounts=[proto_pb2.Account(logged_in=acc.get_logged_in(),
-                                        username=acc.get_username())
-                      for acc in response.get_accounts()])
+        return response.to_grpc_model(proto_pb2.ListAccountsResponse)
 
     def SendMessage(self, request, context):
         response = Events.send_message(
@@ -48,60 +50,212 @@ class ChatServicer(proto_pb2_grpc.ChatServicer):
             recipient_username=request.recipient_username,
             sender_username=request.sender_username,
             database=self.database)
-        return proto_pb2.SendMessageResponse(error=response.get_error())
+        return response.to_grpc_model(proto_pb2.SendMessageResponse)
+
+    def SendMessages(self, request, context):
+        response = Events.send_messages(
+            messages=SendMessagesRequest.from_grpc_model(request)
+            .get_messages(),
+            database=self.database)
+        return response.to_grpc_model(proto_pb2.SendMessagesResponse)
 
     def DeliverUndeliveredMessages(self, request, context):
         response = Events.deliver_undelivered_messages(
             logged_in=request.logged_in,
             username=request.username,
+            max_wait=request.max_wait,
+            ack_ids=list(request.ack_ids),
+            limit=request.limit,
+            cursor=request.cursor,
             database=self.database)
-        return proto_pb2.DeliverUndeliveredMessagesResponse(
-            error=response.get_error(),
-            messages=[proto_pb2.Message(message=msg
-                                        .get_message(),
-                                        recipient_logged_in=msg
-                                        .get_recipient_logged_in(),
-                                        recipient_username=msg
-                                        .get_recipient_username(),
-                                        sender_username=msg
-                                        .get_sender_username(),
-                                        time=msg
-                                        .get_time(),
-                                        delivered=msg
-                                        .get_delivered())
-                      for msg in response.get_messages()])
+        return response.to_grpc_model(
+            proto_pb2.DeliverUndeliveredMessagesResponse)
 
     def AcknowledgeMessages(self, request, context):
-        response = Events.acknowledge_messages(
-            messages=[Message.from_grpc_model(msg)
-                      for msg in request.messages],
-            database=self.database)
-        return proto_pb2.AcknowledgeMessagesResponse(
-            error=response.get_error())
+        response = Events.acknowledge_messages(ids=list(request.ids),
+                                               database=self.database)
+        return response.to_grpc_model(
+            proto_pb2.AcknowledgeMessagesResponse)
+
+    def SubscribeMessages(self, request, context):
+        responses = Events.subscribe_messages(logged_in=request.logged_in,
+                                              username=request.username,
+                                              database=self.database)
+        try:
+            for response in responses:
+                if not context.is_active():
+                    break
+                yield response.to_grpc_model(
+                    proto_pb2.SubscribeMessagesResponse)
+        finally:
+            responses.close()
 
     def DeleteAccount(self, request, context):
         response = Events.delete_account(username=request.username,
                                          database=self.database)
-        return proto_pb2.DeleteAccountResponse(error=response.get_error())
+        return response.to_grpc_model(proto_pb2.DeleteAccountResponse)
 
     def LogOutAccount(self, request, context):
         response = Events.log_out_account(username=request.username,
                                           database=self.database)
-        return proto_pb2.LogOutAccountResponse(error=response.get_error())
+        return response.to_grpc_model(proto_pb2.LogOutAccountResponse)
+
+
+class AsyncChatServicer(ChatServicer):
+    """`ChatServicer` for a `grpc.aio` server. The `Events` (which block) run
+        on `executor`, so the event loop only has the connections and
+        streams, and a subscription (or a delivery waiting for new messages)
+        doesn't take up a thread.
+    """
+
+    def __init__(self, executor: Executor = None, **kwargs):
+        super().__init__(**kwargs)
+        self.executor = executor
+
+    async def run(self, method, request, context):
+        """Run the (blocking) `ChatServicer` `method` on `executor`.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            method,
+            request,
+            context)
+
+    async def LogInAccount(self, request, context):
+        return await self.run(super().LogInAccount, request, context)
+
+    async def CreateAccount(self, request, context):
+        return await self.run(super().CreateAccount, request, context)
+
+    async def ListAccounts(self, request, context):
+        return await self.run(super().ListAccounts, request, context)
+
+    async def SendMessage(self, request, context):
+        return await self.run(super().SendMessage, request, context)
+
+    async def SendMessages(self, request, context):
+        return await self.run(super().SendMessages, request, context)
+
+    async def DeliverUndeliveredMessages(self, request, context):
+        response = await Events.deliver_undelivered_messages_async(
+            logged_in=request.logged_in,
+            username=request.username,
+            max_wait=request.max_wait,
+            ack_ids=list(request.ack_ids),
+            limit=request.limit,
+            cursor=request.cursor,
+            executor=self.executor,
+            database=self.database)
+        return response.to_grpc_model(
+            proto_pb2.DeliverUndeliveredMessagesResponse)
+
+    async def AcknowledgeMessages(self, request, context):
+        return await self.run(super().AcknowledgeMessages, request, context)
+
+    async def SubscribeMessages(self, request, context):
+        responses = Events.subscribe_messages_async(
+            logged_in=request.logged_in,
+            username=request.username,
+            executor=self.executor,
+            database=self.database)
+        try:
+            async for response in responses:
+                yield response.to_grpc_model(
+                    proto_pb2.SubscribeMessagesResponse)
+        finally:
+            await responses.aclose()
+
+    async def DeleteAccount(self, request, context):
+        return await self.run(super().DeleteAccount, request, context)
+
+    async def LogOutAccount(self, request, context):
+        return await self.run(super().LogOutAccount, request, context)
+
+
+def server_options(max_concurrent_streams: int,
+                   max_message_len: int) -> List[Tuple[str, int]]:
+    """The channel options of the server.
+    """
+    return [('grpc.max_concurrent_streams', max_concurrent_streams),
+            ('grpc.max_send_message_length', max_message_len),
+            ('grpc.max_receive_message_length', max_message_len),
+            # so the clients' keepalive pings (see `chat.grpc.client.main`)
+            # are allowed, rather than the connection being closed.
+            ('grpc.keepalive_permit_without_calls', 1),
+            ('grpc.http2.min_ping_interval_without_data_ms',
+             Config.GRPC_KEEPALIVE_TIME * 1000)]
+
+
+def server_compression(compression: str) -> grpc.Compression:
+    """The `grpc.Compression` of a `Config.GRPC_COMPRESSION` value.
+    """
+    match compression:
+        case 'deflate':
+            return grpc.Compression.Deflate
+        case 'gzip':
+            return grpc.Compression.Gzip
+        case _:
+            return grpc.Compression.NoCompression
+
+
+async def serve_async(machine_id=0,
+                      addresses=Config.ADDRESSES,
+                      max_workers=Config.MAX_WORKERS,
+                      max_concurrent_streams=Config
+                      .GRPC_MAX_CONCURRENT_STREAMS,
+                      max_message_len=Config.GRPC_MAX_MESSAGE_LEN,
+                      compression=Config.GRPC_COMPRESSION,
+                      **kwargs):
+    """Serve with `AsyncChatServicer` on a `grpc.aio` server; at most
+        `max_workers` threads are handling requests.
+    """
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        server = grpc.aio.server(
+            options=server_options(max_concurrent_streams, max_message_len),
+            compression=server_compression(compression))
+        proto_pb2_grpc.add_ChatServicer_to_server(
+            AsyncChatServicer(executor=executor, **kwargs),
+            server)
+        _, port = channel_address(addresses[machine_id], Channel.CLIENT)
+        server.add_insecure_port(f'[::]:{port!s}')
+        await server.start()
+        await server.wait_for_termination()
 
 
-def main(machine_id=0, addresses=Config.ADDRESSES, database=Database, **kwargs):
-    """Start a server and keep on listening.
+def main(machine_id=0,
+         addresses=Config.ADDRESSES,
+         database=Database,
+         use_asyncio=True,
+         max_workers=Config.MAX_WORKERS,
+         max_concurrent_streams=Config.GRPC_MAX_CONCURRENT_STREAMS,
+         max_message_len=Config.GRPC_MAX_MESSAGE_LEN,
+         compression=Config.GRPC_COMPRESSION,
+         **kwargs):
+    """Start a server and keep on listening; with `serve_async` (the
+        default), or unless `use_asyncio`, with a pool of `max_workers`
+        threads, where every subscription stream holds one of the threads.
     """
     Events.startup(machine_id=machine_id,
                    addresses=addresses,
                    database=database)
     kwargs['database'] = database
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=Config
-                                                    .MAX_WORKERS))
+    if use_asyncio:
+        asyncio.run(serve_async(machine_id=machine_id,
+                                addresses=addresses,
+                                max_workers=max_workers,
+                                max_concurrent_streams=max_concurrent_streams,
+                                max_message_len=max_message_len,
+                                compression=compression,
+                                **kwargs))
+        return
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=max_workers),
+        options=server_options(max_concurrent_streams, max_message_len),
+        compression=server_compression(compression))
     proto_pb2_grpc.add_ChatServicer_to_server(ChatServicer(**kwargs),
                                               server)
-    server.add_insecure_port(f'[::]:{addresses[machine_id][1]!s}')
+    _, port = channel_address(addresses[machine_id], Channel.CLIENT)
+    server.add_insecure_port(f'[::]:{port!s}')
     server.start()
     server.wait_for_termination()
 
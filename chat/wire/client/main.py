@@ -5,6 +5,7 @@ from chat.common.args import parse_client_args as parse_args
 from chat.common.client.events import main as client_main
 from chat.common.client.shiny.events import main as shiny_client_main
 from chat.common.config import Config
+from chat.common.framing import FramedSocket
 from chat.common.models import (
     AcknowledgeMessagesRequest,
     AcknowledgeMessagesResponse,
@@ -22,9 +23,13 @@ from chat.common.models import (
     LogOutAccountResponse,
     SendMessageRequest,
     SendMessageResponse,
+    SendMessagesRequest,
+    SendMessagesResponse,
+    SubscribeMessagesRequest,
+    SubscribeMessagesResponse,
 )
 from chat.common.operations import Opcode
-from typing import Optional
+from typing import Iterator, Optional, Tuple
 
 import socket
 
@@ -34,12 +39,13 @@ def entry(host=Config.ADDRESSES[0][0], port=Config.ADDRESSES[0][1], **kwargs):
     """
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect((host, port))
-    kwargs['s'] = s
+    kwargs['s'] = FramedSocket(s)
+    kwargs['address'] = (host, port)
     return kwargs
 
 
 def request(opcode: Opcode,
-            s: socket.socket = None,
+            s: FramedSocket = None,
             username: Optional[str] = None,
             text_wildcard: Optional[str] = None,
             message: Optional[str] = None,
@@ -47,6 +53,10 @@ def request(opcode: Opcode,
             sender_username: Optional[str] = None,
             logged_in: Optional[bool] = None,
             messages: Optional[list] = None,
+            max_wait: Optional[int] = None,
+            ack_ids: Optional[list] = None,
+            limit: Optional[int] = None,
+            cursor: Optional[str] = None,
             **kwargs):
     """Send a request to the server.
     """
@@ -57,26 +67,36 @@ def request(opcode: Opcode,
         case Opcode.CREATE_ACCOUNT:
             obj = CreateAccountRequest(username=username)
         case Opcode.LIST_ACCOUNTS:
-            obj = ListAccountsRequest(text_wildcard=text_wildcard)
+            obj = ListAccountsRequest(text_wildcard=text_wildcard,
+                                      limit=limit or 0,
+                                      cursor=cursor or '')
         case Opcode.SEND_MESSAGE:
             obj = SendMessageRequest(
                 message=message,
                 recipient_username=recipient_username,
                 sender_username=sender_username)
+        case Opcode.SEND_MESSAGES:
+            obj = SendMessagesRequest(messages=messages)
         case Opcode.DELIVER_UNDELIVERED_MESSAGES:
             obj = DeliverUndeliveredMessagesRequest(
                 logged_in=logged_in,
-                username=username)
+                username=username,
+                max_wait=max_wait or 0,
+                ack_ids=ack_ids or (),
+                limit=limit or 0,
+                cursor=cursor or '')
         case Opcode.DELETE_ACCOUNT:
             obj = DeleteAccountRequest(username=username)
         case Opcode.LOG_OUT_ACCOUNT:
             obj = LogOutAccountRequest(username=username)
         case Opcode.ACKNOWLEDGE_MESSAGES:
-            obj = AcknowledgeMessagesRequest(messages=messages)
+            obj = AcknowledgeMessagesRequest(ids=ack_ids or ())
 
     request = obj.serialize()
-    s.sendall(request)
-    response = s.recv(1024)
+    s.send_frame(request)
+    response = s.recv_frame()
+    if response is None:
+        raise ConnectionError('Server disconnected.')
 
     match opcode:
         case Opcode.LOG_IN_ACCOUNT:
@@ -87,6 +107,8 @@ def request(opcode: Opcode,
             return ListAccountsResponse.deserialize(response)
         case Opcode.SEND_MESSAGE:
             return SendMessageResponse.deserialize(response)
+        case Opcode.SEND_MESSAGES:
+            return SendMessagesResponse.deserialize(response)
         case Opcode.DELIVER_UNDELIVERED_MESSAGES:
             return DeliverUndeliveredMessagesResponse.deserialize(response)
         case Opcode.DELETE_ACCOUNT:
@@ -97,7 +119,45 @@ def request(opcode: Opcode,
             return AcknowledgeMessagesResponse.deserialize(response)
 
 
-def handler(err: Exception, s: Optional[socket.socket] = None, **kwargs):
+class Subscription(object):
+    """The `SubscribeMessagesResponse`s pushed by the server, on a connection
+        of their own (since the server only pushes on it from then on).
+    """
+
+    def __init__(self, address: Tuple[str, int], username: str):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(address)
+        self.s = FramedSocket(s)
+        self.s.send_frame(SubscribeMessagesRequest(logged_in=True,
+                                                   username=username)
+                          .serialize())
+
+    def __iter__(self) -> Iterator[SubscribeMessagesResponse]:
+        while True:
+            response = self.s.recv_frame()
+            if response is None:
+                return
+            yield SubscribeMessagesResponse.deserialize(response)
+
+    def cancel(self):
+        """Stop the subscription (i.e. close its connection).
+        """
+        try:
+            self.s.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.s.close()
+
+
+def subscribe(username: str,
+              address: Optional[Tuple[str, int]] = None,
+              **kwargs) -> Subscription:
+    """Subscribe to the new messages for `username`.
+    """
+    return Subscription(address, username)
+
+
+def handler(err: Exception, s: Optional[FramedSocket] = None, **kwargs):
     """Handle errors (i.e. close the socket connection).
     """
     if s is not None:
@@ -114,6 +174,7 @@ def main(addresses: list = Config.ADDRESSES,
         shiny_client_main(entry=entry,
                           request=request,
                           handler=handler,
+                          subscribe=subscribe,
                           machine_id=machine_id,
                           addresses=addresses,
                           **kwargs)
@@ -121,6 +182,7 @@ def main(addresses: list = Config.ADDRESSES,
         client_main(entry=entry,
                     request=request,
                     handler=handler,
+                    subscribe=subscribe,
                     machine_id=machine_id,
                     addresses=addresses,
                     **kwargs)
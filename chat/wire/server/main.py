@@ -2,7 +2,9 @@
 # in chat.wire.server
 
 from chat.common.args import parse_server_args as parse_args
+from chat.common.cluster import Channel, channel_address
 from chat.common.config import Config
+from chat.common.framing import FramedSocket, read_frame, serialize_frame
 from chat.common.models import (
     BaseRequest,
     AcknowledgeMessagesRequest,
@@ -13,12 +15,17 @@ from chat.common.models import (
     LogInAccountRequest,
     LogOutAccountRequest,
     SendMessageRequest,
+    SendMessagesRequest,
+    SubscribeMessagesRequest,
 )
 from chat.common.operations import Opcode
 from chat.common.server.database import Database
 from chat.common.server.events import Events, EventsRouter
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
 from typing import Optional
 
+import asyncio
 import socket
 import threading
 
@@ -27,68 +34,94 @@ def entry(machine_id=0, addresses=Config.ADDRESSES, **kwargs):
     """Start the socket for the server.
     """
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind(addresses[machine_id])
+    s.bind(channel_address(addresses[machine_id], Channel.CLIENT))
+
+
+def handle_request(request: bytes, database=Database, **kwargs) -> bytes:
+    """Handle a single request, returning the serialized response.
+    """
+    event_kwargs = {}
+    opcode = Opcode(BaseRequest.peek_opcode(request))
+
+    if kwargs.get('verbose', False):
+        print(f'{opcode.name!s} request: {len(request)!s}B.')
+
+    match opcode:
+        case Opcode.LOG_IN_ACCOUNT:
+            req = CreateAccountRequest.deserialize(request)
+            event_kwargs['username'] = req.get_username()
+        case Opcode.CREATE_ACCOUNT:
+            req = LogInAccountRequest.deserialize(request)
+            event_kwargs['username'] = req.get_username()
+        case Opcode.LIST_ACCOUNTS:
+            req = ListAccountsRequest.deserialize(request)
+            event_kwargs['text_wildcard'] = req.get_text_wildcard()
+            event_kwargs['limit'] = req.get_limit()
+            event_kwargs['cursor'] = req.get_cursor()
+        case Opcode.SEND_MESSAGE:
+            req = SendMessageRequest.deserialize(request)
+            event_kwargs['message'] = req.get_message()
+            event_kwargs['recipient_username'] = \
+                req.get_recipient_username()
+            event_kwargs['sender_username'] = req.get_sender_username()
+        case Opcode.SEND_MESSAGES:
+            req = SendMessagesRequest.deserialize(request)
+            event_kwargs['messages'] = req.get_messages()
+        case Opcode.DELIVER_UNDELIVERED_MESSAGES:
+            req = DeliverUndeliveredMessagesRequest.deserialize(
+                request)
+            event_kwargs['logged_in'] = req.get_logged_in()
+            event_kwargs['username'] = req.get_username()
+            event_kwargs['max_wait'] = req.get_max_wait()
+            event_kwargs['ack_ids'] = req.get_ack_ids()
+            event_kwargs['limit'] = req.get_limit()
+            event_kwargs['cursor'] = req.get_cursor()
+        case Opcode.DELETE_ACCOUNT:
+            req = DeleteAccountRequest.deserialize(request)
+            event_kwargs['username'] = req.get_username()
+        case Opcode.LOG_OUT_ACCOUNT:
+            req = LogOutAccountRequest.deserialize(request)
+            event_kwargs['username'] = req.get_username()
+        case Opcode.ACKNOWLEDGE_MESSAGES:
+            req = AcknowledgeMessagesRequest.deserialize(
+                request)
+            event_kwargs['ids'] = req.get_ids()
+
+    response = EventsRouter[opcode](database=database, **event_kwargs)
+    res_packet = response.serialize()
+
+    if kwargs.get('verbose', False):
+        print(f'{opcode.name!s} response: {len(res_packet)!s}B.')
+    return res_packet
 
 
 def handle_connection(connection, database=Database, **kwargs):
     """The steady state of the server once a connection is established.
     """
     username = None
+    connection = FramedSocket(connection)
     try:
         # TODO: maybe if two devices same acc (out of spec, cf Ed)
         # then just check the db to see if still exists each loop.
         # hacks work ya know.
         while True:
-            request = connection.recv(1024)
-            if len(request) == 0:
+            request = connection.recv_frame()
+            if request is None:
                 # This is a signal of disconnect.
                 # and so if we update `._logged_in` on the loop exit
                 break
 
-            event_kwargs = {}
-            opcode = Opcode(BaseRequest.peek_opcode(request))
-
-            if kwargs.get('verbose', False):
-                print(f'{opcode.name!s} request: {len(request)!s}B.')
-
-            match opcode:
-                case Opcode.LOG_IN_ACCOUNT:
-                    req = CreateAccountRequest.deserialize(request)
-                    event_kwargs['username'] = req.get_username()
-                case Opcode.CREATE_ACCOUNT:
-                    req = LogInAccountRequest.deserialize(request)
-                    event_kwargs['username'] = req.get_username()
-                case Opcode.LIST_ACCOUNTS:
-                    req = ListAccountsRequest.deserialize(request)
-                    event_kwargs['text_wildcard'] = req.get_text_wildcard()
-                case Opcode.SEND_MESSAGE:
-                    req = SendMessageRequest.deserialize(request)
-                    event_kwargs['message'] = req.get_message()
-                    event_kwargs['recipient_username'] = \
-                        req.get_recipient_username()
-                    event_kwargs['sender_username'] = req.get_sender_username()
-                case Opcode.DELIVER_UNDELIVERED_MESSAGES:
-                    req = DeliverUndeliveredMessagesRequest.deserialize(
-                        request)
-                    event_kwargs['logged_in'] = req.get_logged_in()
-                    event_kwargs['username'] = req.get_username()
-                case Opcode.DELETE_ACCOUNT:
-                    req = DeleteAccountRequest.deserialize(request)
-                    event_kwargs['username'] = req.get_username()
-                case Opcode.LOG_OUT_ACCOUNT:
-                    req = LogOutAccountRequest.deserialize(request)
-                    event_kwargs['username'] = req.get_username()
-                case Opcode.ACKNOWLEDGE_MESSAGES:
-                    req = AcknowledgeMessagesRequest.deserialize(
-                        request)
-                    event_kwargs['messages'] = req.get_messages()
-
-            response = EventsRouter[opcode](database=database, **event_kwargs)
-            res_packet = response.serialize()
+            if (BaseRequest.peek_opcode(request) ==
+                    Opcode.SUBSCRIBE_MESSAGES.value):
+                handle_subscription(connection,
+                                    request,
+                                    database=database,
+                                    **kwargs)
+                break
 
-            if kwargs.get('verbose', False):
-                print(f'{opcode.name!s} response: {len(res_packet)!s}B.')
-            connection.sendall(res_packet)
+            connection.send_frame(handle_request(request,
+                                                 database=database,
+                                                 **kwargs))
     except Exception as e:
         raise e
 
@@ -97,6 +130,149 @@ def handle_connection(connection, database=Database, **kwargs):
         Events.log_out_account(username=username)
 
 
+def handle_subscription(connection: FramedSocket,
+                        request: bytes,
+                        database=Database,
+                        **kwargs):
+    """Push `SubscribeMessagesResponse`s on the connection (which is only for
+        that from now on) until it disconnects.
+    """
+    req = SubscribeMessagesRequest.deserialize(request)
+    responses = Events.subscribe_messages(logged_in=req.get_logged_in(),
+                                          username=req.get_username(),
+                                          database=database)
+    try:
+        for response in responses:
+            res_packet = response.serialize()
+            if kwargs.get('verbose', False):
+                print(f'{Opcode.SUBSCRIBE_MESSAGES.name!s} push: '
+                      f'{len(res_packet)!s}B.')
+            connection.send_frame(res_packet)
+    except OSError:
+        # disconnected.
+        pass
+    finally:
+        responses.close()
+
+
+async def handle_subscription_async(writer: asyncio.StreamWriter,
+                                    request: bytes,
+                                    executor: Executor,
+                                    database=Database,
+                                    **kwargs):
+    """`handle_subscription`, as a coroutine (see
+        `Events.subscribe_messages_async`).
+    """
+    req = SubscribeMessagesRequest.deserialize(request)
+    responses = Events.subscribe_messages_async(
+        logged_in=req.get_logged_in(),
+        username=req.get_username(),
+        executor=executor,
+        database=database)
+    try:
+        async for response in responses:
+            writer.write(serialize_frame(response.serialize()))
+            await writer.drain()
+    finally:
+        await responses.aclose()
+
+
+async def handle_delivery_async(request: bytes,
+                                executor: Executor,
+                                database=Database,
+                                **kwargs) -> bytes:
+    """`handle_request` for a `DeliverUndeliveredMessagesRequest`, as a
+        coroutine (see `Events.deliver_undelivered_messages_async`), so a
+        delivery waiting for new messages doesn't hold one of the threads.
+    """
+    if kwargs.get('verbose', False):
+        print(f'{Opcode.DELIVER_UNDELIVERED_MESSAGES.name!s} request: '
+              f'{len(request)!s}B.')
+    req = DeliverUndeliveredMessagesRequest.deserialize(request)
+    response = await Events.deliver_undelivered_messages_async(
+        logged_in=req.get_logged_in(),
+        username=req.get_username(),
+        max_wait=req.get_max_wait(),
+        ack_ids=req.get_ack_ids(),
+        limit=req.get_limit(),
+        cursor=req.get_cursor(),
+        executor=executor,
+        database=database)
+    res_packet = response.serialize()
+    if kwargs.get('verbose', False):
+        print(f'{Opcode.DELIVER_UNDELIVERED_MESSAGES.name!s} response: '
+              f'{len(res_packet)!s}B.')
+    return res_packet
+
+
+async def handle_connection_async(reader: asyncio.StreamReader,
+                                  writer: asyncio.StreamWriter,
+                                  executor: Executor,
+                                  database=Database,
+                                  **kwargs):
+    """`handle_connection`, as a coroutine. The `Database` calls block, so
+        they are run on the `executor`.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                request = await read_frame(reader)
+            except ValueError:
+                # too long to buffer, so nothing after it can be read.
+                break
+            if request is None:
+                # This is a signal of disconnect.
+                break
+
+            if (BaseRequest.peek_opcode(request) ==
+                    Opcode.SUBSCRIBE_MESSAGES.value):
+                await handle_subscription_async(writer,
+                                                request,
+                                                executor,
+                                                database=database,
+                                                **kwargs)
+                break
+
+            if (BaseRequest.peek_opcode(request) ==
+                    Opcode.DELIVER_UNDELIVERED_MESSAGES.value):
+                response = await handle_delivery_async(request,
+                                                       executor,
+                                                       database=database,
+                                                       **kwargs)
+            else:
+                response = await loop.run_in_executor(
+                    executor,
+                    partial(handle_request,
+                            request,
+                            database=database,
+                            **kwargs))
+            writer.write(serialize_frame(response))
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_async(machine_id=0,
+                      addresses=Config.ADDRESSES,
+                      max_workers=Config.MAX_WORKERS,
+                      **kwargs):
+    """Serve every connection on a single event loop, rather than a thread
+        each; at most `max_workers` threads are handling requests.
+    """
+    host, port = channel_address(addresses[machine_id], Channel.CLIENT)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        server = await asyncio.start_server(
+            partial(handle_connection_async, executor=executor, **kwargs),
+            host,
+            port,
+            backlog=Config.SERVER_BACKLOG)
+        async with server:
+            await server.serve_forever()
+
+
 def handler(err: Exception, s: Optional[socket.socket] = None, **kwargs):
     """Handle errors if they come up. i.e. close the socket.
     """
@@ -109,15 +285,22 @@ def handler(err: Exception, s: Optional[socket.socket] = None, **kwargs):
 def main(machine_id=0,
          addresses=Config.ADDRESSES,
          database=Database,
+         use_asyncio=False,
          **kwargs):
-    """Start a server and keep on listening.
+    """Start a server and keep on listening; with a thread per connection,
+        or if `use_asyncio`, with `serve_async`.
     """
     Events.startup(machine_id=machine_id,
                    addresses=addresses,
                    database=database)
     kwargs['database'] = database
+    if use_asyncio:
+        asyncio.run(serve_async(machine_id=machine_id,
+                                addresses=addresses,
+                                **kwargs))
+        return
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind(addresses[machine_id])
+        s.bind(channel_address(addresses[machine_id], Channel.CLIENT))
         s.listen()
         s.settimeout(Config.TIMEOUT_CLIENT)
         threads = []
@@ -128,6 +311,8 @@ def main(machine_id=0,
                                           args=[connection],
                                           kwargs=kwargs)
                 thread.start()
+                # only keep the ones still connected.
+                threads = [t for t in threads if t.is_alive()]
                 threads.append(thread)
             except TimeoutError:
                 pass
@@ -0,0 +1,68 @@
+# bench.py
+
+from chat.common.models import (
+    Account,
+    DeliverUndeliveredMessagesRequest,
+    Message,
+)
+
+import gc
+import tracemalloc
+
+
+# HELPERS
+
+
+class BenchData():
+    n = 100000
+    message = "hi"
+    time = 1681000000
+    username = "username"
+    username2 = "username2"
+
+
+def make_account(i: int):
+    return Account(logged_in=True,
+                   username=BenchData.username)
+
+
+def make_message(i: int):
+    return Message(delivered=False,
+                   message=BenchData.message,
+                   recipient_logged_in=True,
+                   recipient_username=BenchData.username,
+                   sender_username=BenchData.username2,
+                   time=BenchData.time)
+
+
+def make_request(i: int):
+    return DeliverUndeliveredMessagesRequest(logged_in=True,
+                                             username=BenchData.username)
+
+
+def bytes_per_instance(make, n: int = BenchData.n) -> float:
+    """The bytes allocated per instance made by `make`, not counting the
+        field values themselves (which are shared between instances).
+    """
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    objs = [make(i) for i in range(n)]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # the `list` holding them isn't part of the instances.
+    return (after - before - objs.__sizeof__()) / n
+
+
+# BENCHMARKS
+
+
+def bench_memory():
+    for name, make in [('Account', make_account),
+                       ('Message', make_message),
+                       ('DeliverUndeliveredMessagesRequest', make_request)]:
+        print(f'{name!s}: {bytes_per_instance(make):.1f}B per instance.')
+
+
+if __name__ == '__main__':
+    bench_memory()
@@ -1,25 +1,81 @@
 # tests.py
 
+from chat.common.cluster import (
+    Channel,
+    channel_address,
+    parse_addresses,
+)
 from chat.common.config import Config
-from chat.common.models import Message, Account
+from chat.common.framing import (
+    FramedSocket,
+    FRAME_LEN_BITS,
+    read_frame,
+    serialize_frame,
+)
+from chat.common.models import (
+    Account,
+    AcknowledgeMessagesRequest,
+    BaseRequest,
+    CreateAccountRequest,
+    CreateAccountResponse,
+    DeliverUndeliveredMessagesRequest,
+    DeliverUndeliveredMessagesResponse,
+    ListAccountsRequest,
+    ListAccountsResponse,
+    Message,
+    SendMessageRequest,
+)
 from chat.common.operations import Opcode
-from chat.common.server.database import Database
+from chat.common.serialization import LIST_LEN_BITS, SerializationUtils
+from chat.common.server.database import (
+    Database,
+    DatabaseOpcode,
+    DatabaseRequests,
+    DatabaseResponses,
+    LegacyMessage,
+    SNAPSHOT_MAGIC,
+    SNAPSHOT_VERSION,
+)
+from chat.common.server.events import Events
+from chat.common.server.membership import Membership
+from chat.common.server.proxy import ProxyConnection, serve_proxy_connection
+from chat.common.util import Model
 from chat.grpc.client.main import (
+    ChannelPool,
     entry as grpc_client_entry,
     request as grpc_client_request,
+    request_async as grpc_client_request_async,
+)
+from chat.grpc.server.main import (
+    AsyncChatServicer,
+    main as grpc_server_main,
+    server_options,
 )
-from chat.grpc.server.main import main as grpc_server_main
 from chat.wire.client.main import (
     entry as wire_client_entry,
-    request as wire_client_request
+    request as wire_client_request,
+    subscribe as wire_client_subscribe
+)
+from chat.wire.server.main import (
+    handle_connection_async,
+    main as wire_server_main,
 )
-from chat.wire.server.main import main as wire_server_main
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from enum import Enum
-from threading import Thread, Lock
-from time import sleep
+from threading import Condition, Thread, Lock, RLock
+from time import monotonic, sleep
+from typing import Callable
 
+import asyncio
 import chat.common.server.database
+import chat.grpc.grpcio.proto_pb2 as proto_pb2
+import chat.grpc.grpcio.proto_pb2_grpc as proto_pb2_grpc
+import grpc
+import itertools
 import pytest
+import socket
 
 
 # HELPERS
@@ -46,11 +102,35 @@ class TestDatabases():
             pass
 
         impl_db._accounts = {}
+        impl_db._usernames = []
         impl_db._messages = {}
+        impl_db._messages_by_id = {}
+        impl_db._undelivered = {}
+        impl_db._next_message_id = 1
+        impl_db._subscribers = {}
+        impl_db._message_conds = {}
+        impl_db.log_file = None
+        impl_db.log_len = 0
+        impl_db.log_fsynced_at = 0
+        impl_db.log_seq = 0
+        impl_db.log_backlog = deque(maxlen=Config.REPLICATION_BACKLOG_LEN)
+        impl_db.replica_sent_seqs = {}
+        impl_db.replica_acked_seqs = {}
+        impl_db.origin_seqs = {}
+        impl_db.replicated_ats = {}
         impl_db.addresses = [v for v in TestData.addresses]
         impl_db.machines_down = [False, False, False]
+        impl_db.machines_caught_up = [True, True, True]
+        impl_db.synced_partitions = set()
         impl_db.machine_id = machine_id
         impl_db.machine_lock = Lock()
+        impl_db.machine_cond = Condition(impl_db.machine_lock)
+        impl_db.primary_id = None
+        impl_db.machine_generations = [0, 0, 0]
+        impl_db.membership = None
+        impl_db.shard_locks = [Lock() for _ in range(Config.DATABASE_SHARDS)]
+        impl_db.log_lock = RLock()
+        impl_db.replication_cond = Condition(impl_db.log_lock)
         impl_db.queue_sockets = {}
         impl_db.sync_sockets = {}
         impl_db.queue_connections = {}
@@ -151,6 +231,13 @@ def deliver_undelivered_messages(chat: Chat, username: str = None, **kwargs):
                    **kwargs)
 
 
+def acknowledge_messages(chat: Chat, ack_ids: list, **kwargs):
+    return request(chat,
+                   Opcode.ACKNOWLEDGE_MESSAGES,
+                   ack_ids=ack_ids,
+                   **kwargs)
+
+
 def delete_account(chat: Chat, username: str = None, **kwargs):
     username = username if username is not None else TestData.username
     return request(chat,
@@ -340,6 +427,41 @@ def test_send_message_error(chat: Chat, machine_id: int, kwargs):
     assert (len(response.get_error()) != 0)
 
 
+@pytest.mark.parametrize("chat", [Chat.WIRE])
+def test_send_messages(chat: Chat, kwargs):
+    clean_between_tests(chat, 0)
+    for username in [TestData.username, TestData.username2]:
+        create_account(chat, username=username, **kwargs[0])
+
+    missing = 'missing'
+    messages = [Message(message=TestData.message * (i + 1),
+                        recipient_username=recipient,
+                        sender_username=TestData.username,
+                        time=0)
+                for i, recipient in enumerate([TestData.username,
+                                               TestData.username2,
+                                               missing,
+                                               TestData.username2])]
+    db = TestDatabases.DBS[chat][0]
+    seq = db.log_seq
+    response = request(chat,
+                       Opcode.SEND_MESSAGES,
+                       messages=messages,
+                       **kwargs[0])
+
+    # only the missing recipient's message isn't sent, and the others are
+    # a single change.
+    assert (missing in response.get_error())
+    assert (db.log_seq == seq + 1)
+    for username, expected in [(TestData.username, [messages[0]]),
+                               (TestData.username2, messages[1::2])]:
+        delivered = deliver_undelivered_messages(chat,
+                                                 username=username,
+                                                 **kwargs[0])
+        assert ([msg.get_message() for msg in delivered.get_messages()] ==
+                [msg.get_message() for msg in expected])
+
+
 @pytest.mark.parametrize("chat", [Chat.WIRE])
 @pytest.mark.parametrize("machine_id", range(3))
 def test_deliver_undelivered_messages_success(chat: Chat, machine_id: int, kwargs):
@@ -368,6 +490,7 @@ def test_deliver_undelivered_messages_success(chat: Chat, machine_id: int, kwarg
     assert (len(response_messages) == 1)
 
     for response_message in response_messages:
+        response_message.set_id(0)
         response_message.set_time(None)
 
     assert ([message] == response_messages)
@@ -421,3 +544,1150 @@ def test_log_out_account_error(chat: Chat, machine_id: int, kwargs):
 
     response = log_out_account(chat, **kwargs[0])
     assert (len(response.get_error()) != 0)
+
+
+def test_framing_partial_and_coalesced_frames():
+    a, b = socket.socketpair()
+    sender, receiver = FramedSocket(a), FramedSocket(b, chunk_len=3)
+
+    payloads = [b'', b'hi', bytes(range(256)) * 8]
+    packet = b''.join(FramedSocket.serialize_header(len(p)) + p
+                      for p in payloads)
+
+    # byte at a time, so every frame (and header) arrives in pieces.
+    thread = Thread(target=lambda: [a.sendall(packet[i:i + 1])
+                                    for i in range(len(packet))])
+    thread.start()
+    for payload in payloads:
+        assert (receiver.recv_frame() == payload)
+    thread.join()
+
+    # all at once, so several frames arrive in one `recv`.
+    thread = Thread(target=a.sendall, args=[packet])
+    thread.start()
+    for payload in payloads:
+        assert (receiver.recv_frame() == payload)
+    thread.join()
+
+    sender.send_frame(b'bye')
+    assert (receiver.recv_frame() == b'bye')
+
+    a.sendall(FramedSocket.serialize_header(10)[:FRAME_LEN_BITS - 1])
+    a.close()
+    assert (receiver.recv_frame() is None)
+    b.close()
+
+
+def test_framing_rejects_long_frames():
+    with pytest.raises(ValueError):
+        FramedSocket.serialize_header(Config.FRAME_MAX_LEN + 1)
+
+    header = SerializationUtils.serialize_int(Config.FRAME_MAX_LEN + 1,
+                                              length=FRAME_LEN_BITS)
+    a, b = socket.socketpair()
+    a.sendall(header)
+    with pytest.raises(ValueError):
+        FramedSocket(b).recv_frame()
+    a.close()
+    b.close()
+
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(header)
+        await read_frame(reader)
+
+    with pytest.raises(ValueError):
+        asyncio.run(run())
+
+
+@pytest.mark.parametrize("chat", [Chat.WIRE])
+@pytest.mark.parametrize("machine_id", range(3))
+def test_deliver_undelivered_messages_large(chat: Chat,
+                                            machine_id: int,
+                                            kwargs):
+    clean_between_tests(chat, machine_id)
+    create_account(chat, **kwargs[0])
+
+    n = 100
+    for i in range(n):
+        send_message(chat,
+                     recipient_username=TestData.username,
+                     message=f'{TestData.message!s} {i!s}',
+                     **kwargs[0])
+
+    response = deliver_undelivered_messages(chat,
+                                            **kwargs[0])
+
+    assert (len(response.get_error()) == 0)
+    assert (sorted(m.get_message() for m in response.get_messages()) ==
+            sorted(f'{TestData.message!s} {i!s}' for i in range(n)))
+
+
+def test_decode_offsets():
+    message = Message(delivered=True,
+                      message='h\u00e9llo',
+                      recipient_logged_in=False,
+                      recipient_username=TestData.username,
+                      sender_username=TestData.username2,
+                      time=1 << 40)
+    data = b'junk' + message.serialize() + message.serialize()
+
+    decoded, offset = Message.decode(memoryview(data), 4)
+    assert (decoded == message)
+    assert (offset == 4 + len(message.serialize()))
+    assert (Message.decode(memoryview(data), offset)[1] == len(data))
+
+    response = DeliverUndeliveredMessagesResponse(error='',
+                                                  messages=[message] * 3)
+    assert (DeliverUndeliveredMessagesResponse
+            .deserialize(response.serialize())
+            .get_messages() == [message] * 3)
+
+    # a field without a decoder falls back to its deserializer.
+    Custom = Model.model_with_fields(
+        field_deserializers=dict(
+            name=lambda d: SerializationUtils.deserialize_str(d)[::-1]),
+        field_serializers=dict(
+            name=lambda v: SerializationUtils.serialize_str(v[::-1])),
+        name=str,
+        flag=bool)
+    custom = Custom(name=TestData.username, flag=True)
+    assert (Custom.deserialize(custom.serialize()) == custom)
+
+
+def test_serialize_list_max_len():
+    accounts = [Account(logged_in=i % 2 == 0, username=str(i))
+                for i in range(Config.LIST_MAX_LEN + 10)]
+    data = SerializationUtils.serialize_list(accounts,
+                                             lambda v: v.serialize())
+    assert (len(data) == LIST_LEN_BITS + sum(len(a.serialize())
+                                             for a in accounts
+                                             [:Config.LIST_MAX_LEN]))
+    assert (SerializationUtils.decode_list(memoryview(data),
+                                           0,
+                                           Account.decode)
+            == (accounts[:Config.LIST_MAX_LEN], len(data)))
+
+
+def test_generated_codecs():
+    message = Message(delivered=False,
+                      message=TestData.message,
+                      recipient_logged_in=True,
+                      recipient_username=TestData.username,
+                      sender_username=TestData.username2,
+                      time=(1 << 48) - 1)
+    response = DeliverUndeliveredMessagesResponse(error='error',
+                                                  messages=[message] * 2)
+    request = SendMessageRequest(message=TestData.message,
+                                 recipient_username=TestData.username,
+                                 sender_username=TestData.username2)
+
+    # the generated codecs are equivalent to the generic `Model` ones.
+    for obj in [message, response, request]:
+        data = obj.serialize()
+        assert (data == Model.serialize(obj))
+        assert (type(obj).decode(memoryview(data)) ==
+                (Model.decode.__func__(type(obj), memoryview(data))[0],
+                 len(data)))
+        assert (type(obj).deserialize(data) == obj)
+
+    assert (BaseRequest.peek_opcode(request.serialize()) ==
+            Opcode.SEND_MESSAGE.value)
+
+    # out of range `int`s fail, rather than wrapping around.
+    for time in [1 << 48, -1]:
+        with pytest.raises(OverflowError):
+            Message(time=time).serialize()
+        with pytest.raises(OverflowError):
+            Model.serialize(Message(time=time))
+
+
+def test_grpc_converters():
+    message = Message(delivered=False,
+                      id=3,
+                      message=TestData.message,
+                      recipient_logged_in=True,
+                      recipient_username=TestData.username,
+                      sender_username=TestData.username2,
+                      time=(1 << 48) - 1)
+    response = DeliverUndeliveredMessagesResponse(error='error',
+                                                  messages=[message] * 2)
+    listed = ListAccountsResponse(error='',
+                                  accounts=[Account(logged_in=True,
+                                                    username=TestData
+                                                    .username)])
+
+    for obj, grpc_model in [
+            (message, proto_pb2.Message),
+            (response, proto_pb2.DeliverUndeliveredMessagesResponse),
+            (listed, proto_pb2.ListAccountsResponse)]:
+        grpc_obj = obj.to_grpc_model(grpc_model)
+        assert (type(grpc_obj) is grpc_model)
+        assert (type(obj).from_grpc_model(grpc_obj) == obj)
+
+    # generated once per pair of models.
+    assert (Message.grpc_converters(proto_pb2.Message) is
+            Message.grpc_converters(proto_pb2.Message))
+    assert ([msg.message for msg in
+             response.to_grpc_model(
+                 proto_pb2.DeliverUndeliveredMessagesResponse).messages] ==
+            [TestData.message] * 2)
+
+
+def test_models_have_no_dict():
+    for obj in [Account(),
+                Message(),
+                SendMessageRequest(),
+                DeliverUndeliveredMessagesResponse(),
+                DatabaseRequests.SyncData()]:
+        assert (not hasattr(obj, '__dict__'))
+
+
+def test_message_store():
+    db = TestDatabases.db_from_id(0)
+    account = Account(username=TestData.username)
+
+    def message(time):
+        return Message(delivered=False,
+                       message=TestData.message,
+                       recipient_logged_in=True,
+                       recipient_username=TestData.username,
+                       sender_username=TestData.username2,
+                       time=time)
+
+    messages = [message(2), message(3), message(1)]
+    for msg in messages:
+        db.local_upsert_message(msg)
+
+    # new ones get ids, in the order they were stored.
+    assert ([msg.get_id() for msg in messages] == [1, 2, 3])
+    assert ([msg.get_time() for msg in db._messages[TestData.username]] ==
+            [1, 2, 3])
+    assert ([msg.get_time() for msg in db.get_messages(account, False)] ==
+            [1, 2, 3])
+
+    # acknowledging is by id, and doesn't duplicate.
+    ack = Message.deserialize(messages[0].serialize()).set_delivered(True)
+    db.local_upsert_message(ack)
+    assert (messages[0].get_delivered())
+    assert (len(db._messages[TestData.username]) == 3)
+    assert ([msg.get_time() for msg in db.get_messages(account, False)] ==
+            [1, 3])
+
+    # the one stored out of order is removed from the undelivered ones too.
+    db.local_acknowledge_messages([messages[2].get_id()], {TestData.username})
+    assert ([msg.get_time() for msg in db._undelivered[TestData.username]] ==
+            [3])
+
+    db.local_delete_messages(TestData.username)
+    assert (db.get_messages(account, False) == [])
+    assert (len(db._messages_by_id) == 0)
+
+
+def db_in_tmp(tmp_path, machine_id=0):
+    class impl_db(TestDatabases.db_from_id(machine_id)):
+        @classmethod
+        def accounts_file_name(cls):
+            return str(tmp_path / f"accounts{machine_id!s}.txt")
+
+        @classmethod
+        def messages_file_name(cls):
+            return str(tmp_path / f"messages{machine_id!s}.txt")
+
+        @classmethod
+        def log_file_name(cls):
+            return str(tmp_path / f"log{machine_id!s}.txt")
+
+        @classmethod
+        def primary_log_file_name(cls):
+            return str(tmp_path / f"primary{machine_id!s}.txt")
+
+    return impl_db
+
+
+def make_message(time):
+    return Message(delivered=False,
+                   message=TestData.message,
+                   recipient_logged_in=False,
+                   recipient_username=TestData.username,
+                   sender_username=TestData.username2,
+                   time=time)
+
+
+def test_log_replay(tmp_path):
+    db = db_in_tmp(tmp_path)
+    account = Account(logged_in=False, username=TestData.username)
+    message = make_message(1)
+
+    db.local_upsert_account(account)
+    db.append_log(DatabaseRequests.UpsertAccount(account=account).serialize())
+    db.compact()
+    db.local_upsert_message(message)
+    db.append_log(
+        DatabaseRequests.UpsertMessage(the_message=message).serialize())
+    db.log_file.close()
+
+    # a crash mid-write leaves a partial change at the end.
+    with open(db.log_file_name(), "ab") as file:
+        file.write(FramedSocket.serialize_header(100) + b'partial')
+
+    replayed = db_in_tmp(tmp_path)
+    with open(replayed.accounts_file_name(), "rb") as file:
+        for acc in replayed.deserialize_accounts(file.read()):
+            replayed.local_upsert_account(acc)
+    replayed.replay_log()
+    # replaying again (e.g. a crash before compacting) is idempotent.
+    replayed.replay_log()
+
+    assert (list(replayed._accounts.keys()) == [TestData.username])
+    assert ([msg.get_id() for msg in replayed._messages_by_id.values()] ==
+            [message.get_id()])
+    assert (replayed.log_len == 1)
+    with open(replayed.log_file_name(), "rb") as file:
+        assert (len(file.read()) ==
+                FRAME_LEN_BITS + len(DatabaseRequests.UpsertMessage(
+                    the_message=message).serialize()))
+
+
+def test_snapshot_files(tmp_path):
+    db = db_in_tmp(tmp_path)
+    db.local_upsert_account(Account(logged_in=False,
+                                    username=TestData.username))
+    message = make_message(1)
+    db.local_upsert_message(message)
+    accounts, messages = db.serialize_accounts(), db.serialize_messages()
+    assert (accounts.startswith(SNAPSHOT_MAGIC))
+    assert ([str(v) for v in db.deserialize_accounts(accounts)] ==
+            [str(Account(logged_in=False, username=TestData.username))])
+    assert (db.deserialize_messages(messages) == [message])
+    assert (db.deserialize_accounts(b'') == [])
+
+    # the legacy format, a single `list`, still loads (without the ids).
+    legacy = SerializationUtils.serialize_list(
+        [message.as_model(LegacyMessage)],
+        lambda v: v.serialize())
+    loaded = db.deserialize_messages(legacy)
+    assert (len(loaded) == 1 and loaded[0].get_id() == 0)
+    assert (loaded[0].set_id(message.get_id()) == message)
+
+    # anything else fails, rather than loading as empty.
+    for data in [SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION + 1]) + messages,
+                 messages[:-1],
+                 legacy + b'junk']:
+        with pytest.raises(ValueError):
+            db.deserialize_messages(data)
+
+
+def test_acknowledge_messages(tmp_path, monkeypatch):
+    db = db_in_tmp(tmp_path)
+    monkeypatch.setattr(Config, 'REPLICATION_DURABILITY', 'local')
+    db.local_upsert_account(Account(logged_in=False,
+                                    username=TestData.username))
+    messages = [make_message(time) for time in range(3)]
+    db.send_messages(messages)
+
+    seq = db.log_seq
+    db.acknowledge_messages([msg.get_id() for msg in messages[:2]] + [1000])
+
+    # one change, which replays the same.
+    assert (db.log_seq == seq + 1)
+    replayed = db_in_tmp(tmp_path)
+    replayed.replay_log()
+    for impl_db in [db, replayed]:
+        assert ([msg.get_id()
+                 for msg in impl_db._undelivered[TestData.username]] ==
+                [messages[2].get_id()])
+        assert ([msg.get_delivered()
+                 for msg in impl_db._messages[TestData.username]] ==
+                [True, True, False])
+
+
+def test_incremental_replication(tmp_path):
+    primary = db_in_tmp(tmp_path, 0)
+    replica = db_in_tmp(tmp_path, 1)
+    a, b = socket.socketpair()
+    primary.sync_sockets[1] = FramedSocket(a)
+    b = FramedSocket(b)
+
+    def write(message):
+        primary.local_upsert_message(message)
+        primary.append_log(
+            DatabaseRequests.UpsertMessage(the_message=message).serialize())
+
+    def replicate():
+        primary.sync(1)
+        b.setblocking(False)
+        acks = []
+        try:
+            while True:
+                acks.append(replica.local_replicate(b.recv_frame(), 0))
+        except BlockingIOError:
+            pass
+        b.setblocking(True)
+        return acks
+
+    def stored(db):
+        return sorted(db._messages_by_id.keys())
+
+    # a new replica gets a snapshot, then the primary's position.
+    for i in range(3):
+        write(make_message(i))
+    acks = replicate()
+    assert ([ack.get_seq() for ack in acks] == [3, 3])
+    assert (0 in replica.replicated_ats)
+    assert (stored(replica) == stored(primary))
+
+    # then only the changes since.
+    for i in range(2):
+        write(make_message(i))
+    acks = replicate()
+    assert ([ack.get_seq() for ack in acks] == [4, 5, 5])
+    assert (stored(replica) == stored(primary) == [1, 2, 3, 4, 5])
+    assert (replica.origin_seqs[0] == primary.log_seq == 5)
+
+    # a change out of order is asked for again.
+    ahead = DatabaseRequests.Replicate(seq=7).serialize()
+    assert (replica.local_replicate(ahead, 0).get_resend())
+
+    # a replica behind the backlog gets a snapshot again.
+    primary.replica_sent_seqs[1] = 0
+    primary.log_backlog.popleft()
+    acks = replicate()
+    assert ([ack.get_seq() for ack in acks] == [5, 5])
+    assert (stored(replica) == stored(primary))
+
+
+def test_wait_for_replicas(monkeypatch):
+    db = TestDatabases.db_from_id(0)
+    monkeypatch.setattr(Config, 'REPLICATION_TIMEOUT', 0.2)
+
+    def ack(machine_id, seq):
+        sleep(0.05)
+        with db.replication_cond:
+            db.replica_acked_seqs[machine_id] = seq
+            db.replication_cond.notify_all()
+
+    monkeypatch.setattr(Config, 'REPLICATION_DURABILITY', 'one')
+    thread = Thread(target=ack, args=[1, 1])
+    thread.start()
+    db.wait_for_replicas(1)
+    assert (db.replica_acked_seqs == {1: 1})
+    thread.join()
+
+    # 'all' waits for the other one too, until the timeout.
+    monkeypatch.setattr(Config, 'REPLICATION_DURABILITY', 'all')
+    db.wait_for_replicas(1)
+    thread = Thread(target=ack, args=[2, 2])
+    thread.start()
+    db.wait_for_replicas(2)
+    assert (db.replica_acked_seqs == {1: 1, 2: 2})
+    thread.join()
+
+
+def test_shard_locks(tmp_path, monkeypatch):
+    db = db_in_tmp(tmp_path)
+    monkeypatch.setattr(Config, 'REPLICATION_DURABILITY', 'local')
+    username = TestData.username
+    other_username = next(f'{username!s}{i!s}' for i in range(100)
+                          if db.shard_lock(f'{username!s}{i!s}') is not
+                          db.shard_lock(username))
+
+    # a write to another shard isn't held up by this one.
+    with db.shard_lock(username):
+        thread = Thread(target=db.upsert_account,
+                        args=[Account(username=other_username)])
+        thread.start()
+        thread.join(timeout=1)
+        assert (not thread.is_alive())
+        assert (db.has_account(Account(username=other_username)))
+
+
+def replicate(db, other):
+    """Send `other` what `db` hasn't replicated to it yet (see `sync`), and
+        apply it there.
+    """
+    a, b = socket.socketpair()
+    db.sync_sockets[other.machine_id] = FramedSocket(a)
+    db.sync(other.machine_id)
+    b = FramedSocket(b)
+    b.setblocking(False)
+    try:
+        while True:
+            other.local_replicate(b.recv_frame(), db.machine_id)
+    except BlockingIOError:
+        pass
+    finally:
+        a.close()
+        b.close()
+
+
+def test_partitions(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'PARTITIONS', 4)
+    monkeypatch.setattr(Config, 'REPLICATION_DURABILITY', 'local')
+    dbs = [db_in_tmp(tmp_path, machine_id) for machine_id in range(2)]
+    for db in dbs:
+        db.machines_down = [False, False, True]
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    # the machines take the partitions in turn, and the one that's down's
+    # go to the next one up.
+    assert ([db.partition_primary_ids() for db in dbs] ==
+            [{0: [0, 2, 3], 1: [1]}] * 2)
+    usernames = {}
+    for i in itertools.count():
+        username = f'{TestData.username!s}{i!s}'
+        usernames.setdefault(dbs[0].primary_id_of(username), username)
+        if len(usernames) == 2:
+            break
+
+    # each proxies to the other over a `ProxyConnection`.
+    for db, other in [(dbs[0], dbs[1]), (dbs[1], dbs[0])]:
+        a, b = socket.socketpair()
+        db.queue_sockets[other.machine_id] = [ProxyConnection(FramedSocket(a))]
+        Thread(target=serve_proxy_connection,
+               args=[FramedSocket(b), other.handle_proxied, executor],
+               daemon=True).start()
+
+    # so each write goes to the primary of its username's partition.
+    for username in usernames.values():
+        dbs[0].upsert_account(Account(logged_in=False, username=username))
+    assert ([list(db._accounts.keys()) for db in dbs] ==
+            [[usernames[0]], [usernames[1]]])
+    assert (sorted(dbs[1].get_accounts().keys()) ==
+            sorted(usernames.values()))
+    accounts, more = dbs[1].list_accounts('', '', 1)
+    assert ([account.get_username() for account in accounts] ==
+            [min(usernames.values())] and more)
+
+    messages = [Message(delivered=False,
+                        message=TestData.message,
+                        recipient_logged_in=False,
+                        recipient_username=recipient_username,
+                        sender_username=TestData.username,
+                        time=time)
+                for time, recipient_username in enumerate(
+                    [usernames[0], usernames[1], usernames[1], 'missing'])]
+    assert (dbs[1].send_messages(messages) == ['missing'])
+    # and the primaries' message ids are of their partitions', so they
+    # don't give out the same ones.
+    for machine_id, db in enumerate(dbs):
+        partition = db.partition_of(usernames[machine_id])
+        assert ([message_id % Config.PARTITIONS
+                 for message_id in db._messages_by_id] ==
+                [partition] * (machine_id + 1))
+    ids = list(dbs[0]._messages_by_id) + list(dbs[1]._messages_by_id)
+
+    # each replicates its partitions to the other, leaving the rest alone.
+    replicate(dbs[0], dbs[1])
+    replicate(dbs[1], dbs[0])
+    for db in dbs:
+        assert (sorted(db._accounts.keys()) == sorted(usernames.values()))
+        assert (sorted(db._messages_by_id.keys()) == sorted(ids))
+
+    dbs[0].acknowledge_messages(ids)
+    assert ([db.get_messages(Account(username=usernames[machine_id]), False)
+             for machine_id, db in enumerate(dbs)] == [[], []])
+
+    # and deleting everything deletes every partition, on their primaries.
+    dbs[1].delete_all()
+    assert ([db.get_accounts() for db in dbs] == [{}, {}])
+    executor.shutdown(wait=False)
+
+
+@pytest.mark.parametrize("chat", [Chat.WIRE])
+def test_read_locally(chat: Chat, kwargs, monkeypatch):
+    clean_between_tests(chat, 0)
+    create_account(chat, **kwargs[0])
+    replica = TestDatabases.DBS[chat][1]
+    account = Account(username=TestData.username)
+
+    # the primary sends its position at least every heartbeat.
+    sleep(2 * Config.REPLICATION_HEARTBEAT)
+    assert (not replica.read_locally())
+    assert (replica.read_locally('bounded'))
+
+    # so a 'bounded' read doesn't go to the primary at all.
+    def proxy(*args, **kwargs):
+        raise AssertionError('proxied')
+    monkeypatch.setattr(replica, 'proxy', proxy)
+    monkeypatch.setattr(Config, 'READ_CONSISTENCY', 'bounded')
+    assert (replica.has_account(account))
+    assert ([a.get_username()
+             for a in replica.list_accounts('', '', 1)[0]] ==
+            [TestData.username])
+
+    # but not if it hasn't heard from the primary in a while.
+    monkeypatch.setattr(Config, 'READ_MAX_STALENESS', 0)
+    assert (not replica.read_locally())
+
+
+def test_partitions_rejoin(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'PARTITIONS', 2)
+    monkeypatch.setattr(Config, 'REPLICATION_DURABILITY', 'local')
+    dbs = [db_in_tmp(tmp_path, machine_id) for machine_id in range(2)]
+    for db in dbs:
+        db.machines_down = [False, False, True]
+        db.primary_id = 0
+    username = next(username for username in
+                    (f'{TestData.username!s}{i!s}' for i in itertools.count())
+                    if dbs[0].primary_id_of(username) == 1)
+
+    def message(text):
+        return Message(delivered=False,
+                       message=text,
+                       recipient_logged_in=False,
+                       recipient_username=username,
+                       sender_username=TestData.username,
+                       time=0)
+
+    def stored(db):
+        return (db._accounts[username].get_logged_in(),
+                sorted(msg.get_message() for msg in db._messages[username]))
+
+    # machine 1 is the primary of `username`'s partition.
+    dbs[1].upsert_account(Account(logged_in=False, username=username))
+    dbs[1].send_messages([message('before')])
+    replicate(dbs[1], dbs[0])
+
+    # it goes down, so machine 0 takes the partition over meanwhile.
+    dbs[0].set_machine_down(1)
+    assert (dbs[0].primary_id_of(username) == 0)
+    dbs[0].upsert_account(Account(logged_in=True, username=username))
+    dbs[0].send_messages([message('while down')])
+
+    # then it's back (with only what it had before), but it isn't the
+    # primary of its partition again until it's caught up.
+    back = db_in_tmp(tmp_path, 1)
+    back.replay_log()
+    back.machines_down = [False, False, True]
+    back.machines_caught_up = [True, False, False]
+    back.primary_id = 0
+    dbs[0].set_machine_up(1)
+    assert (stored(back) == (False, ['before']))
+    assert (not back.check_caught_up())
+    assert (dbs[0].primary_id_of(username) == back.primary_id_of(username) ==
+            0)
+    # so it has nothing of its own to replicate, e.g. a stale snapshot.
+    assert (not back.needs_sync(0))
+
+    replicate(dbs[0], back)
+    assert (back.check_caught_up())
+    assert (stored(back) == (True, ['before', 'while down']))
+
+    # once the others hear it is, it's the primary of it again.
+    dbs[0].machines_caught_up[1] = True
+    assert (dbs[0].primary_id_of(username) == back.primary_id_of(username) ==
+            1)
+    back.send_messages([message('after')])
+    replicate(back, dbs[0])
+    for db in [dbs[0], back]:
+        assert (stored(db) == (True, ['after', 'before', 'while down']))
+
+
+def test_proxy_connection():
+    a, b = socket.socketpair()
+    connection = ProxyConnection(FramedSocket(a))
+    executor = ThreadPoolExecutor(max_workers=8)
+    waiting = Lock()
+    waiting.acquire()
+
+    def handle(request: bytes) -> bytes:
+        # the first request waits on the last, so they're answered out of
+        # order on the one connection.
+        if request == b'0':
+            assert (waiting.acquire(timeout=5))
+        elif request == b'7':
+            waiting.release()
+        elif request == b'fail':
+            raise ValueError('Bad request.')
+        return request * 2
+
+    server = Thread(target=serve_proxy_connection,
+                    args=[FramedSocket(b), handle, executor])
+    server.start()
+
+    results = {}
+    threads = [Thread(target=lambda i=i: results.update(
+        {i: connection.request(str(i).encode('utf-8'), timeout=5)}))
+        for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert (results == {i: str(i).encode('utf-8') * 2 for i in range(8)})
+
+    # a request that fails gets the error back, and the connection (and the
+    # other requests on it) carries on.
+    with pytest.raises(RuntimeError, match='Bad request.'):
+        connection.request(b'fail', timeout=5)
+    assert (not connection.closed)
+    assert (connection.request(b'8', timeout=5) == b'88')
+
+    # and once it's closed, requests fail rather than wait.
+    connection.close()
+    server.join(timeout=5)
+    assert (not server.is_alive())
+    with pytest.raises(ConnectionError):
+        connection.request(b'0')
+    executor.shutdown()
+
+
+def test_proxy_timeout():
+    db = TestDatabases.db_from_id(0)
+    account = Account(logged_in=True, username=TestData.username)
+
+    class SlowConnection:
+        closed = False
+
+        def request(self, data, timeout=None):
+            raise TimeoutError('No response in time.')
+
+    # a slow primary is still up, so the write isn't done here instead.
+    db.queue_sockets = {1: [SlowConnection()]}
+    with pytest.raises(TimeoutError):
+        db.proxy(DatabaseOpcode.UPSERT_ACCOUNT, 1, account=account)
+    assert (db.machines_down == [False, False, False])
+    assert (db._accounts == {})
+    assert (Config.TIMEOUT_PROXY > Config.REPLICATION_TIMEOUT)
+
+
+def test_proxy_waits_for_heartbeats(tmp_path, monkeypatch):
+    db = db_in_tmp(tmp_path)
+    monkeypatch.setattr(Config, 'REPLICATION_DURABILITY', 'local')
+    # it's started, so only the heartbeats say whether a machine is down.
+    db.membership = object()
+    db.primary_id = 1
+    account = Account(logged_in=True, username=TestData.username)
+    executor = ThreadPoolExecutor(max_workers=1)
+    handled = []
+
+    def handle(request: bytes) -> bytes:
+        handled.append(request)
+        return DatabaseResponses.UpsertAccount().serialize()
+
+    def connect():
+        # it's only just up, so its connections come a bit later.
+        sleep(0.2)
+        a, b = socket.socketpair()
+        Thread(target=serve_proxy_connection,
+               args=[FramedSocket(b), handle, executor],
+               daemon=True).start()
+        with db.machine_cond:
+            db.queue_sockets[1] = [ProxyConnection(FramedSocket(a))]
+            db.machine_cond.notify_all()
+
+    # not being connected to the primary yet isn't it being down, so the
+    # write waits for the connection rather than being done here.
+    Thread(target=connect).start()
+    db.upsert_account(account)
+    assert (len(handled) == 1)
+    assert (db.machines_down == [False, False, False])
+    assert (db._accounts == {})
+
+    # nor is its connection breaking, until its heartbeats stop.
+    db.queue_sockets[1][0].close()
+
+    def down():
+        sleep(0.2)
+        with db.machine_cond:
+            db.machines_down[1] = True
+            db.primary_id = 0
+            db.machine_cond.notify_all()
+
+    Thread(target=down).start()
+    db.proxy(DatabaseOpcode.UPSERT_ACCOUNT, 1, account=account)
+    assert (len(handled) == 1)
+    assert (list(db._accounts.keys()) == [TestData.username])
+    executor.shutdown()
+
+
+def test_cluster_addresses():
+    addresses = parse_addresses('localhost:40130, 10.0.0.2:40130/'
+                                'sync=10.0.1.2:5000,[::1]:40150,'
+                                'h:40160,h:40170')
+    assert (len(addresses) == 5)
+    assert ([channel_address(addresses[0], channel)
+             for channel in Channel] ==
+            [('localhost', 40130 + i) for i in range(4)])
+    assert ([channel_address(addresses[1], channel)
+             for channel in Channel] ==
+            [('10.0.0.2', 40130),
+             ('10.0.0.2', 40131),
+             ('10.0.1.2', 5000),
+             ('10.0.0.2', 40133)])
+    assert (channel_address(addresses[2], Channel.CLIENT) ==
+            ('::1', 40150))
+
+    for text in ['', 'localhost', 'localhost:x', 'h:1/client', 'h:1/x=h:2']:
+        with pytest.raises(ValueError):
+            parse_addresses(text)
+
+
+def test_membership():
+    addresses = [('localhost', 50130), ('localhost', 50140)]
+    events = {0: [], 1: []}
+    beats = {0: [], 1: []}
+
+    def membership(machine_id: int) -> Membership:
+        return Membership(
+            machine_id,
+            addresses,
+            beat=lambda: str(machine_id).encode('utf-8'),
+            on_beat=lambda i, data: beats[machine_id].append((i, data)),
+            on_up=lambda i: events[machine_id].append(('up', i)),
+            on_down=lambda i: events[machine_id].append(('down', i)),
+            interval=0.02,
+            timeout=0.2)
+
+    def wait_until(condition: Callable[[], bool]):
+        deadline = monotonic() + 5
+        while not condition() and monotonic() < deadline:
+            sleep(0.01)
+        assert (condition())
+
+    # each notices the other once it's heard from, whichever starts first.
+    first = membership(0)
+    first.start()
+    sleep(0.1)
+    assert (events[0] == [])
+    second = membership(1)
+    second.start()
+    wait_until(lambda: first.is_up(1) and second.is_up(0))
+    assert (events == {0: [('up', 1)], 1: [('up', 0)]})
+    assert ((1, b'1') in beats[0] and (0, b'0') in beats[1])
+
+    # and that it's down once it isn't.
+    second.close()
+    wait_until(lambda: not first.is_up(1))
+    assert (events[0] == [('up', 1), ('down', 1)])
+
+    # a suspected machine is up again once it's heard from again.
+    second = membership(1)
+    second.start()
+    wait_until(lambda: first.is_up(1))
+    first.suspect(1)
+    wait_until(lambda: first.is_up(1))
+    assert (events[0] == [('up', 1), ('down', 1), ('up', 1), ('up', 1)])
+    first.close()
+    second.close()
+
+
+@pytest.mark.parametrize("chat", [Chat.WIRE])
+def test_deliver_undelivered_messages_ack_ids(chat: Chat, kwargs):
+    clean_between_tests(chat, 0)
+    create_account(chat, **kwargs[0])
+    for _ in range(2):
+        send_message(chat,
+                     recipient_username=TestData.username,
+                     message=TestData.message,
+                     **kwargs[0])
+
+    delivered = deliver_undelivered_messages(chat, **kwargs[0])
+    ack_ids = [msg.get_id() for msg in delivered.get_messages()]
+    assert (len(ack_ids) == 2)
+
+    # the next delivery acknowledges the last one's messages first.
+    response = deliver_undelivered_messages(chat,
+                                            ack_ids=ack_ids[:1],
+                                            **kwargs[0])
+    assert ([msg.get_id() for msg in response.get_messages()] ==
+            ack_ids[1:])
+    response = deliver_undelivered_messages(chat,
+                                            ack_ids=ack_ids[1:],
+                                            **kwargs[0])
+    assert (len(response.get_error()) != 0)
+
+
+@pytest.mark.parametrize("chat", [Chat.WIRE])
+def test_acknowledge_messages_ids(chat: Chat, kwargs):
+    clean_between_tests(chat, 0)
+    create_account(chat, **kwargs[0])
+    for _ in range(2):
+        send_message(chat,
+                     recipient_username=TestData.username,
+                     message=TestData.message,
+                     **kwargs[0])
+
+    delivered = deliver_undelivered_messages(chat, **kwargs[0])
+    ack_ids = [msg.get_id() for msg in delivered.get_messages()]
+    assert (len(ack_ids) == 2)
+
+    # only the ids are sent to acknowledge, not the whole messages.
+    request = AcknowledgeMessagesRequest(ids=ack_ids[:1])
+    assert (AcknowledgeMessagesRequest.deserialize(request.serialize())
+            .get_ids() == ack_ids[:1])
+    assert (len(request.serialize()) <
+            len(delivered.get_messages()[0].serialize()))
+
+    response = acknowledge_messages(chat, ack_ids=ack_ids[:1], **kwargs[0])
+    assert (len(response.get_error()) == 0)
+    response = deliver_undelivered_messages(chat, **kwargs[0])
+    assert ([msg.get_id() for msg in response.get_messages()] ==
+            ack_ids[1:])
+
+
+@pytest.mark.parametrize("chat", [Chat.WIRE])
+@pytest.mark.parametrize("machine_id", range(2))
+def test_pagination(chat: Chat, machine_id: int, kwargs):
+    clean_between_tests(chat, machine_id)
+    usernames = [f'{TestData.username!s}{i!s}' for i in range(5)]
+    for username in reversed(usernames):
+        create_account(chat, username=username, **kwargs[machine_id])
+    create_account(chat, username=TestData.message, **kwargs[machine_id])
+
+    # the accounts come in order of username, a page at a time.
+    pages = []
+    cursor = ''
+    while cursor is not None:
+        response = list_accounts(chat,
+                                 TestData.username,
+                                 limit=2,
+                                 cursor=cursor,
+                                 **kwargs[machine_id])
+        assert (len(response.get_error()) == 0)
+        pages.append([account.get_username()
+                      for account in response.get_accounts()])
+        cursor = response.get_next_cursor() or None
+    assert (pages == [usernames[:2], usernames[2:4], usernames[4:]])
+
+    for i in range(5):
+        send_message(chat,
+                     recipient_username=usernames[0],
+                     message=f'{TestData.message!s} {i!s}',
+                     **kwargs[machine_id])
+
+    # as do the messages, without acknowledging them.
+    messages = []
+    cursor = ''
+    while cursor is not None:
+        response = deliver_undelivered_messages(chat,
+                                                username=usernames[0],
+                                                limit=3,
+                                                cursor=cursor,
+                                                **kwargs[machine_id])
+        assert (len(response.get_error()) == 0)
+        assert (len(response.get_messages()) <= 3)
+        messages += [msg.get_message() for msg in response.get_messages()]
+        cursor = response.get_next_cursor() or None
+    assert (messages == [f'{TestData.message!s} {i!s}' for i in range(5)])
+
+    response = deliver_undelivered_messages(chat,
+                                            username=usernames[0],
+                                            cursor='not a cursor',
+                                            **kwargs[machine_id])
+    assert (len(response.get_error()) != 0)
+
+
+@pytest.mark.parametrize("chat", [Chat.WIRE])
+def test_deliver_undelivered_messages_long_poll(chat: Chat, kwargs):
+    clean_between_tests(chat, 0)
+    create_account(chat, **kwargs[0])
+
+    # the long-poll holds its connection, so the message is sent on another.
+    poller = start_client(chat, machine_id=0)
+    responses = []
+    thread = Thread(target=lambda: responses.append(
+        deliver_undelivered_messages(chat, max_wait=5000, **poller)))
+    thread.start()
+    sleep(0.2)
+    assert (thread.is_alive())
+
+    send_message(chat,
+                 recipient_username=TestData.username,
+                 message=TestData.message,
+                 **kwargs[0])
+    thread.join(timeout=2)
+    poller['s'].close()
+
+    assert (not thread.is_alive())
+    assert (len(responses[0].get_error()) == 0)
+    assert ([msg.get_message() for msg in responses[0].get_messages()] ==
+            [TestData.message])
+
+
+@pytest.mark.parametrize("chat", [Chat.WIRE])
+def test_deliver_undelivered_messages_waiting(chat: Chat, kwargs):
+    clean_between_tests(chat, 0)
+    create_account(chat, **kwargs[0])
+
+    # with every waiting thread taken, a long-poll returns at once.
+    taken = 0
+    while Events.waiting.acquire(blocking=False):
+        taken += 1
+    try:
+        start = monotonic()
+        response = Events.deliver_undelivered_messages(
+            logged_in=False,
+            username=TestData.username,
+            max_wait=5000,
+            database=TestDatabases.DBS[chat][0])
+        assert (monotonic() - start < 1)
+        assert (len(response.get_error()) != 0)
+    finally:
+        for _ in range(taken):
+            Events.waiting.release()
+    assert (taken == Config.DELIVERY_MAX_WAITING)
+    assert (Config.DELIVERY_MAX_WAITING < Config.MAX_WORKERS)
+
+
+@pytest.mark.parametrize("chat", [Chat.WIRE])
+def test_subscribe_messages(chat: Chat, kwargs):
+    clean_between_tests(chat, 0)
+    create_account(chat, **kwargs[0])
+    send_message(chat,
+                 recipient_username=TestData.username,
+                 message=TestData.message,
+                 **kwargs[0])
+
+    subscription = wire_client_subscribe(TestData.username, **kwargs[0])
+    subscription.s.settimeout(5)
+    responses = iter(subscription)
+    try:
+        # the undelivered message is pushed straight away.
+        pushed = next(responses).get_messages()
+        assert ([msg.get_message() for msg in pushed] == [TestData.message])
+
+        send_message(chat,
+                     recipient_username=TestData.username,
+                     message=TestData.message * 2,
+                     **kwargs[0])
+
+        # then the new one (only), skipping any heartbeats.
+        pushed = []
+        while len(pushed) == 0:
+            pushed = next(responses).get_messages()
+        assert ([msg.get_message() for msg in pushed] ==
+                [TestData.message * 2])
+    finally:
+        subscription.cancel()
+
+
+def test_channel_pool():
+    pool = ChannelPool('localhost:0', size=2)
+    try:
+        # one stub per channel, handed out round-robin.
+        stubs = [pool.stub() for _ in range(4)]
+        assert (stubs[0] is not stubs[1])
+        assert (stubs[:2] == stubs[2:])
+        assert (len(pool.channels) == 2)
+    finally:
+        pool.close()
+
+
+@pytest.mark.parametrize("chat", [Chat.WIRE])
+def test_asyncio_grpc_server(chat: Chat, kwargs):
+    clean_between_tests(chat, 0)
+
+    async def run():
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            server = grpc.aio.server(
+                options=server_options(Config.GRPC_MAX_CONCURRENT_STREAMS,
+                                       Config.GRPC_MAX_MESSAGE_LEN))
+            proto_pb2_grpc.add_ChatServicer_to_server(
+                AsyncChatServicer(executor=executor,
+                                  database=TestDatabases.DBS[chat][0]),
+                server)
+            port = server.add_insecure_port('localhost:0')
+            await server.start()
+            pool = ChannelPool(f'localhost:{port!s}', aio=True)
+            try:
+                created = await grpc_client_request_async(
+                    Opcode.CREATE_ACCOUNT,
+                    username=TestData.username,
+                    pool=pool)
+                listed = await grpc_client_request_async(
+                    Opcode.LIST_ACCOUNTS,
+                    text_wildcard='',
+                    pool=pool)
+                return created, listed
+            finally:
+                await pool.close_async()
+                await server.stop(None)
+
+    created, listed = asyncio.run(run())
+    assert (len(created.get_error()) == 0)
+    assert ([account.get_username() for account in listed.get_accounts()] ==
+            [TestData.username])
+
+
+@pytest.mark.parametrize("chat", [Chat.WIRE])
+def test_asyncio_server(chat: Chat, kwargs):
+    clean_between_tests(chat, 0)
+
+    async def run():
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            server = await asyncio.start_server(
+                partial(handle_connection_async,
+                        executor=executor,
+                        database=TestDatabases.DBS[chat][0]),
+                'localhost',
+                0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                reader, writer = await asyncio.open_connection('localhost',
+                                                               port)
+                for request in [
+                        CreateAccountRequest(username=TestData.username),
+                        ListAccountsRequest(text_wildcard='')]:
+                    writer.write(serialize_frame(request.serialize()))
+                responses = [await read_frame(reader) for _ in range(2)]
+                writer.close()
+                await writer.wait_closed()
+                return responses
+
+    created, listed = asyncio.run(run())
+    assert (len(CreateAccountResponse.deserialize(created).get_error()) == 0)
+    assert ([account.get_username()
+             for account in (ListAccountsResponse.deserialize(listed)
+                             .get_accounts())] ==
+            [TestData.username])
+
+
+@pytest.mark.parametrize("chat", [Chat.WIRE])
+def test_asyncio_server_long_poll(chat: Chat, kwargs):
+    clean_between_tests(chat, 0)
+
+    async def request(connection, request):
+        reader, writer = connection
+        writer.write(serialize_frame(request.serialize()))
+        return await asyncio.wait_for(read_frame(reader), timeout=2)
+
+    async def run():
+        # a single thread, which the waiting long-poll mustn't hold.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            server = await asyncio.start_server(
+                partial(handle_connection_async,
+                        executor=executor,
+                        database=TestDatabases.DBS[chat][0]),
+                'localhost',
+                0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                poller = await asyncio.open_connection('localhost', port)
+                sender = await asyncio.open_connection('localhost', port)
+                await request(sender,
+                              CreateAccountRequest(username=TestData.username))
+                delivered = asyncio.create_task(request(
+                    poller,
+                    DeliverUndeliveredMessagesRequest(
+                        logged_in=False,
+                        username=TestData.username,
+                        max_wait=5000)))
+                await asyncio.sleep(0.2)
+                assert (not delivered.done())
+                await request(sender,
+                              SendMessageRequest(
+                                  message=TestData.message,
+                                  recipient_username=TestData.username,
+                                  sender_username=TestData.username))
+                delivered = await delivered
+                for _, writer in [poller, sender]:
+                    writer.close()
+                    await writer.wait_closed()
+                return delivered
+
+    response = DeliverUndeliveredMessagesResponse.deserialize(
+        asyncio.run(run()))
+    assert (len(response.get_error()) == 0)
+    assert ([msg.get_message() for msg in response.get_messages()] ==
+            [TestData.message])